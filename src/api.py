@@ -1,5 +1,7 @@
 """Description of your app."""
-from typing import Type, Optional, Dict, Any, cast, List
+import logging
+import time
+from typing import Type, Optional, Dict, Any, cast, List, Union
 
 from steamship.experimental.package_starters.telegram_bot import TelegramBotConfig, TelegramBot
 from steamship.experimental.transports.chat import ChatMessage
@@ -8,8 +10,38 @@ from steamship import SteamshipError, File, Block, Tag, PluginInstance
 from steamship.data.tags.tag_constants import TagKind, RoleTag
 from pydantic import Field
 
+from tokenizer import count_tokens, token_count_tag, remember_token_count, block_token_counts, \
+    encoding_name_for_model, get_encoder
+from chat_cache import chat_files
+from chat_export import DEFAULT_MAX_BLOCKS, NDJSON_MIME_TYPE, ChatExporter, chat_id_of, message_id_tag, \
+    ndjson_lines
+from chat_segments import ChatManifest, closing_block_index, load_manifest, manifests, roll_segment
+from client_registry import steamship_clients
+from chat_scheduler import chat_scheduler, is_awaiting_reply
+from compaction import is_summary_block, pending_compactions, summary_block, summary_prompt
+from context_window import ContextWindow, context_windows, is_system_block
+from streaming import StreamingMessage, partial_output_text
+from telegram_sender import TelegramSender, split_message, telegram_senders
+from memory import ChatMemory, chat_memories
+from message_index import message_index, message_ids_in_blocks, message_ids_in_file
+from metrics import cache_lookups, completion_tokens, metrics, time_stage, timed
+from reply_cache import ReplyCache, prompt_key, reply_caches
+from routing import choose_models, model_latency, race
+from token_scheduler import BUSY_REPLY, TokenScheduler, token_schedulers
+from traffic_capture import TrafficRecorder, traffic_recorders
+from update_filters import ContentTypeFilter, FilterPipeline, FloodFilter, GroupMentionFilter, RepeatFilter, \
+    UpdateFilter, filter_pipelines
 from util import filter_blocks_for_prompt_length
 
+# What prompts are selected with: recency only, or recency plus relevant older turns
+PromptWindow = Union[ContextWindow, ChatMemory]
+
+# Telegram usernames by bot token, from getMe
+bot_usernames: Dict[str, Optional[str]] = {}
+# After a failed getMe, when it may be tried again, by bot token
+bot_username_retry_at: Dict[str, float] = {}
+BOT_USERNAME_RETRY_S = 60
+
 
 class TelegramBuddyConfig(TelegramBotConfig):
     """Config object containing required parameters to initialize a MyPackage instance."""
@@ -17,89 +49,630 @@ class TelegramBuddyConfig(TelegramBotConfig):
     bot_name: str = Field(description='What the bot should call itself')
     bot_personality: str = Field(description='Complete the sentence, "The bot\'s personality is _." Writing a longer, more detailed description will yield less generic results.')
     use_gpt4: bool = Field(False, description="If True, use GPT-4 instead of GPT-3.5 to generate responses. GPT-4 creates better responses at higher cost and with longer wait times.")
+    async_replies: bool = Field(False, description="If True, acknowledge Telegram immediately and generate the reply in a background task, showing \"typing…\" meanwhile.")
+    streaming_replies: bool = Field(False, description="If True, post a placeholder message right away and edit it in place as the reply is generated.")
+    summarize_after_tokens: int = Field(0, description="If above 0, once a chat's history exceeds this many tokens its older turns are folded into a summary, and the chat continues in a new segment file that starts with it.")
+    reply_debounce_ms: int = Field(0, description="Wait this long after a message for more messages from the same chat, then answer the whole burst with a single reply. At 0, every message gets its own reply, except with async_replies on: messages that arrive before the pending background reply is generated are answered by it together.")
+    latency_budget_ms: int = Field(0, description="If above 0, switch to the other GPT model when the configured one is recently slower than this, and also ask the faster model when a reply takes longer than this. The first answer is used.")
+    reply_cache_ttl_s: int = Field(0, description="If above 0, reuse a generated reply for this many seconds whenever the system prompt and a chat's turns so far repeat, e.g. /start or \"hi\" in a new chat.")
+    reply_cache_turns: int = Field(2, description="Replies are only cached and reused for prompts with at most this many turns, which must all match after normalizing case, spacing and trailing punctuation.")
+    reply_cache_max_entries: int = Field(1000, description="Most replies kept in the reply cache; the least recently used are dropped first.")
+    tokens_per_minute: int = Field(0, description="If above 0, keep generation within this many model tokens per minute, sharing them fairly between chats. Messages that would wait too long get a short \"busy\" reply.")
+    max_queue_wait_s: int = Field(20, description="Longest a message waits for its share of tokens_per_minute before the bot answers that it is busy.")
+    segment_max_blocks: int = Field(0, description="If above 0, once a chat File holds more than this many blocks, continue the chat in a new File that starts with the system prompt and recent turns. Older Files are kept for export and search; keep this on once chats have been split.")
+    memory_top_k: int = Field(0, description="If above 0, build prompts from the system prompt, the newest memory_recent_turns turns and up to this many older turns most relevant to the latest message, instead of as much recent history as fits.")
+    memory_recent_turns: int = Field(6, description="How many of the newest turns are always part of the prompt when memory_top_k is set.")
+    memory_embedder: str = Field("hashing", description="How turns are embedded for relevance search when memory_top_k is set. \"hashing\" needs no model or network.")
+    memory_max_turns: int = Field(4096, description="How many of a chat's newest turns can be recalled when memory_top_k is set. Bounds the memory each chat's index takes.")
+    group_mentions_only: bool = Field(True, description="If True, in group chats only answer messages that mention the bot, reply to it, or are commands.")
+    flood_max_messages: int = Field(0, description="If above 0, ignore a user's messages beyond this many per flood_window_s seconds in a chat.")
+    flood_window_s: int = Field(60, description="Length of the window flood_max_messages applies to.")
+    repeat_window_s: int = Field(0, description="If above 0, ignore a message that exactly repeats the user's previous one in the chat within this many seconds.")
+    capture_traffic_path: str = Field("", description="If set, append an anonymized copy of every incoming Telegram update, with its arrival time, to this JSONL file for load-test replay. Ids are pseudonymized with the key in $TRAFFIC_CAPTURE_SALT, or else in a .salt file next to the capture.")
 
 class TelegramBuddy(TelegramBot):
     """Telegram Buddy package.  Stores individual chats in Steamship Files for chat history."""
 
     config: TelegramBuddyConfig
-    gpt4: Optional[PluginInstance]
+    llms: Dict[str, PluginInstance]
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.model = "gpt-4" if self.config.use_gpt4 else "gpt-3.5-turbo"
-        self.gpt4 = None
+        self.fallback_model = "gpt-3.5-turbo" if self.config.use_gpt4 else "gpt-4"
+        # Both models tokenize with cl100k_base, so token counts hold whichever one answers
+        self.encoding_name = encoding_name_for_model(self.model)
+        self.llms = {}
+        self.send_media = self.telegram_transport.send
+        self.telegram_transport.send = timed("telegram_send")(self.send_messages)
+
+    def instance_init(self):
+        """Register the webhook, then load the model's BPE ranks so the first reply does not pay for them."""
+        super().instance_init()
+        get_encoder(self.encoding_name)
 
     def get_gpt4(self) -> PluginInstance:
-        if self.gpt4 is not None:
-            return self.gpt4
-        else:
-            self.gpt4 = self.client.use_plugin("gpt-4", config={"model": self.model, "temperature": 0.8})
-            return self.gpt4
+        return self.get_llm(self.model)
+
+    def get_llm(self, model: str) -> PluginInstance:
+        if model not in self.llms:
+            # Made once per process and workspace, not once per invocation
+            self.llms[model] = steamship_clients.plugin_instance(self.client, "gpt-4",
+                                                                 config={"model": model, "temperature": 0.8})
+        return self.llms[model]
 
     @classmethod
     def config_cls(cls) -> Type[Config]:
         """Return the Configuration class."""
         return TelegramBuddyConfig
 
+    @post("respond", public=True)
+    @timed("respond")
+    def respond(self, **kwargs) -> InvocableResponse[str]:
+        """Telegram webhook endpoint. Retried updates are acknowledged without any further work."""
+        arrived_at, started = TrafficRecorder.now(), time.perf_counter()
+        try:
+            if not message_index.claim_update(kwargs.get("update_id")):
+                logging.info(f"Ignoring retried Telegram update {kwargs.get('update_id')}")
+                return InvocableResponse(string="OK")
+            # Stickers, edits, group chatter and floods are dropped here, before any storage or model access
+            if not self.get_update_filters().admit(kwargs):
+                return InvocableResponse(string="OK")
+            return super().respond(**kwargs)
+        finally:
+            if self.config.capture_traffic_path:
+                # Retries are captured too; a replay should exercise the duplicate handling as well
+                traffic_recorders.get(self.config.capture_traffic_path).record(
+                    "/respond", kwargs, arrived_at, time.perf_counter() - started)
+
+    @timed("create_response")
     def create_response(self, incoming_message: ChatMessage) -> Optional[List[ChatMessage]]:
         """ Use the LLM to prepare the next response by appending the user input to the file and then generating. """
-        chat_file = self.get_file_for_chat(incoming_message.get_chat_id())
+        chat_id = incoming_message.get_chat_id()
+        message_id = incoming_message.get_message_id()
+        debounce_ms = self.config.reply_debounce_ms
+
+        # Appends and generations for one chat never overlap, so history order is arrival order
+        with chat_scheduler.lock(chat_id):
+            if message_index.contains(chat_id, message_id):
+                return None
+
+            chat_file = self.get_file_for_chat(chat_id)
 
-        if self.includes_message(chat_file, incoming_message.get_message_id()):
+            index_loaded = message_index.is_loaded(chat_id)
+            cache_lookups.inc(cache="message_index", result="hit" if index_loaded else "miss")
+            if not index_loaded:
+                message_index.load(chat_id, message_ids_in_file(chat_file))
+                if message_index.contains(chat_id, message_id):
+                    return None
+
+            if incoming_message.text is None or incoming_message.text == "":
+                return None
+
+            try:
+                if self.append_user_message(chat_id, chat_file, message_id, incoming_message.text) is None:
+                    return None
+            except Exception as e:
+                # The cached File or manifest may be out of date, e.g. another worker deleted the File; retry on fresh copies
+                logging.warning(f"Appending to the cached File of chat {chat_id} failed, retrying on a fresh copy: {e}")
+                self.forget_chat_file(chat_id, chat_file)
+                manifests.discard(chat_id)
+                message_index.discard(chat_id)
+                chat_file = self.get_file_for_chat(chat_id)
+                message_index.load(chat_id, message_ids_in_file(chat_file))
+                if message_index.contains(chat_id, message_id):
+                    return None
+                if self.append_user_message(chat_id, chat_file, message_id, incoming_message.text) is None:
+                    return None
+            if not debounce_ms and not self.config.async_replies:
+                # Without a debounce window nothing is coalesced: each message is answered before the next is appended
+                return self.generate_for_chat(chat_id, self.get_file_for_chat(chat_id))
+            ticket = chat_scheduler.take_ticket(chat_id)
+
+        if self.config.async_replies:
+            # Answer the webhook now; generation and delivery happen in generate_reply
+            self.send_chat_action(chat_id)
+            self.invoke_later("generate_reply", arguments={"chat_id": chat_id, "message_id": message_id},
+                              delay_ms=debounce_ms or None)
             return None
 
-        if incoming_message.text is None or incoming_message.text == "":
+        # Only the last message of a burst replies; its prompt already contains the earlier ones
+        if not chat_scheduler.wait_for_quiet(chat_id, ticket, debounce_ms / 1000):
             return None
+        with chat_scheduler.lock(chat_id):
+            if not chat_scheduler.is_latest(chat_id, ticket):
+                return None
+            return self.generate_for_chat(chat_id, self.get_file_for_chat(chat_id))
+
+    @post("generate_reply")
+    def generate_reply(self, chat_id: str, message_id: Optional[str] = None) -> InvocableResponse[str]:
+        """Background half of an async reply: generate for the chat and send the result to Telegram."""
+        try:
+            with chat_scheduler.lock(chat_id):
+                chat_file = self.get_file_for_chat(chat_id)
+                if message_id is not None and not is_awaiting_reply(chat_file, message_id):
+                    # This process's copy may predate the message if another worker appended it; re-read it
+                    chat_file = self.refresh_chat_file(chat_id, chat_file)
+                if message_id is not None and not is_awaiting_reply(chat_file, message_id):
+                    # A later message was appended (or answered); its reply covers this one. This coalesces even
+                    # without a debounce window: replies are not tied to a message, so both would answer the newest
+                    logging.info(f"Skipping reply to message {message_id} in chat {chat_id}: superseded")
+                    return InvocableResponse(string="OK")
+                response = self.generate_for_chat(chat_id, chat_file)
+        except Exception as e:
+            logging.exception(f"Failed generating reply to message {message_id} in chat {chat_id}")
+            response = [self.response_for_exception(e, chat_id=chat_id)]
+        self.telegram_transport.send(response)
+        return InvocableResponse(string="OK")
 
-        chat_file.append_block(text=incoming_message.text, tags=[
+    @timed("append_user_message")
+    def append_user_message(self, chat_id: str, chat_file: File, message_id: str, text: str) -> Optional[Block]:
+        """Append the user's message to the chat file, keeping the local caches in step. None if the File turned
+        out to hold the message already, e.g. because another worker handled a retry of its update."""
+        # Count tokens once, at write time; the count travels with the block as a tag
+        num_tokens = count_tokens(text, self.encoding_name)
+        next_index = len(chat_file.blocks)
+        user_block = chat_file.append_block(text=text, tags=[
             Tag(kind=TagKind.ROLE, name=RoleTag.USER),
-            Tag(kind="message_id", name=incoming_message.get_message_id())
+            message_id_tag(message_id),
+            token_count_tag(num_tokens, self.encoding_name)
         ])
+        remember_token_count(user_block, num_tokens, self.encoding_name)
+        message_index.add(chat_id, message_id)
+        if not chat_files.record_appended(chat_id, chat_file, [user_block], next_index):
+            # Another worker wrote to the File, so this process's message index may be missing its messages too
+            current_file = self.refresh_chat_file(chat_id, chat_file)
+            message_index.discard(chat_id)
+            message_index.load(chat_id, message_ids_in_file(current_file))
+            if current_file is not chat_file:
+                # The message landed after the close marker; it belongs in the chat's current segment
+                if message_index.contains(chat_id, message_id):
+                    return None
+                return self.append_user_message(chat_id, current_file, message_id, text)
+            earlier = [block for block in chat_file.blocks if block.index_in_file < user_block.index_in_file]
+            if message_id in message_ids_in_blocks(earlier):
+                logging.info(f"Message {message_id} of chat {chat_id} was already appended by another worker")
+                user_block.delete()
+                # The local copy still holds the deleted block
+                self.forget_chat_file(chat_id, chat_file)
+                return None
+        return user_block
+
+    def refresh_chat_file(self, chat_id: str, chat_file: File) -> File:
+        """Re-read a cached chat File that another worker may have written to. If that worker closed it, the
+        chat's current segment is returned instead."""
         chat_file.refresh()
+        if closing_block_index(chat_file) is None:
+            chat_files.put(chat_id, chat_file)
+            return chat_file
+        logging.info(f"Segment {chat_file.handle} of chat {chat_id} was closed; continuing in the next one")
+        self.forget_chat_file(chat_id, chat_file)
+        manifests.discard(chat_id)
+        return self.get_file_for_chat(chat_id)
+
+    def generate_for_chat(self, chat_id: str, chat_file: File) -> List[ChatMessage]:
+        """Generate the next assistant turn from the chat history, appending it to the chat file."""
         # Limit total tokens passed to fit in context window
         max_tokens = self.max_tokens_for_model()
-        retained_blocks = filter_blocks_for_prompt_length(max_tokens, chat_file.blocks)
-        generate_task = self.get_gpt4().generate(input_file_id=chat_file.id, input_file_block_index_list = retained_blocks,
-                                           append_output_to_file=True, output_file_id=chat_file.id)
+        window = self.get_prompt_window(chat_file)
+        retained_blocks = filter_blocks_for_prompt_length(max_tokens, chat_file.blocks, self.encoding_name, window)
+        prompt_tokens = window.token_total(retained_blocks)
+        next_index = len(chat_file.blocks)
+
+        reply_cache = self.get_reply_cache()
+        cache_key = None
+        if reply_cache is not None:
+            cache_key = prompt_key(self.model, blocks_at(chat_file, retained_blocks), self.config.reply_cache_turns)
+        if cache_key is not None:
+            cached_texts = reply_cache.get(cache_key)
+            if cached_texts is not None:
+                output_blocks = self.append_assistant_blocks(chat_file, cached_texts)
+                return self.finish_reply(chat_id, chat_file, window, output_blocks, next_index)
+
+        # Reserve the prompt plus the longest possible completion; what goes unused is returned afterwards
+        scheduler = self.get_token_scheduler()
+        reserved_tokens = prompt_tokens + self.get_gpt4().config['max_tokens']
+        if scheduler is not None:
+            with time_stage("token_queue"):
+                # Less than asked for when the reservation is larger than the whole bucket
+                reserved_tokens = scheduler.acquire(chat_id, reserved_tokens, self.config.max_queue_wait_s)
+            if reserved_tokens is None:
+                logging.info(f"Over token budget; telling chat {chat_id} we are busy")
+                return [ChatMessage(text=BUSY_REPLY, chat_id=chat_id)]
+
+        stream: Optional[StreamingMessage] = None
+
+        def on_refresh(refresh_count: int, elapsed: float, task):
+            if stream is not None:
+                stream.update(partial_output_text(task))
+            elif self.config.async_replies and refresh_count % 4 == 0:
+                # Telegram shows "typing…" for about 5 seconds; task.wait refreshes once a second
+                self.send_chat_action(chat_id)
 
         # TODO: handle moderated input error
-        generate_task.wait()
-        return [ChatMessage.from_block(block, chat_id=incoming_message.get_chat_id()) for block in generate_task.output.blocks]
+        completion = 0
+        try:
+            if self.config.streaming_replies:
+                stream = StreamingMessage(self.api_root, chat_id, sender=self.get_sender()).start()
+            with time_stage("generate"):
+                if self.config.latency_budget_ms:
+                    output_blocks = self.generate_routed(chat_file, window, retained_blocks, prompt_tokens, on_refresh)
+                else:
+                    started = time.perf_counter()
+                    generate_task = self.get_gpt4().generate(input_file_id=chat_file.id, input_file_block_index_list = retained_blocks,
+                                                       append_output_to_file=True, output_file_id=chat_file.id)
+                    generate_task.wait(on_each_refresh=on_refresh)
+                    model_latency.observe(self.model, time.perf_counter() - started, prompt_tokens)
+                    output_blocks = generate_task.output.blocks
+            if scheduler is not None:
+                completion = sum(block_token_counts(output_blocks, self.encoding_name))
+        except Exception:
+            if stream is not None:
+                stream.cancel()
+            raise
+        finally:
+            if scheduler is not None:
+                # A failed generation is charged for its prompt only
+                scheduler.release(reserved_tokens - prompt_tokens - completion)
+        if cache_key is not None and output_blocks:
+            reply_cache.put(cache_key, [block.text for block in output_blocks])
+        return self.finish_reply(chat_id, chat_file, window, output_blocks, next_index, stream)
+
+    def finish_reply(self, chat_id: str, chat_file: File, window: PromptWindow, output_blocks: List[Block],
+                     next_index: int, stream: Optional[StreamingMessage] = None) -> List[ChatMessage]:
+        """Bookkeeping for reply blocks that were just appended to the chat file; returns the messages to send."""
+        # Counting the reply now means the next message only has to tokenize its own text
+        completion_tokens.observe(sum(block_token_counts(output_blocks, self.encoding_name)))
+        # Keep the cached history current without downloading it again
+        chat_files.record_appended(chat_id, chat_file, output_blocks, next_index)
+        overflow = []
+        if stream is not None and output_blocks:
+            # The first block replaces the placeholder; anything after it, or beyond one message, is sent as usual
+            first, *overflow = split_message(output_blocks[0].text) or [""]
+            stream.finish(first)
+            output_blocks = output_blocks[1:]
+        messages = [ChatMessage(text=text, chat_id=chat_id) for text in overflow] + \
+                   [ChatMessage.from_block(block, chat_id=chat_id) for block in output_blocks]
+
+        # Both take the chat's lock, which the caller holds, and may run inline; schedule them once it is released
+        if self.config.summarize_after_tokens and window.total_tokens > self.config.summarize_after_tokens:
+            file_id, block_count = chat_file.id, len(chat_file.blocks)
+            chat_scheduler.defer(chat_id, lambda: self.schedule_compaction(chat_id, file_id, block_count))
+        if self.config.segment_max_blocks and len(chat_file.blocks) > self.config.segment_max_blocks:
+            chat_scheduler.defer(chat_id, lambda: self.schedule_segment_roll(chat_id))
+        return messages
+
+    def generate_routed(self, chat_file: File, window: PromptWindow, retained_blocks: List[int], prompt_tokens: int,
+                        on_refresh) -> List[Block]:
+        """Generate with the model expected to fit the latency budget, hedging with the faster model once the
+        budget is spent. Only the winning reply is appended to the chat file."""
+        budget_s = self.config.latency_budget_ms / 1000
+        first, hedge = choose_models(self.model, self.fallback_model, model_latency, budget_s, prompt_tokens)
+
+        def start(model: str):
+            def start_generation():
+                max_tokens = self.max_tokens_for_model(model)
+                # The prompt was sized for the configured model; re-fit it when this one has a smaller window
+                indices = retained_blocks if max_tokens >= self.max_tokens_for_model() else window.fit(chat_file.blocks, max_tokens)
+                return self.get_llm(model).generate(input_file_id=chat_file.id, input_file_block_index_list=indices,
+                                                    append_output_to_file=False)
+            return model, start_generation
+
+        def on_poll(poll_count: int, elapsed: float, tasks):
+            # Show the progress of whichever request has produced the most text so far
+            on_refresh(poll_count, elapsed, max(tasks, key=lambda task: len(partial_output_text(task))))
+
+        def on_abandoned(model: str, seconds: float):
+            # The losing request took at least this long; without it a slow model's samples would only get faster
+            model_latency.observe(model, seconds, prompt_tokens, censored=True)
+
+        model, task, seconds = race(start(first), start(hedge), hedge_after_s=budget_s, on_poll=on_poll,
+                                    on_abandoned=on_abandoned)
+        model_latency.observe(model, seconds, prompt_tokens)
+        if model != first:
+            logging.info(f"Hedged request to {model} answered first after {seconds:.1f}s")
+        return self.append_assistant_blocks(chat_file, [block.text for block in task.output.blocks])
+
+    def append_assistant_blocks(self, chat_file: File, texts: List[str]) -> List[Block]:
+        """Append reply texts that did not come from a generate call writing to the file itself."""
+        appended = []
+        for text in texts:
+            num_tokens = count_tokens(text, self.encoding_name)
+            appended.append(chat_file.append_block(text=text, tags=[
+                Tag(kind=TagKind.ROLE, name=RoleTag.ASSISTANT),
+                token_count_tag(num_tokens, self.encoding_name)
+            ]))
+            remember_token_count(appended[-1], num_tokens, self.encoding_name)
+        return appended
+
+    def get_prompt_window(self, chat_file: File) -> PromptWindow:
+        if self.config.memory_top_k <= 0:
+            return context_windows.get(chat_file.id, self.encoding_name)
+        return chat_memories.get(chat_file.id, self.encoding_name, self.config.memory_embedder,
+                                 self.config.memory_recent_turns, self.config.memory_top_k,
+                                 self.config.memory_max_turns)
+
+    def update_filters(self) -> List[UpdateFilter]:
+        """The filters incoming updates must pass, cheapest and most selective first. Override to add more."""
+        filters: List[UpdateFilter] = [ContentTypeFilter()]
+        if self.config.group_mentions_only:
+            filters.append(GroupMentionFilter(self.get_bot_username))
+        if self.config.flood_max_messages > 0:
+            filters.append(FloodFilter(self.config.flood_max_messages, self.config.flood_window_s))
+        if self.config.repeat_window_s > 0:
+            filters.append(RepeatFilter(self.config.repeat_window_s))
+        return filters
+
+    def get_update_filters(self) -> FilterPipeline:
+        instance = self.context.invocable_instance_handle if self.context else None
+        key = (instance or self.config.bot_name, self.config.group_mentions_only, self.config.flood_max_messages,
+               self.config.flood_window_s, self.config.repeat_window_s)
+        return filter_pipelines.get(key, lambda: FilterPipeline(self.update_filters()))
+
+    def get_bot_username(self) -> Optional[str]:
+        """The bot's Telegram username, fetched with getMe once per process. None while it cannot be fetched; a
+        failed getMe is tried again after BOT_USERNAME_RETRY_S seconds rather than on every group message."""
+        token = self.config.bot_token
+        if token in bot_usernames:
+            return bot_usernames[token]
+        if time.monotonic() < bot_username_retry_at.get(token, 0.0):
+            return None
+        try:
+            result = self.get_sender().call("getMe", {}, max_attempts=1)
+        except Exception as e:
+            logging.warning(f"Could not fetch the bot's username, retrying in {BOT_USERNAME_RETRY_S}s: {e}")
+            bot_username_retry_at[token] = time.monotonic() + BOT_USERNAME_RETRY_S
+            return None
+        bot_username_retry_at.pop(token, None)
+        bot_usernames[token] = result.get("username")
+        return bot_usernames[token]
+
+    def get_token_scheduler(self) -> Optional[TokenScheduler]:
+        if self.config.tokens_per_minute <= 0:
+            return None
+        return token_schedulers.get(self.model, self.config.tokens_per_minute)
+
+    def get_reply_cache(self) -> Optional[ReplyCache]:
+        if self.config.reply_cache_ttl_s <= 0:
+            return None
+        instance = self.context.invocable_instance_handle if self.context else None
+        return reply_caches.get(instance or self.config.bot_name, self.config.reply_cache_max_entries,
+                                self.config.reply_cache_ttl_s)
+
+    def schedule_compaction(self, chat_id: str, file_id: str, block_count: int):
+        """Compact the chat's File `file_id` later, unless this process already scheduled a compaction of it."""
+        if not pending_compactions.claim(chat_id):
+            return
+        try:
+            self.invoke_later("compact_chat",
+                              arguments={"chat_id": chat_id, "file_id": file_id, "block_count": block_count})
+        except Exception as e:
+            pending_compactions.release(chat_id)
+            logging.warning(f"Could not schedule compaction of chat {chat_id}: {e}")
+
+    def schedule_segment_roll(self, chat_id: str):
+        try:
+            self.invoke_later("roll_chat_segment", arguments={"chat_id": chat_id})
+        except Exception as e:
+            logging.warning(f"Could not schedule a new segment for chat {chat_id}: {e}")
+
+    @post("roll_chat_segment")
+    @timed("roll_chat_segment")
+    def roll_chat_segment(self, chat_id: str) -> InvocableResponse[str]:
+        """Continue a chat whose current segment is full in a new segment File.
+
+        The new segment starts with the system blocks and the turns the next prompt would use anyway, capped
+        at half of segment_max_blocks, so both the next reply and later rolls read a bounded number of blocks.
+        """
+        limit = self.config.segment_max_blocks
+        with chat_scheduler.lock(chat_id):
+            # Another worker may have rolled the chat since this one cached its manifest
+            manifests.discard(chat_id)
+            chat_file = self.get_file_for_chat(chat_id)
+            if not limit or len(chat_file.blocks) <= limit:
+                return InvocableResponse(string="OK")
+            window = context_windows.get(chat_file.id, self.encoding_name)
+            prompt_indices = set(filter_blocks_for_prompt_length(self.max_tokens_for_model(), chat_file.blocks,
+                                                                 self.encoding_name, window))
+            system_blocks = [block for block in chat_file.blocks if is_system_block(block)]
+            recent_blocks = [block for block in chat_file.blocks
+                             if block.index_in_file in prompt_indices and not is_system_block(block)]
+            recent_blocks = recent_blocks[-(limit // 2):] if limit >= 2 else []
+
+            manifest = self.manifest_for_chat(chat_id)
+            segment = roll_segment(self.client, manifest, system_blocks + recent_blocks, current=chat_file)
+            self.forget_chat_file(chat_id, chat_file)
+            chat_files.put(chat_id, segment)
+        logging.info(f"Chat {chat_id} continues in {segment.handle}, carrying over {len(recent_blocks)} turns")
+        return InvocableResponse(string="OK")
+
+    def manifest_for_chat(self, chat_id: str) -> ChatManifest:
+        """The chat's segment manifest; read from Steamship once per process, then kept up to date locally until
+        a closed segment shows that another worker rolled the chat."""
+        manifest = manifests.get(chat_id)
+        if manifest is None:
+            with time_stage("manifest_get"):
+                manifest = load_manifest(self.client, chat_id)
+            manifests.put(manifest)
+        return manifest
+
+    def current_segment_handle(self, chat_id: str) -> str:
+        # Chats are only ever split with segmenting or compaction on; without them, skip the manifest round trip
+        if not self.config.segment_max_blocks and not self.config.summarize_after_tokens:
+            return chat_id
+        return self.manifest_for_chat(chat_id).current_handle
+
+    def forget_chat_file(self, chat_id: str, chat_file: File):
+        """Drop what this process cached about the chat's File, e.g. because it was replaced by a new segment."""
+        chat_files.discard(chat_id)
+        context_windows.discard(chat_file.id)
+        chat_memories.discard(chat_file.id)
+
+    @post("compact_chat")
+    @timed("compact_chat")
+    def compact_chat(self, chat_id: str, file_id: Optional[str] = None,
+                     block_count: Optional[int] = None) -> InvocableResponse[str]:
+        """Fold the older turns of a long chat into a summary block and continue the chat in a new segment File
+        that starts with the summary and the newest turns. The old File is kept, but never read for replies.
+
+        `file_id` and `block_count` describe the chat File when the compaction was scheduled; if it has changed
+        since, e.g. because another compaction already ran, nothing is done and the next long reply schedules
+        a new one.
+        """
+        try:
+            return self._compact_chat(chat_id, file_id, block_count)
+        finally:
+            pending_compactions.release(chat_id)
+
+    def _compact_chat(self, chat_id: str, file_id: Optional[str], block_count: Optional[int]) -> InvocableResponse[str]:
+        threshold = self.config.summarize_after_tokens
+        # Another worker may have moved the chat to a new segment since this one cached its manifest
+        manifests.discard(chat_id)
+        segment_handle = self.current_segment_handle(chat_id)
+        chat_file = File.get(self.client, handle=segment_handle)
+        if file_id is not None and (chat_file.id != file_id or len(chat_file.blocks) != block_count):
+            logging.info(f"Skipping compaction of chat {chat_id}: its File changed since it was scheduled")
+            return InvocableResponse(string="OK")
+        window = ContextWindow(self.encoding_name).extend(chat_file.blocks)
+        if not threshold or window.total_tokens <= threshold:
+            return InvocableResponse(string="OK")
+
+        # Keep the newest turns within half the threshold; everything older is folded
+        start = window.cutoff(threshold // 2)
+        folded_indices = set(window.indices[:start])
+        if not folded_indices:
+            return InvocableResponse(string="OK")
+        previous_summaries = [block for block in chat_file.blocks if is_summary_block(block)]
+        folded = [block for block in chat_file.blocks if block.index_in_file in folded_indices]
+
+        # The summarization prompt itself has to fit in the model's window
+        budget = self.max_tokens_for_model() // 2
+        prompt_turns = []
+        for block, count in reversed(list(zip(folded, block_token_counts(folded, self.encoding_name)))):
+            if count > budget:
+                break
+            prompt_turns.insert(0, block)
+            budget -= count
+        previous_summary = "\n".join(block.text for block in previous_summaries) or None
+        summarize_task = self.get_gpt4().generate(text=summary_prompt(prompt_turns, previous_summary))
+        summarize_task.wait()
+        summary_text = "\n".join(block.text for block in summarize_task.output.blocks)
+
+        summary = summary_block(summary_text)
+        summary.tags.append(token_count_tag(count_tokens(summary.text, self.encoding_name), self.encoding_name))
+        with chat_scheduler.lock(chat_id):
+            manifests.discard(chat_id)
+            manifest = self.manifest_for_chat(chat_id)
+            latest = File.get(self.client, handle=segment_handle)
+            if manifest.current_handle != segment_handle or latest.id != chat_file.id:
+                # The chat moved on to another File meanwhile, so the folded indices no longer apply to it
+                logging.info(f"Skipping compaction of chat {chat_id}: it continued in another File meanwhile")
+                return InvocableResponse(string="OK")
+            # Messages may have arrived while we were summarizing; carry them over too
+            kept = [block for block in latest.blocks
+                    if block.index_in_file not in folded_indices and not is_summary_block(block)]
+            system_blocks = [block for block in kept if is_system_block(block)]
+            recent_blocks = [block for block in kept if not is_system_block(block)]
+            # The new File is complete before the manifest points at it, and the old one stays as it is
+            compacted = roll_segment(self.client, manifest, system_blocks + [summary] + recent_blocks, current=latest)
+            self.forget_chat_file(chat_id, chat_file)
+            chat_files.put(chat_id, compacted)
+        logging.info(f"Compacted chat {chat_id} into {compacted.handle}: folded {len(folded)} blocks, "
+                     f"kept {len(recent_blocks)}")
+        return InvocableResponse(string="OK")
+
+    @get("list_chats")
+    def list_chats(self, page_size: int = 100, page_token: Optional[str] = None) -> InvocableResponse[dict]:
+        """One page of the chats stored in this workspace. Pass `next_page_token` back to get the next page; a
+        page may hold fewer chats than `page_size`, since segment and manifest Files are skipped."""
+        files, next_page_token = ChatExporter(self.client, self.encoding_name).list_chats(page_size, page_token)
+        return InvocableResponse(json={"chats": [{"chat_id": chat_id_of(file), "file_id": file.id} for file in files],
+                                       "next_page_token": next_page_token})
+
+    @post("export_chats")
+    @timed("export_chats")
+    # `List[str] = None`, not Optional: Steamship's method spec only understands Optional around an Enum
+    def export_chats(self, chat_ids: List[str] = None, page_token: Optional[str] = None,
+                     max_blocks: int = DEFAULT_MAX_BLOCKS, include_blocks: bool = True) -> InvocableResponse[str]:
+        """One page of chat history as NDJSON: each chat's turns with their role and message_id, then its stats
+        (turns, tokens, last activity). The last line holds the token for the next page. With `include_blocks`
+        off, only the stats are returned. See `chat_export.py` for the record format."""
+        exporter = ChatExporter(self.client, self.encoding_name, include_blocks=include_blocks)
+        body = "".join(ndjson_lines(exporter.page(chat_ids, page_token, max_blocks)))
+        return InvocableResponse(string=body, mime_type=NDJSON_MIME_TYPE)
+
+    @get("metrics")
+    def get_metrics(self) -> InvocableResponse[str]:
+        """Latency histograms per stage, token counts and cache hit rates, in the Prometheus text format."""
+        return InvocableResponse(string=metrics.render())
+
+    def send_chat_action(self, chat_id: str, action: str = "typing"):
+        """Show a chat action such as "typing…" in the Telegram chat. Failures are logged, never raised."""
+        try:
+            self.get_sender().call("sendChatAction", {"chat_id": int(chat_id), "action": action}, max_attempts=1)
+        except Exception as e:
+            logging.warning(f"Could not send chat action {action} to chat {chat_id}: {e}")
+
+    def get_sender(self) -> TelegramSender:
+        return telegram_senders.get(self.api_root)
+
+    def send_messages(self, messages: List[ChatMessage]):
+        """Deliver replies in order: text through the pooled, rate-limited sender, which splits long texts and
+        retries; anything else through the stock transport."""
+        for message in messages:
+            if message.is_text() or message.text:
+                self.get_sender().send_message(int(message.get_chat_id()), message.text)
+            else:
+                self.send_media([message])
 
     def includes_message(self, file: File, message_id: str):
         """Determine if the message ID has already been processed in this file by checking Block tags."""
-        for block in file.blocks:
-            for tag in block.tags:
-                if tag.kind == "message_id" and tag.name == message_id:
-                    return True
-        return False
+        return message_id in message_ids_in_file(file)
 
     def get_file_for_chat(self, chat_id: str) -> File:
-        """ Find the File associated with this chat id, or create it """
-        file_handle = chat_id
+        """ Find the current segment File of this chat id, or create it. Served from the chat file cache when possible. """
+        file = chat_files.get(chat_id)
+        if file is not None and file.handle == self.current_segment_handle(chat_id):
+            return file
+        file = self.fetch_segment(chat_id)
+        if closing_block_index(file) is not None:
+            # Another worker rolled the chat after this process cached its manifest
+            manifests.discard(chat_id)
+            file = self.fetch_segment(chat_id)
+        chat_files.put(chat_id, file)
+        return file
+
+    def fetch_segment(self, chat_id: str) -> File:
+        file_handle = self.current_segment_handle(chat_id)
         try:
-            file = File.get(self.client, handle=file_handle)
+            with time_stage("file_get"):
+                return File.get(self.client, handle=file_handle)
         except:
-            file = self.create_new_file_for_chat(file_handle)
-        return file
+            return self.create_new_file_for_chat(file_handle)
 
     def create_new_file_for_chat(self, file_handle: str):
         """ Create a new File for this chat id, beginning with the system prompt based on name and personality."""
+        system_prompt = f"Your name is {self.config.bot_name}. Your personality is {self.config.bot_personality}."
         return File.create(self.client, handle=file_handle, blocks=[
-            Block(text=f"Your name is {self.config.bot_name}. Your personality is {self.config.bot_personality}.",
-                  tags=[Tag(kind=TagKind.ROLE, name=RoleTag.SYSTEM)])
+            Block(text=system_prompt,
+                  tags=[Tag(kind=TagKind.ROLE, name=RoleTag.SYSTEM), token_count_tag(count_tokens(system_prompt, self.encoding_name), self.encoding_name)])
         ])
 
 
-    def max_tokens_for_model(self) -> int:
-        if self.config.use_gpt4:
+    def max_tokens_for_model(self, model: Optional[str] = None) -> int:
+        model = model or self.model
+        if model == "gpt-4":
             # Use 7800 instead of 8000 as buffer for different counting
-            return 7800 - self.get_gpt4().config['max_tokens']
+            return 7800 - self.get_llm(model).config['max_tokens']
         else:
             # Use 4000 instead of 4097 as buffer for different counting
-            return 4097 - self.get_gpt4().config['max_tokens']
-
-
-
+            return 4097 - self.get_llm(model).config['max_tokens']
 
 
+def blocks_at(file: File, indices: List[int]) -> List[Block]:
+    """The blocks of `file` at the given file indices, in order."""
+    blocks = file.blocks
+    if all(i < len(blocks) and blocks[i].index_in_file == i for i in indices):
+        return [blocks[i] for i in indices]
+    wanted = set(indices)
+    return [block for block in blocks if block.index_in_file in wanted]
@@ -0,0 +1,100 @@
+"""Process-wide cache of chat Files, kept current locally instead of re-downloading after every write."""
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+from steamship import Block, File
+
+from metrics import cache_lookups
+
+# Rough per-block cost of the pydantic objects on top of the text itself.
+BLOCK_OVERHEAD_BYTES = 1024
+
+
+def block_size(block: Block) -> int:
+    return len(block.text or "") + BLOCK_OVERHEAD_BYTES
+
+
+def file_size(file: File) -> int:
+    return sum(block_size(block) for block in file.blocks)
+
+
+class ChatFileCache:
+    """LRU of chat Files bounded by their approximate in-memory size.
+
+    A cached File is trusted as long as every block appended through this process lands exactly where the
+    cached copy expects it. The index the engine reports for an appended block is the version check: any
+    other value means someone else wrote to the File, and the caller must refresh it.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._files: "OrderedDict[str, File]" = OrderedDict()
+        self._sizes = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, handle: str) -> Optional[File]:
+        with self._lock:
+            file = self._files.get(handle)
+            if file is not None:
+                self._files.move_to_end(handle)
+        cache_lookups.inc(cache="chat_file", result="miss" if file is None else "hit")
+        return file
+
+    def put(self, handle: str, file: File):
+        with self._lock:
+            self._remove(handle)
+            size = file_size(file)
+            if size > self.max_bytes:
+                return
+            self._files[handle] = file
+            self._sizes[handle] = size
+            self._total_bytes += size
+            self._evict()
+
+    def discard(self, handle: str):
+        with self._lock:
+            self._remove(handle)
+
+    def record_appended(self, handle: str, file: File, blocks: List[Block], expected_index: int) -> bool:
+        """Account for `blocks`, which were just written to `file` starting at `expected_index`.
+
+        Blocks not already present on the local `file` are appended to it. Returns False when the indices
+        reported by the engine show the File changed underneath us; the cached copy is dropped in that case.
+        """
+        for offset, block in enumerate(blocks):
+            if block.index_in_file != expected_index + offset:
+                logging.info(
+                    f"Chat file {handle} changed remotely (expected block {expected_index + offset}, got {block.index_in_file})"
+                )
+                self.discard(handle)
+                return False
+
+        known = {block.id for block in file.blocks[expected_index:]}
+        for block in blocks:
+            if block.id not in known:
+                block.client = file.client
+                file.blocks.append(block)
+
+        with self._lock:
+            if self._files.get(handle) is file:
+                added = sum(block_size(block) for block in blocks)
+                self._sizes[handle] += added
+                self._total_bytes += added
+                self._evict()
+        return True
+
+    def _remove(self, handle: str):
+        if handle in self._files:
+            del self._files[handle]
+            self._total_bytes -= self._sizes.pop(handle)
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._files:
+            handle, _ = self._files.popitem(last=False)
+            self._total_bytes -= self._sizes.pop(handle)
+
+
+chat_files = ChatFileCache()
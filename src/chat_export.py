@@ -0,0 +1,190 @@
+"""Chat history export as NDJSON, one chat File at a time, with per-chat stats computed on the way.
+
+An export is paged: each page covers whole chats until about `max_blocks` blocks have been written, and ends with
+a `page` record holding the token for the next page. Only one segment File is held in memory at a time, so memory
+stays bounded by the segment size however long the chats are, and every page is short enough to finish within one
+invocation.
+
+Records, one JSON object per line:
+
+- `{"type": "block", "chat_id", "file", "index", "role", "message_id", "sent_at", "tokens", "summary", "text"}` for
+  each turn, segment by segment in order
+- `{"type": "chat", "chat_id", "turns", "user_turns", "assistant_turns", "tokens", "blocks", "files",
+  "last_activity"}` after a chat's blocks; `last_activity` is the latest `sent_at`, or null for chats whose
+  messages predate it
+- `{"type": "page", "chats", "next_page_token"}` last; `next_page_token` is null on the final page
+"""
+import base64
+import json
+import re
+import time
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from steamship import Block, File, Steamship, SteamshipError, Tag
+from steamship.data.tags.tag_constants import RoleTag
+
+from chat_segments import CARRIED_OVER_TAG_KIND, SEGMENT_OF_TAG_KIND, closing_block_index, load_manifest
+from compaction import block_role_name, is_summary_block
+from message_index import MESSAGE_ID_TAG_KIND
+from tokenizer import count_tokens, tagged_token_count
+
+NDJSON_MIME_TYPE = "application/x-ndjson"
+LIST_PAGE_SIZE = 100
+DEFAULT_MAX_BLOCKS = 5_000
+SENT_AT_KEY = "sent_at"
+
+# Handles of the Files that belong to a chat without being its first segment
+_AUXILIARY_HANDLE = re.compile(r"-(manifest|epoch-\d+)$")
+
+
+def message_id_tag(message_id: str, sent_at: Optional[float] = None) -> Tag:
+    """The message_id tag of a user turn, recording when it arrived for `last_activity`."""
+    return Tag(kind=MESSAGE_ID_TAG_KIND, name=message_id, value={SENT_AT_KEY: round(sent_at or time.time(), 3)})
+
+
+def chat_id_of(file: File) -> Optional[str]:
+    """The chat id if `file` is a chat's first segment (its handle is the chat id), else None."""
+    if not file.handle or _AUXILIARY_HANDLE.search(file.handle):
+        return None
+    if any(tag.kind == SEGMENT_OF_TAG_KIND for tag in file.tags or []):
+        return None
+    return file.handle
+
+
+def encode_page_token(state: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+
+def decode_page_token(token: Optional[str]) -> dict:
+    if not token:
+        return {}
+    try:
+        return json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    except ValueError as e:
+        raise SteamshipError(message=f"Invalid page token: {e}")
+
+
+class ChatStats:
+    """Aggregates for one chat, updated block by block."""
+
+    def __init__(self, chat_id: str):
+        self.chat_id = chat_id
+        self.user_turns = 0
+        self.assistant_turns = 0
+        self.tokens = 0
+        self.blocks = 0
+        self.files = 0
+        self.last_activity: Optional[float] = None
+
+    def add(self, role: Optional[str], tokens: int, sent_at: Optional[float]):
+        self.blocks += 1
+        self.tokens += tokens
+        if role == RoleTag.USER:
+            self.user_turns += 1
+        elif role == RoleTag.ASSISTANT:
+            self.assistant_turns += 1
+        if sent_at is not None and (self.last_activity is None or sent_at > self.last_activity):
+            self.last_activity = sent_at
+
+    def record(self) -> dict:
+        return {"type": "chat", "chat_id": self.chat_id, "turns": self.user_turns + self.assistant_turns,
+                "user_turns": self.user_turns, "assistant_turns": self.assistant_turns, "tokens": self.tokens,
+                "blocks": self.blocks, "files": self.files, "last_activity": self.last_activity}
+
+
+def _message_tag(block: Block) -> Tuple[Optional[str], Optional[float]]:
+    for tag in block.tags or []:
+        if tag.kind == MESSAGE_ID_TAG_KIND:
+            return tag.name, (tag.value or {}).get(SENT_AT_KEY)
+    return None, None
+
+
+def _is_carried_over(block: Block) -> bool:
+    return any(tag.kind == CARRIED_OVER_TAG_KIND for tag in block.tags or [])
+
+
+class ChatExporter:
+    """Streams chats as NDJSON records. `encoding_name` is used to count blocks without a token_count tag."""
+
+    def __init__(self, client: Steamship, encoding_name: str, include_blocks: bool = True):
+        self.client = client
+        self.encoding_name = encoding_name
+        self.include_blocks = include_blocks
+
+    def list_chats(self, page_size: int = LIST_PAGE_SIZE, page_token: Optional[str] = None) -> Tuple[List[File], Optional[str]]:
+        """One page of the workspace's Files, reduced to the chats' first segments."""
+        response = File.list(self.client, page_size=page_size, page_token=page_token)
+        return [file for file in response.files if chat_id_of(file)], response.next_page_token
+
+    def chat_files(self, chat_id: str) -> Iterator[File]:
+        """Every segment File of the chat, oldest first, fetched one at a time."""
+        # Read afresh: a manifest cached by the reply path misses segments rolled by other workers
+        for handle in load_manifest(self.client, chat_id).segment_handles():
+            try:
+                yield File.get(self.client, handle=handle)
+            except SteamshipError:
+                # A segment that was never written to, e.g. the chat was created and then failed
+                continue
+
+    def chat_records(self, chat_id: str) -> Iterator[dict]:
+        stats = ChatStats(chat_id)
+        for file in self.chat_files(chat_id):
+            stats.files += 1
+            # Blocks after a segment's close marker were appended late and moved on to the next segment
+            end = closing_block_index(file)
+            for block in file.blocks[:end]:
+                if _is_carried_over(block):
+                    continue
+                role = block_role_name(block)
+                message_id, sent_at = _message_tag(block)
+                tokens = tagged_token_count(block, self.encoding_name)
+                if tokens is None:
+                    tokens = count_tokens(block.text, self.encoding_name)
+                stats.add(role, tokens, sent_at)
+                if self.include_blocks:
+                    yield {"type": "block", "chat_id": chat_id, "file": file.handle, "index": block.index_in_file,
+                           "role": role, "message_id": message_id, "sent_at": sent_at, "tokens": tokens,
+                           "summary": is_summary_block(block), "text": block.text}
+        yield stats.record()
+
+    def page(self, chat_ids: Optional[List[str]] = None, page_token: Optional[str] = None,
+             max_blocks: int = DEFAULT_MAX_BLOCKS) -> Iterator[dict]:
+        """The records of one export page, ending with its `page` record.
+
+        With `chat_ids`, those chats are exported in order; otherwise every chat in the workspace is. A page
+        always holds at least one whole chat, so a chat longer than `max_blocks` still makes progress.
+        """
+        state = decode_page_token(page_token)
+        skip = state.get("skip", 0)
+        exported, written = 0, 0
+        for list_token, batch in self._batches(chat_ids, state.get("list")):
+            for position in range(skip, len(batch)):
+                if written >= max_blocks:
+                    yield {"type": "page", "chats": exported,
+                           "next_page_token": encode_page_token({"list": list_token, "skip": position})}
+                    return
+                for record in self.chat_records(batch[position]):
+                    if record["type"] == "chat":
+                        # Blocks read, whether or not they were written out
+                        written += record["blocks"]
+                    yield record
+                exported += 1
+            skip = 0
+        yield {"type": "page", "chats": exported, "next_page_token": None}
+
+    def _batches(self, chat_ids: Optional[List[str]], list_token: Optional[str]) -> Iterator[Tuple[Optional[str], List[str]]]:
+        """`(list page token, chat ids)` batches, resuming at the File list page `list_token`."""
+        if chat_ids is not None:
+            yield None, list(chat_ids)
+            return
+        while True:
+            files, next_list_token = self.list_chats(page_token=list_token)
+            yield list_token, [chat_id_of(file) for file in files]
+            if not next_list_token:
+                return
+            list_token = next_list_token
+
+
+def ndjson_lines(records: Iterable[dict]) -> Iterator[str]:
+    for record in records:
+        yield json.dumps(record, separators=(",", ":"), ensure_ascii=False) + "\n"
@@ -0,0 +1,126 @@
+"""Per-chat serialization and debouncing, so a burst of short messages gets a single reply."""
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List
+
+from steamship import File
+from steamship.data.tags.tag_constants import RoleTag
+
+from compaction import block_role_name
+from message_index import MESSAGE_ID_TAG_KIND
+
+
+class ChatLock:
+    """A chat's lock. Work passed to `defer` while it is held runs once it is released, outside of it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._deferred: List[Callable[[], None]] = []
+
+    def __enter__(self) -> "ChatLock":
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        deferred, self._deferred = self._deferred, []
+        self._lock.release()
+        for fn in deferred:
+            fn()
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    def defer(self, fn: Callable[[], None]):
+        self._deferred.append(fn)
+
+
+class _ChatState:
+    __slots__ = ("lock", "ticket")
+
+    def __init__(self):
+        self.lock = ChatLock()
+        self.ticket = 0
+
+
+class ChatScheduler:
+    """Hands out one lock and one message counter per chat.
+
+    Everything that writes to a chat File (appending a user message, generating, compacting) runs under the
+    chat's lock, so appends never interleave with a generation. Each appended user message takes a ticket;
+    after the debounce window only the holder of the newest ticket generates, and its prompt already
+    contains every message of the burst. Follow-up work that takes the lock itself, such as scheduling a
+    compaction that may run inline, is deferred until the lock is released.
+    """
+
+    def __init__(self, max_chats: int = 10_000, clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.max_chats = max_chats
+        self.clock = clock
+        self.sleep = sleep
+        self._chats: "OrderedDict[str, _ChatState]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _state(self, chat_id: str) -> _ChatState:
+        with self._lock:
+            state = self._chats.get(chat_id)
+            if state is None:
+                state = self._chats[chat_id] = _ChatState()
+                self._evict()
+            else:
+                self._chats.move_to_end(chat_id)
+            return state
+
+    def lock(self, chat_id: str) -> ChatLock:
+        return self._state(chat_id).lock
+
+    def defer(self, chat_id: str, fn: Callable[[], None]):
+        """Run `fn` right after the chat's lock is released; call while holding it."""
+        self._state(chat_id).lock.defer(fn)
+
+    def take_ticket(self, chat_id: str) -> int:
+        """Record that a new user message arrived in the chat; call while holding the chat's lock."""
+        state = self._state(chat_id)
+        with self._lock:
+            state.ticket += 1
+            return state.ticket
+
+    def is_latest(self, chat_id: str, ticket: int) -> bool:
+        with self._lock:
+            state = self._chats.get(chat_id)
+            return state is not None and state.ticket == ticket
+
+    def wait_for_quiet(self, chat_id: str, ticket: int, debounce_s: float) -> bool:
+        """Sleep out the debounce window. False if a newer message arrived meanwhile; its turn will reply."""
+        deadline = self.clock() + debounce_s
+        while True:
+            if not self.is_latest(chat_id, ticket):
+                return False
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                return True
+            self.sleep(min(remaining, 0.05))
+
+    def _evict(self):
+        # A chat whose lock is held stays, otherwise a second lock for it could be handed out
+        for chat_id in [chat_id for chat_id, state in self._chats.items() if not state.lock.locked()]:
+            if len(self._chats) <= self.max_chats:
+                break
+            del self._chats[chat_id]
+
+
+def is_awaiting_reply(file: File, message_id: str) -> bool:
+    """True if `message_id` is the newest user message in the File and nothing has answered it yet.
+
+    This is the cross-process form of the ticket check, used by background replies that may run anywhere.
+    """
+    for block in reversed(file.blocks):
+        role = block_role_name(block)
+        if role == RoleTag.ASSISTANT:
+            return False
+        if role == RoleTag.USER:
+            return any(tag.kind == MESSAGE_ID_TAG_KIND and tag.name == str(message_id) for tag in block.tags)
+    return False
+
+
+chat_scheduler = ChatScheduler()
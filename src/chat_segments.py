@@ -0,0 +1,149 @@
+"""Chat history split into rolling segment Files, listed in a small per-chat manifest File.
+
+Segment 0 is the File whose handle is the chat id, so chats created before segmenting need no migration.
+Each later segment starts with copies of the system blocks and the recent turns the prompt window still
+uses, so a reply only ever needs the newest segment.
+
+A roll ends the old segment with a close marker block. A worker whose cached copy of the old segment predates
+the roll finds out on its next append: the engine reports an index past the marker, the cached File is
+refreshed, and the marker says where the chat continues.
+"""
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+from steamship import Block, File, Steamship, SteamshipError, Tag
+
+from compaction import copy_block
+
+SEGMENT_TAG_KIND = "chat_segment"
+SEGMENT_OF_TAG_KIND = "segment_of"
+# Marks the copies a segment starts with, so an export of the whole chat lists each turn once
+CARRIED_OVER_TAG_KIND = "carried_over"
+# Marks the block that closes a segment; its name is the handle of the next segment
+SEGMENT_CLOSED_TAG_KIND = "segment_closed"
+
+
+def manifest_handle(chat_id: str) -> str:
+    return f"{chat_id}-manifest"
+
+
+def segment_handle(chat_id: str, epoch: int) -> str:
+    return chat_id if epoch == 0 else f"{chat_id}-epoch-{epoch}"
+
+
+class ChatManifest:
+    """The epochs of a chat's segments, oldest first. `file_id` is None until the manifest File exists."""
+
+    def __init__(self, chat_id: str, epochs: Optional[List[int]] = None, file_id: Optional[str] = None):
+        self.chat_id = chat_id
+        self.epochs = sorted(set(epochs or [0]))
+        self.file_id = file_id
+
+    @property
+    def current_epoch(self) -> int:
+        return self.epochs[-1]
+
+    @property
+    def current_handle(self) -> str:
+        return segment_handle(self.chat_id, self.current_epoch)
+
+    def segment_handles(self) -> List[str]:
+        """Handles of all segments, oldest first, e.g. for exports."""
+        return [segment_handle(self.chat_id, epoch) for epoch in self.epochs]
+
+
+def segment_tag(chat_id: str, epoch: int) -> Tag:
+    return Tag(kind=SEGMENT_TAG_KIND, name=str(epoch), value={"epoch": epoch, "handle": segment_handle(chat_id, epoch)})
+
+
+def load_manifest(client: Steamship, chat_id: str) -> ChatManifest:
+    """Read the chat's manifest; a chat without one has only segment 0."""
+    try:
+        file = File.get(client, handle=manifest_handle(chat_id))
+    except SteamshipError:
+        return ChatManifest(chat_id)
+    epochs = [int(tag.value["epoch"]) for tag in file.tags or [] if tag.kind == SEGMENT_TAG_KIND and tag.value]
+    return ChatManifest(chat_id, epochs, file.id)
+
+
+def closing_block_index(file: File) -> Optional[int]:
+    """Position of the close marker in `file`, or None if the chat still continues in it."""
+    for position in range(len(file.blocks) - 1, -1, -1):
+        if any(tag.kind == SEGMENT_CLOSED_TAG_KIND for tag in file.blocks[position].tags or []):
+            return position
+    return None
+
+
+def carried_over(block: Block, from_handle: str) -> Block:
+    copy = copy_block(block)
+    if not any(tag.kind == CARRIED_OVER_TAG_KIND for tag in copy.tags):
+        copy.tags.append(Tag(kind=CARRIED_OVER_TAG_KIND, name=from_handle))
+    return copy
+
+
+def roll_segment(client: Steamship, manifest: ChatManifest, blocks: List[Block],
+                 current: Optional[File] = None) -> File:
+    """Start the chat's next segment with copies of `blocks`, record it in the manifest, then close `current`,
+    the segment the chat continued in so far, if given.
+
+    Blocks read from a File are marked as carried over; new ones, such as a summary, are written as they are.
+    """
+    chat_id = manifest.chat_id
+    epoch = manifest.current_epoch + 1
+    segment = File.create(
+        client,
+        handle=segment_handle(chat_id, epoch),
+        blocks=[carried_over(block, manifest.current_handle) if block.id else copy_block(block) for block in blocks],
+        tags=[Tag(kind=SEGMENT_OF_TAG_KIND, name=chat_id, value={"epoch": epoch})],
+    )
+    if manifest.file_id is None:
+        manifest_file = File.create(
+            client,
+            handle=manifest_handle(chat_id),
+            blocks=[],
+            tags=[segment_tag(chat_id, e) for e in manifest.epochs + [epoch]],
+        )
+        manifest.file_id = manifest_file.id
+    else:
+        tag = segment_tag(chat_id, epoch)
+        Tag.create(client, file_id=manifest.file_id, kind=tag.kind, name=tag.name, value=tag.value)
+    manifest.epochs.append(epoch)
+    if current is not None:
+        Block.create(client, file_id=current.id, text=f"Continued in {segment.handle}",
+                     tags=[Tag(kind=SEGMENT_CLOSED_TAG_KIND, name=segment.handle)])
+    return segment
+
+
+class ManifestCache:
+    """Process-wide LRU of chat manifests.
+
+    Another worker may roll a segment after a manifest was cached here; whoever finds the old segment closed
+    discards the chat's entry so the manifest is read again.
+    """
+
+    def __init__(self, max_chats: int = 10_000):
+        self.max_chats = max_chats
+        self._manifests: "OrderedDict[str, ChatManifest]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chat_id: str) -> Optional[ChatManifest]:
+        with self._lock:
+            manifest = self._manifests.get(chat_id)
+            if manifest is not None:
+                self._manifests.move_to_end(chat_id)
+            return manifest
+
+    def put(self, manifest: ChatManifest):
+        with self._lock:
+            self._manifests[manifest.chat_id] = manifest
+            self._manifests.move_to_end(manifest.chat_id)
+            while len(self._manifests) > self.max_chats:
+                self._manifests.popitem(last=False)
+
+    def discard(self, chat_id: str):
+        with self._lock:
+            self._manifests.pop(chat_id, None)
+
+
+manifests = ManifestCache()
@@ -0,0 +1,94 @@
+"""Warm Steamship clients and plugin instances, shared by every invocation handled by this process.
+
+Building a client opens a new HTTP session, and `use_plugin` is a round trip to the engine. Both are done once
+per workspace, plugin and config and then reused until unused for `ttl_s` seconds.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from steamship import PluginInstance, Steamship
+from steamship.base import Configuration
+
+DEFAULT_TTL_S = 30 * 60
+DEFAULT_MAX_ENTRIES = 256
+
+
+def client_key(config: Configuration) -> Hashable:
+    return config.api_base, config.api_key, config.workspace_id, config.workspace_handle
+
+
+class _Entry:
+    __slots__ = ("value", "used_at", "lock")
+
+    def __init__(self, now: float):
+        self.value = None
+        self.used_at = now
+        self.lock = threading.Lock()
+
+
+class ClientRegistry:
+    """Thread-safe TTL cache of clients and plugin instances.
+
+    Concurrent misses on one key make a single round trip; the other callers wait for its result. Misses on
+    different keys do not wait for each other. A failed build is not cached, so the next caller tries again.
+    """
+
+    def __init__(self, ttl_s: float = DEFAULT_TTL_S, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 clock: Callable[[], float] = time.monotonic):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def client(self, config: Configuration) -> Steamship:
+        """A client for `config`'s workspace that trusts the config, as the lambda handler builds it."""
+        return self.get(("client", client_key(config)),
+                        lambda: Steamship(config=config, trust_workspace_config=True))
+
+    def plugin_instance(self, client: Steamship, plugin_handle: str, config: Optional[Dict[str, Any]] = None,
+                        **kwargs) -> PluginInstance:
+        """`client.use_plugin(plugin_handle, config=config, **kwargs)`, made once per workspace.
+
+        The instance is returned bound to `client`, so its calls go through the caller's session.
+        """
+        key = ("plugin", client_key(client.config), plugin_handle, json.dumps(config, sort_keys=True),
+               json.dumps(kwargs, sort_keys=True))
+        instance = self.get(key, lambda: client.use_plugin(plugin_handle, config=config, **kwargs))
+        return instance if instance.client is client else instance.copy(update={"client": client})
+
+    def get(self, key: Hashable, build: Callable[[], Any]) -> Any:
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now - entry.used_at > self.ttl_s:
+                entry = self._entries[key] = _Entry(now)
+                self._evict(now)
+            else:
+                entry.used_at = now
+            self._entries.move_to_end(key)
+        if entry.value is None:
+            with entry.lock:
+                if entry.value is None:
+                    entry.value = build()
+        return entry.value
+
+    def discard(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def _evict(self, now: float):
+        for key in [key for key, entry in self._entries.items() if now - entry.used_at > self.ttl_s]:
+            del self._entries[key]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+steamship_clients = ClientRegistry()
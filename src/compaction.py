@@ -0,0 +1,82 @@
+"""Folding old chat turns into a rolling summary so chat Files stay bounded."""
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from steamship import Block, Tag
+from steamship.data.tags.tag_constants import RoleTag, TagKind
+
+SUMMARY_TAG_KIND = "summary"
+
+SUMMARY_INSTRUCTIONS = (
+    "Summarize the conversation below between a user and an assistant so that the assistant can continue it "
+    "later. Keep names, facts the user shared about themselves, preferences, promises and open questions. "
+    "Write at most a few short paragraphs."
+)
+
+
+def is_summary_block(block: Block) -> bool:
+    return any(tag.kind == SUMMARY_TAG_KIND for tag in block.tags or [])
+
+
+def block_role_name(block: Block) -> Optional[str]:
+    for tag in block.tags or []:
+        if tag.kind == TagKind.ROLE:
+            return tag.name
+    return None
+
+
+def summary_prompt(turns: List[Block], previous_summary: Optional[str] = None) -> str:
+    """Prompt asking the model to fold `turns` (and any earlier summary) into a single summary."""
+    lines = [SUMMARY_INSTRUCTIONS, ""]
+    if previous_summary:
+        lines += ["Summary of the conversation before this point:", previous_summary, ""]
+    lines.append("Conversation:")
+    for block in turns:
+        lines.append(f"{block_role_name(block) or 'unknown'}: {block.text}")
+    return "\n".join(lines)
+
+
+def summary_block(text: str, tags: Optional[List[Tag]] = None) -> Block:
+    """A system block carrying the conversation summary, so it is always part of the prompt."""
+    return Block(
+        text=f"Summary of the earlier conversation: {text}",
+        tags=[Tag(kind=TagKind.ROLE, name=RoleTag.SYSTEM), Tag(kind=SUMMARY_TAG_KIND, name="rolling"), *(tags or [])],
+    )
+
+
+def copy_block(block: Block) -> Block:
+    return Block(
+        text=block.text,
+        tags=[Tag(kind=tag.kind, name=tag.name, value=tag.value) for tag in block.tags or []],
+    )
+
+
+class PendingCompactions:
+    """Chats with a compaction scheduled by this process, so a run of long replies schedules it only once.
+
+    An entry expires after `ttl_s` in case the compaction ran, or failed, on another worker.
+    """
+
+    def __init__(self, ttl_s: float = 600, clock: Callable[[], float] = time.monotonic):
+        self.ttl_s = ttl_s
+        self.clock = clock
+        self._scheduled_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def claim(self, chat_id: str) -> bool:
+        """True if no compaction of the chat is pending yet; it is pending from now on."""
+        with self._lock:
+            now = self.clock()
+            scheduled_at = self._scheduled_at.get(chat_id)
+            if scheduled_at is not None and now - scheduled_at < self.ttl_s:
+                return False
+            self._scheduled_at[chat_id] = now
+            return True
+
+    def release(self, chat_id: str):
+        with self._lock:
+            self._scheduled_at.pop(chat_id, None)
+
+
+pending_compactions = PendingCompactions()
@@ -0,0 +1,141 @@
+"""Incremental context-window selection over a chat's blocks using prefix sums of token counts."""
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import List, Optional
+
+from steamship import Block, SteamshipError
+from steamship.data.tags.tag_constants import RoleTag, TagKind
+
+from metrics import cache_lookups
+from tokenizer import DEFAULT_ENCODING, block_token_counts
+
+
+def is_system_block(block: Block) -> bool:
+    for tag in block.tags or []:
+        if tag.kind == TagKind.ROLE:
+            return tag.name == RoleTag.SYSTEM
+    return False
+
+
+class ContextWindow:
+    """Token bookkeeping for one chat.
+
+    System blocks are always retained. Non-system blocks are kept as a prefix-sum array of their token
+    counts, so the newest run of blocks that fits a budget is found by binary search, and appending a
+    message only costs work proportional to the new blocks. The cutoff from the previous selection is
+    reused as a starting point since, for a fixed budget, it only ever moves forward.
+    """
+
+    def __init__(self, encoding_name: str = DEFAULT_ENCODING):
+        self.encoding_name = encoding_name
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __len__(self) -> int:
+        return self._num_blocks
+
+    def reset(self):
+        self.system_indices: List[int] = []
+        self.system_tokens = 0
+        self.indices: List[int] = []
+        self.prefix: List[int] = [0]
+        self._last_block_id: Optional[str] = None
+        self._num_blocks = 0
+        self._last_budget: Optional[int] = None
+        self._last_start = 0
+
+    def fit(self, blocks: List[Block], max_tokens: int) -> List[int]:
+        """Extend with `blocks` and select for `max_tokens` as one atomic step."""
+        with self._lock:
+            return self.extend(blocks).select(max_tokens)
+
+    def extend(self, blocks: List[Block]) -> "ContextWindow":
+        """Bring the window up to date with `blocks`, the full and ordered list of the chat's blocks."""
+        seen = self._num_blocks
+        if len(blocks) < seen or (seen and blocks[seen - 1].id != self._last_block_id):
+            # The history was rewritten underneath us; start over.
+            self.reset()
+            seen = 0
+
+        new_blocks = blocks[seen:]
+        if not new_blocks:
+            return self
+
+        for block, count in zip(new_blocks, block_token_counts(new_blocks, self.encoding_name)):
+            if is_system_block(block):
+                self.system_indices.append(block.index_in_file)
+                self.system_tokens += count
+            else:
+                self.indices.append(block.index_in_file)
+                self.prefix.append(self.prefix[-1] + count)
+
+        self._num_blocks = len(blocks)
+        self._last_block_id = blocks[-1].id
+        return self
+
+    def select(self, max_tokens: int) -> List[int]:
+        """Block indices (in file order) of the system blocks plus the newest blocks that fit in `max_tokens`."""
+        if self.system_tokens > max_tokens:
+            raise SteamshipError(
+                f"Plugin attempted to filter input to fit into {max_tokens} tokens, but the total size of system blocks was {self.system_tokens}"
+            )
+
+        start = self.cutoff(max_tokens)
+        if start >= len(self.indices):
+            raise SteamshipError(
+                f"Plugin attempted to filter input to fit into {max_tokens} tokens, but no non-System blocks remained."
+            )
+
+        self._last_budget = max_tokens
+        self._last_start = start
+        return sorted(self.system_indices + self.indices[start:])
+
+    def cutoff(self, max_tokens: int) -> int:
+        """Position in `indices` of the oldest non-system block kept under `max_tokens` (len(indices) if none)."""
+        # Keep indices[start:] where prefix[-1] - prefix[start] + system_tokens < max_tokens.
+        threshold = self.prefix[-1] + self.system_tokens - max_tokens
+        if max_tokens == self._last_budget and self._last_start < len(self.prefix):
+            start = self._last_start
+            while start < len(self.prefix) and self.prefix[start] <= threshold:
+                start += 1
+            return start
+        return bisect_right(self.prefix, threshold)
+
+    @property
+    def total_tokens(self) -> int:
+        return self.system_tokens + self.prefix[-1]
+
+    def token_total(self, block_indices: List[int]) -> int:
+        """Total tokens of a selection returned by `select`."""
+        num_recent = len(block_indices) - len(self.system_indices)
+        return self.system_tokens + self.prefix[-1] - self.prefix[len(self.prefix) - 1 - num_recent]
+
+
+class ContextWindowRegistry:
+    """Process-wide LRU of ContextWindows, one per chat file and encoding."""
+
+    def __init__(self, max_chats: int = 1000):
+        self.max_chats = max_chats
+        self._windows: "OrderedDict[tuple, ContextWindow]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, file_id: str, encoding_name: str = DEFAULT_ENCODING) -> ContextWindow:
+        key = (file_id, encoding_name)
+        with self._lock:
+            window = self._windows.get(key)
+            cache_lookups.inc(cache="context_window", result="miss" if window is None else "hit")
+            if window is None:
+                window = self._windows[key] = ContextWindow(encoding_name)
+            self._windows.move_to_end(key)
+            while len(self._windows) > self.max_chats:
+                self._windows.popitem(last=False)
+            return window
+
+    def discard(self, file_id: str):
+        with self._lock:
+            for key in [key for key in self._windows if key[0] == file_id]:
+                del self._windows[key]
+
+
+context_windows = ContextWindowRegistry()
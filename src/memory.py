@@ -0,0 +1,253 @@
+"""Relevance-based prompt selection: the system blocks, a short recent tail, and the older turns most similar to
+the latest message, found in a per-chat NumPy index of turn embeddings."""
+import hashlib
+import re
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+from steamship import Block, SteamshipError
+
+from context_window import is_system_block
+from metrics import cache_lookups
+from tokenizer import DEFAULT_ENCODING, block_token_counts
+
+_WORD = re.compile(r"[^\W_]+")
+
+STOP_WORDS = frozenset(
+    "a an and are as at be but by can do does did for from had has have he her him his how i if in is it its "
+    "just me my no not of on or our she so that the their them then there they this to too us was we were what "
+    "when where which who why will with would you your".split()
+)
+
+
+# The most turns a chat's index keeps vectors for; about 4 MiB with the 256-dimensional hashing embedder
+DEFAULT_MAX_TURNS = 4096
+
+
+class Embedder(ABC):
+    """Turns texts into L2-normalized float32 vectors of length `dim`."""
+
+    dim: int
+
+    @abstractmethod
+    def embed(self, texts: List[str]) -> np.ndarray:
+        ...
+
+
+class HashingEmbedder(Embedder):
+    """Signed feature hashing of words and word prefixes, weighted by log term frequency.
+
+    Needs no model and no network, so it works offline and in tests; it matches shared words, not meaning.
+    """
+
+    def __init__(self, dim: int = 256, prefix_length: int = 5):
+        self.dim = dim
+        self.prefix_length = prefix_length
+
+    def features(self, text: str) -> List[str]:
+        words = [word for word in _WORD.findall((text or "").lower()) if word not in STOP_WORDS]
+        # The prefix feature lets "dogs" and "dog's" share weight with "dog"
+        return words + [f"{word[:self.prefix_length]}~" for word in words if len(word) > 3]
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts: Dict[int, float] = {}
+            for feature in self.features(text):
+                h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+                bucket = (h >> 1) % self.dim
+                counts[bucket] = counts.get(bucket, 0.0) + (1.0 if h & 1 else -1.0)
+            for bucket, count in counts.items():
+                vectors[row, bucket] = np.sign(count) * np.log1p(abs(count))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+EMBEDDERS = {"hashing": HashingEmbedder}
+
+
+def get_embedder(name: str) -> Embedder:
+    if name not in EMBEDDERS:
+        raise SteamshipError(f"Unknown memory embedder {name}; expected one of {sorted(EMBEDDERS)}")
+    return EMBEDDERS[name]()
+
+
+class ChatMemory:
+    """Embeddings and token counts of one chat's non-system turns, kept current as the chat grows.
+
+    Has the same `fit` / `token_total` / `total_tokens` interface as ContextWindow, so it can stand in for one
+    when building prompts. Vectors live in one float32 matrix that doubles as it fills, so scoring every older
+    turn is a single matrix-vector product; only turns appended since the last call are embedded.
+
+    Only the newest `max_turns` turns are indexed. Once a chat grows past that, the oldest quarter is dropped
+    at once; dropped turns still count towards `total_tokens` but can no longer be recalled.
+    """
+
+    def __init__(self, embedder: Embedder, encoding_name: str = DEFAULT_ENCODING, recent_turns: int = 6,
+                 top_k: int = 4, min_similarity: float = 0.1, max_turns: int = DEFAULT_MAX_TURNS):
+        self.embedder = embedder
+        self.encoding_name = encoding_name
+        self.recent_turns = recent_turns
+        self.top_k = top_k
+        self.min_similarity = min_similarity
+        self.max_turns = max_turns
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __len__(self) -> int:
+        return self._num_blocks
+
+    def reset(self):
+        self.system_indices: List[int] = []
+        self.system_tokens = 0
+        self.indices: List[int] = []
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.vectors = np.zeros((0, self.embedder.dim), dtype=np.float32)
+        self._positions: Dict[int, int] = {}
+        self._size = 0
+        self._total = 0
+        self._num_blocks = 0
+        self._last_block_id: Optional[str] = None
+
+    def fit(self, blocks: List[Block], max_tokens: int) -> List[int]:
+        """Extend with `blocks` and select for `max_tokens` as one atomic step."""
+        with self._lock:
+            return self.extend(blocks).select(max_tokens)
+
+    def extend(self, blocks: List[Block]) -> "ChatMemory":
+        """Bring the index up to date with `blocks`, the full and ordered list of the chat's blocks."""
+        seen = self._num_blocks
+        if len(blocks) < seen or (seen and blocks[seen - 1].id != self._last_block_id):
+            # The history was rewritten underneath us; start over.
+            self.reset()
+            seen = 0
+
+        new_blocks = blocks[seen:]
+        if not new_blocks:
+            return self
+
+        turns, turn_counts = [], []
+        for block, count in zip(new_blocks, block_token_counts(new_blocks, self.encoding_name)):
+            if is_system_block(block):
+                self.system_indices.append(block.index_in_file)
+                self.system_tokens += count
+            else:
+                turns.append(block)
+                turn_counts.append(count)
+        if turns:
+            self._append(turns, turn_counts)
+
+        self._num_blocks = len(blocks)
+        self._last_block_id = blocks[-1].id
+        return self
+
+    def _append(self, turns: List[Block], turn_counts: List[int]):
+        if len(turns) > self.max_turns:
+            # Turns older than the index would keep are counted, but never embedded
+            skipped = len(turns) - self.max_turns
+            self._total += sum(turn_counts[:skipped])
+            turns, turn_counts = turns[skipped:], turn_counts[skipped:]
+        if self._size + len(turns) > self.max_turns:
+            self._forget_oldest(max(0, self.max_turns - self.max_turns // 4 - len(turns)))
+        needed = self._size + len(turns)
+        if needed > len(self.vectors):
+            capacity = min(max(needed, 2 * len(self.vectors), 64), self.max_turns)
+            vectors = np.zeros((capacity, self.embedder.dim), dtype=np.float32)
+            vectors[:self._size] = self.vectors[:self._size]
+            counts = np.zeros(capacity, dtype=np.int64)
+            counts[:self._size] = self.counts[:self._size]
+            self.vectors, self.counts = vectors, counts
+        self.vectors[self._size:needed] = self.embedder.embed([block.text for block in turns])
+        self.counts[self._size:needed] = turn_counts
+        for offset, block in enumerate(turns):
+            self._positions[block.index_in_file] = self._size + offset
+            self.indices.append(block.index_in_file)
+        self._size = needed
+        self._total += sum(turn_counts)
+
+    def _forget_oldest(self, keep: int):
+        """Keep only the newest `keep` turns in the index."""
+        drop = self._size - keep
+        self.vectors[:keep] = self.vectors[drop:self._size]
+        self.counts[:keep] = self.counts[drop:self._size]
+        self.indices = self.indices[drop:]
+        self._positions = {index: position - drop for index, position in self._positions.items() if position >= drop}
+        self._size = keep
+
+    def select(self, max_tokens: int) -> List[int]:
+        """Block indices (in file order) of the system blocks, the newest `recent_turns` turns that fit, and up
+        to `top_k` older turns most similar to the newest turn that fit in what is left of `max_tokens`."""
+        if self.system_tokens > max_tokens:
+            raise SteamshipError(
+                f"Plugin attempted to filter input to fit into {max_tokens} tokens, but the total size of system blocks was {self.system_tokens}"
+            )
+        budget = max_tokens - self.system_tokens
+        start = self._size
+        while start > 0 and self._size - start < self.recent_turns and self.counts[start - 1] < budget:
+            start -= 1
+            budget -= int(self.counts[start])
+        if start == self._size:
+            raise SteamshipError(
+                f"Plugin attempted to filter input to fit into {max_tokens} tokens, but no non-System blocks remained."
+            )
+
+        chosen = list(range(start, self._size))
+        if self.top_k > 0 and start > 0:
+            scores = self.vectors[:start] @ self.vectors[self._size - 1]
+            # Some of the best matches may not fit the budget, so look a little further than top_k
+            num_candidates = min(start, max(self.top_k * 4, 16))
+            candidates = np.argpartition(-scores, num_candidates - 1)[:num_candidates]
+            candidates = candidates[np.argsort(-scores[candidates])]
+            picked = 0
+            for position in candidates:
+                if scores[position] < self.min_similarity or picked == self.top_k:
+                    break
+                if self.counts[position] < budget:
+                    budget -= int(self.counts[position])
+                    chosen.append(int(position))
+                    picked += 1
+        return sorted(self.system_indices + [self.indices[position] for position in chosen])
+
+    @property
+    def total_tokens(self) -> int:
+        return self.system_tokens + self._total
+
+    def token_total(self, block_indices: List[int]) -> int:
+        """Total tokens of a selection returned by `select`."""
+        turns = [self._positions[index] for index in block_indices if index in self._positions]
+        return self.system_tokens + int(self.counts[turns].sum())
+
+
+class ChatMemoryRegistry:
+    """Process-wide LRU of ChatMemory indexes, one per chat file, encoding and embedder. Memory use is bounded
+    by `max_chats` times the `max_turns` of each index."""
+
+    def __init__(self, max_chats: int = 256):
+        self.max_chats = max_chats
+        self._memories: "OrderedDict[tuple, ChatMemory]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, file_id: str, encoding_name: str = DEFAULT_ENCODING, embedder: str = "hashing",
+            recent_turns: int = 6, top_k: int = 4, max_turns: int = DEFAULT_MAX_TURNS) -> ChatMemory:
+        key = (file_id, encoding_name, embedder)
+        with self._lock:
+            memory = self._memories.get(key)
+            cache_lookups.inc(cache="chat_memory", result="miss" if memory is None else "hit")
+            if memory is None:
+                memory = self._memories[key] = ChatMemory(get_embedder(embedder), encoding_name, max_turns=max_turns)
+            memory.recent_turns, memory.top_k = recent_turns, top_k
+            self._memories.move_to_end(key)
+            while len(self._memories) > self.max_chats:
+                self._memories.popitem(last=False)
+            return memory
+
+    def discard(self, file_id: str):
+        with self._lock:
+            for key in [key for key in self._memories if key[0] == file_id]:
+                del self._memories[key]
+
+
+chat_memories = ChatMemoryRegistry()
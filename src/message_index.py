@@ -0,0 +1,127 @@
+"""Process-wide index of Telegram updates and messages that have already been handled."""
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, Optional
+
+from steamship import Block, File
+
+MESSAGE_ID_TAG_KIND = "message_id"
+
+
+class RecentIds:
+    """Bounded set of ids with a floor: ids at or below the floor are treated as already seen.
+
+    Telegram update ids and per-chat message ids only grow, so once the set is full the oldest ids can be
+    dropped and remembered as a single high-watermark instead.
+    """
+
+    def __init__(self, max_ids: int):
+        self.max_ids = max_ids
+        self.floor: Optional[int] = None
+        self._ids: Dict[int, None] = {}
+
+    def __contains__(self, value: int) -> bool:
+        return value in self._ids or (self.floor is not None and value <= self.floor)
+
+    def add(self, value: int):
+        if value in self:
+            return
+        self._ids[value] = None
+        if len(self._ids) > self.max_ids:
+            lowest = sorted(self._ids)[: len(self._ids) - self.max_ids // 2]
+            for dropped in lowest:
+                del self._ids[dropped]
+            self.floor = max(lowest[-1], self.floor if self.floor is not None else lowest[-1])
+
+
+def _as_int(value: Hashable) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class MessageIndex:
+    """Answers "already processed?" for updates and chat messages without touching chat Files.
+
+    A chat's entry is seeded from its File's message_id tags the first time the chat is seen by this
+    process; after that, lookups are O(1) and happen before the File is fetched.
+    """
+
+    def __init__(self, max_chats: int = 10_000, max_ids_per_chat: int = 1_000, max_updates: int = 10_000):
+        self.max_chats = max_chats
+        self.max_ids_per_chat = max_ids_per_chat
+        self._chats: "OrderedDict[str, RecentIds]" = OrderedDict()
+        self._updates = RecentIds(max_updates)
+        self._lock = threading.Lock()
+
+    def claim_update(self, update_id: Hashable) -> bool:
+        """Record a webhook update; False if it was already claimed (i.e. this is a Telegram retry)."""
+        value = _as_int(update_id)
+        if value is None:
+            return True
+        with self._lock:
+            if value in self._updates:
+                return False
+            self._updates.add(value)
+            return True
+
+    def is_loaded(self, chat_id: str) -> bool:
+        with self._lock:
+            return chat_id in self._chats
+
+    def contains(self, chat_id: str, message_id: Hashable) -> bool:
+        """True if the message is known to be processed. False means "not known", not "not processed"
+        unless the chat is loaded."""
+        value = _as_int(message_id)
+        with self._lock:
+            ids = self._chats.get(chat_id)
+            if ids is None or value is None:
+                return False
+            self._chats.move_to_end(chat_id)
+            return value in ids
+
+    def load(self, chat_id: str, message_ids: Iterable[Hashable]):
+        """Seed the index for a chat from its persisted history."""
+        ids = RecentIds(self.max_ids_per_chat)
+        for message_id in message_ids:
+            value = _as_int(message_id)
+            if value is not None:
+                ids.add(value)
+        with self._lock:
+            if chat_id not in self._chats:
+                self._chats[chat_id] = ids
+            self._evict()
+
+    def add(self, chat_id: str, message_id: Hashable):
+        """Record a message of a loaded chat as processed."""
+        value = _as_int(message_id)
+        if value is None:
+            return
+        with self._lock:
+            # Only extend chats that were seeded from their File; a partial entry would hide older ids.
+            ids = self._chats.get(chat_id)
+            if ids is not None:
+                ids.add(value)
+
+    def discard(self, chat_id: str):
+        with self._lock:
+            self._chats.pop(chat_id, None)
+
+    def _evict(self):
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+
+
+def message_ids_in_file(file: File) -> Iterable[str]:
+    return message_ids_in_blocks(file.blocks)
+
+
+def message_ids_in_blocks(blocks: Iterable[Block]) -> Iterable[str]:
+    for block in blocks:
+        for tag in block.tags:
+            if tag.kind == MESSAGE_ID_TAG_KIND:
+                yield tag.name
+
+
+message_index = MessageIndex()
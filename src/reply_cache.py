@@ -0,0 +1,109 @@
+"""Cache of generated replies keyed by the prompt they answered, for openers and commands that repeat."""
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from steamship import Block
+
+from compaction import block_role_name
+from context_window import is_system_block
+from metrics import cache_lookups
+
+_WHITESPACE = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = re.compile(r"[\s.!?,;:…]+$")
+
+
+def normalize_turn(text: str) -> str:
+    """Case, spacing and trailing punctuation do not change what a short message asks for."""
+    return _TRAILING_PUNCTUATION.sub("", _WHITESPACE.sub(" ", (text or "").strip().lower()))
+
+
+def prompt_key(model: str, blocks: List[Block], num_turns: int) -> Optional[str]:
+    """Hash of the prompt as the model sees it: all system blocks verbatim plus every turn, normalized.
+
+    None if the prompt holds more than `num_turns` turns: such a reply depends on a conversation that is
+    unlikely to repeat, and keying it on fewer turns would serve it to chats with a different history.
+    """
+    turns = [block for block in blocks if not is_system_block(block)]
+    if len(turns) > num_turns:
+        return None
+    digest = hashlib.sha256(model.encode("utf-8"))
+    for block in [block for block in blocks if is_system_block(block)]:
+        digest.update(b"\0system\0" + (block.text or "").encode("utf-8"))
+    for block in turns:
+        role = block_role_name(block) or ""
+        digest.update(f"\0{role}\0{normalize_turn(block.text)}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ReplyCache:
+    """LRU of reply texts with a time-to-live, and hit/miss counts."""
+
+    def __init__(self, max_entries: int = 1000, ttl_s: float = 3600, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[float, List[str]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[List[str]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= self.clock():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+        cache_lookups.inc(cache="reply", result="miss" if entry is None else "hit")
+        return None if entry is None else list(entry[1])
+
+    def put(self, key: str, texts: List[str]):
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl_s, list(texts))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def resize(self, max_entries: int, ttl_s: float):
+        with self._lock:
+            self.max_entries = max_entries
+            self.ttl_s = ttl_s
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class ReplyCacheRegistry:
+    """One ReplyCache per package instance, so each bot's limits apply to its own replies only."""
+
+    def __init__(self):
+        self._caches: Dict[str, ReplyCache] = {}
+        self._lock = threading.Lock()
+
+    def get(self, instance: str, max_entries: int, ttl_s: float) -> ReplyCache:
+        with self._lock:
+            cache = self._caches.get(instance)
+            if cache is None:
+                cache = self._caches[instance] = ReplyCache(max_entries, ttl_s)
+        if cache.max_entries != max_entries or cache.ttl_s != ttl_s:
+            cache.resize(max_entries, ttl_s)
+        return cache
+
+
+reply_caches = ReplyCacheRegistry()
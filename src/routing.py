@@ -0,0 +1,162 @@
+"""Latency-aware choice between the chat models, and hedged generation across them."""
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from steamship import SteamshipError, Task
+from steamship.base.tasks import TaskState
+
+# Generation time grows with the prompt, so latencies are kept per prompt-size bucket (upper bounds, in tokens).
+PROMPT_TOKEN_BUCKETS = (1000, 2000, 4000)
+POLL_INTERVAL_S = 0.5
+
+
+def prompt_bucket(prompt_tokens: int) -> int:
+    for i, bound in enumerate(PROMPT_TOKEN_BUCKETS):
+        if prompt_tokens <= bound:
+            return i
+    return len(PROMPT_TOKEN_BUCKETS)
+
+
+# (seconds, censored, observed at): a censored sample only says the generation took at least that long
+Sample = Tuple[float, bool, float]
+
+
+class LatencyTracker:
+    """Recent generation latencies per model and prompt-size bucket.
+
+    Estimates use the model's samples for the same prompt size when there are at least `min_samples` of
+    them, and all of the model's samples otherwise. Samples older than `max_age_s` are ignored, so a model
+    that was skipped for being slow is asked again once what made it look slow has aged out.
+    """
+
+    def __init__(self, window: int = 100, min_samples: int = 5, max_age_s: float = 600,
+                 clock: Callable[[], float] = time.monotonic):
+        self.window = window
+        self.min_samples = min_samples
+        self.max_age_s = max_age_s
+        self.clock = clock
+        self._samples: Dict[Tuple[str, int], Deque[Sample]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, model: str, seconds: float, prompt_tokens: int = 0, censored: bool = False):
+        """Record a generation that took `seconds`, or, if `censored`, one abandoned after `seconds`."""
+        key = (model, prompt_bucket(prompt_tokens))
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append((seconds, censored, self.clock()))
+
+    def estimate(self, model: str, prompt_tokens: int = 0, quantile: float = 0.9) -> Optional[float]:
+        """The `quantile` of recent latencies for `model` at this prompt size; None when nothing is known."""
+        oldest = self.clock() - self.max_age_s
+        with self._lock:
+            samples = [s for s in self._samples.get((model, prompt_bucket(prompt_tokens))) or [] if s[2] >= oldest]
+            if len(samples) < self.min_samples:
+                samples = [s for (m, _), values in self._samples.items() if m == model for s in values
+                           if s[2] >= oldest]
+        return censored_quantile(samples, quantile)
+
+
+def censored_quantile(samples: List[Sample], quantile: float) -> Optional[float]:
+    """Kaplan-Meier estimate of the `quantile` of latencies, some of which are only known lower bounds.
+
+    When the censored samples leave the quantile undetermined, the largest sample is returned: the true value
+    is at least that.
+    """
+    if not samples:
+        return None
+    # At equal values, a completed sample counts before a censored one
+    ordered = sorted((seconds, censored) for seconds, censored, _ in samples)
+    surviving, at_risk = 1.0, len(ordered)
+    for seconds, censored in ordered:
+        if not censored:
+            surviving *= (at_risk - 1) / at_risk
+            if 1 - surviving >= quantile:
+                return seconds
+        at_risk -= 1
+    return ordered[-1][0]
+
+
+def choose_models(primary: str, fallback: str, tracker: LatencyTracker, budget_s: float,
+                  prompt_tokens: int) -> Tuple[str, str]:
+    """Pick (model to ask first, model to hedge with) for a prompt of `prompt_tokens`.
+
+    The primary model is asked first unless its recent p90 latency at this prompt size is over the budget
+    and the fallback's is lower. The hedge goes to whichever model is currently faster, which may be the
+    same model again; a second request to the same model still cuts off its tail.
+    """
+    estimates = {model: tracker.estimate(model, prompt_tokens) for model in (primary, fallback)}
+    first = primary
+    primary_estimate, fallback_estimate = estimates[primary], estimates[fallback]
+    if primary_estimate is not None and primary_estimate > budget_s:
+        if fallback_estimate is None or fallback_estimate < primary_estimate:
+            first = fallback
+    known = [model for model in (primary, fallback) if estimates[model] is not None]
+    hedge = min(known, key=lambda model: estimates[model]) if known else fallback
+    return first, hedge
+
+
+def _finished(task: Task) -> bool:
+    return task.state in (TaskState.succeeded, TaskState.failed)
+
+
+def race(
+    first: Tuple[str, Callable[[], Task]],
+    hedge: Tuple[str, Callable[[], Task]],
+    hedge_after_s: float,
+    max_timeout_s: float = 180,
+    poll_interval_s: float = POLL_INTERVAL_S,
+    on_poll: Optional[Callable[[int, float, List[Task]], None]] = None,
+    on_abandoned: Optional[Callable[[str, float], None]] = None,
+    clock: Callable[[], float] = time.monotonic,
+    sleep: Callable[[float], None] = time.sleep,
+) -> Tuple[str, Task, float]:
+    """Start the `first` generation and, if it has not finished after `hedge_after_s`, the `hedge` one too.
+
+    Each entry is (model, start function). Returns (model, task, seconds) for the first task to succeed. A
+    failure before the deadline starts the hedge right away; if every started task fails, the first error
+    is raised. The losing task is left to finish on its own, since tasks cannot be cancelled; `on_abandoned`
+    is called with its model and how long it had run by then.
+    """
+    start = clock()
+    running: List[Tuple[str, Task, float]] = [(first[0], first[1](), start)]
+    hedged = False
+    errors: List[str] = []
+    polls = 0
+    while True:
+        for entry in list(running):
+            model, task, started = entry
+            if not _finished(task):
+                continue
+            if task.state == TaskState.succeeded:
+                finished_at = clock()
+                if on_abandoned is not None:
+                    for other_model, other_task, other_started in running:
+                        if other_task is not task and not _finished(other_task):
+                            on_abandoned(other_model, finished_at - other_started)
+                return model, task, finished_at - started
+            errors.append(f"{model}: {task.status_message}")
+            running.remove(entry)
+
+        elapsed = clock() - start
+        if not hedged and (not running or elapsed >= hedge_after_s):
+            hedged = True
+            running.append((hedge[0], hedge[1](), clock()))
+            continue
+        if not running:
+            raise SteamshipError(message=f"Generation failed on every model: {'; '.join(errors)}")
+        if elapsed >= max_timeout_s:
+            raise SteamshipError(message=f"No model answered within {max_timeout_s}s")
+
+        sleep(poll_interval_s if hedged else max(0.0, min(poll_interval_s, hedge_after_s - elapsed)))
+        for _, task, _ in running:
+            task.refresh()
+        polls += 1
+        if on_poll is not None:
+            on_poll(polls, clock() - start, [task for _, task, _ in running])
+
+
+model_latency = LatencyTracker()
@@ -0,0 +1,119 @@
+"""Progressive delivery of a reply by editing a single Telegram message in place."""
+import logging
+import time
+from typing import Any, Callable, Optional
+
+import requests
+from steamship import SteamshipError, Task
+
+from telegram_sender import TelegramSender, split_message
+
+PLACEHOLDER_TEXT = "…"
+
+# Telegram allows roughly one edit per second per chat before it starts answering 429.
+MIN_EDIT_INTERVAL_S = 1.0
+
+
+def partial_output_text(task: Task) -> str:
+    """Text of the first output block a running generate task has produced so far, if any.
+
+    Depending on the generator, `task.output` is still raw JSON while the task runs.
+    """
+    output: Any = task.output
+    blocks = output.get("blocks") if isinstance(output, dict) else getattr(output, "blocks", None)
+    if not blocks:
+        return ""
+    first = blocks[0]
+    return (first.get("text") if isinstance(first, dict) else getattr(first, "text", None)) or ""
+
+
+class StreamingMessage:
+    """A Telegram message sent as a placeholder and then edited as more of the reply becomes available.
+
+    Edits are rate limited to `min_edit_interval_s` and skipped when the text has not changed; `finish`
+    always writes the final text. A failed progress edit is logged and skipped, and if the final edit fails the
+    text is sent as a new message instead, so the reply is never lost to an edit. Text beyond Telegram's message size limit is left for the caller to send.
+    With a `sender`, calls go through its pooled, retrying session.
+    """
+
+    def __init__(
+        self,
+        api_root: str,
+        chat_id: str,
+        min_edit_interval_s: float = MIN_EDIT_INTERVAL_S,
+        clock: Callable[[], float] = time.monotonic,
+        sender: Optional[TelegramSender] = None,
+    ):
+        self.api_root = api_root
+        self.chat_id = chat_id
+        self.sender = sender
+        self.min_edit_interval_s = min_edit_interval_s
+        self.clock = clock
+        self.message_id: Optional[int] = None
+        self.text: Optional[str] = None
+        self.num_edits = 0
+        self._last_edit_at: Optional[float] = None
+
+    def _call(self, method: str, params: dict) -> dict:
+        if self.sender is not None:
+            return self.sender.call(method, params)
+        resp = requests.post(f"{self.api_root}/{method}", json=params, timeout=10)
+        body = resp.json()
+        if not body.get("ok"):
+            raise SteamshipError(f"Telegram {method} failed for chat {self.chat_id}: {body.get('description')}")
+        return body.get("result") or {}
+
+    def start(self, placeholder: str = PLACEHOLDER_TEXT) -> "StreamingMessage":
+        result = self._call("sendMessage", {"chat_id": int(self.chat_id), "text": placeholder})
+        self.message_id = result.get("message_id")
+        self.text = placeholder
+        self._last_edit_at = self.clock()
+        return self
+
+    def update(self, text: str) -> bool:
+        """Show `text` if the rate limit allows it. Returns whether an edit was made."""
+        if self.message_id is None or not text:
+            return False
+        if self._last_edit_at is not None and self.clock() - self._last_edit_at < self.min_edit_interval_s:
+            return False
+        # Whitespace-only output splits into nothing, and Telegram rejects an empty edit anyway
+        pieces = split_message(text)
+        if not pieces or pieces[0] == self.text:
+            return False
+        text = pieces[0]
+        try:
+            self._edit(text)
+        except Exception as e:
+            logging.warning(f"Skipping an edit of the streamed reply in chat {self.chat_id}: {e}")
+            # Wait out the rate limit before trying again
+            self._last_edit_at = self.clock()
+            return False
+        return True
+
+    def finish(self, text: str):
+        """Replace the placeholder with the complete text, regardless of the rate limit."""
+        if self.message_id is None or not text or text == self.text:
+            return
+        try:
+            self._edit(text)
+        except Exception as e:
+            logging.warning(f"Could not edit the streamed reply in chat {self.chat_id}; sending it as a new message: {e}")
+            self._call("sendMessage", {"chat_id": int(self.chat_id), "text": text})
+            self.cancel()
+            self.text = text
+
+    def cancel(self):
+        """Remove the placeholder, e.g. when generation failed and an error will be sent instead."""
+        if self.message_id is None:
+            return
+        try:
+            self._call("deleteMessage", {"chat_id": int(self.chat_id), "message_id": self.message_id})
+        except Exception as e:
+            logging.warning(f"Could not delete placeholder message in chat {self.chat_id}: {e}")
+        self.message_id = None
+
+    def _edit(self, text: str):
+        self._call("editMessageText", {"chat_id": int(self.chat_id), "message_id": self.message_id, "text": text})
+        self.text = text
+        self.num_edits += 1
+        self._last_edit_at = self.clock()
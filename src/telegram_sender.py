@@ -0,0 +1,195 @@
+"""Outbound Telegram Bot API calls over a shared keep-alive session, paced to Telegram's rate limits and retried.
+
+Long texts are split to fit Telegram's message size limit. Pacing follows the published limits: about one
+message per second in a chat, 20 per minute in a group, and 30 per second overall. 429 answers are retried
+after the `retry_after` Telegram asks for, and server or network errors are retried with exponential backoff.
+"""
+import logging
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from steamship import SteamshipError
+
+from metrics import metrics
+from token_scheduler import TokenBucket
+
+# Telegram measures message length in UTF-16 code units.
+MAX_MESSAGE_LENGTH = 4096
+
+GLOBAL_MESSAGES_PER_SECOND = 30
+PRIVATE_CHAT_MESSAGES_PER_MINUTE = 60
+GROUP_CHAT_MESSAGES_PER_MINUTE = 20
+CHAT_BURST = 3
+
+telegram_retries = metrics.counter("telegram_retries_total", "Bot API calls retried, by method and reason.")
+telegram_failures = metrics.counter("telegram_failures_total", "Bot API calls that failed for good, by method.")
+
+_BREAKS = [re.compile(r"\n\s*\n"), re.compile(r"\n"), re.compile(r"(?<=[.!?…])\s"), re.compile(r"\s")]
+
+
+def utf16_length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _longest_prefix(text: str, limit: int) -> int:
+    """Number of characters of `text` that fit in `limit` UTF-16 code units."""
+    end = min(len(text), limit)
+    while utf16_length(text[:end]) > limit:
+        end -= max(1, (utf16_length(text[:end]) - limit) // 2)
+    return end
+
+
+def split_message(text: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """Split `text` into parts of at most `limit` UTF-16 code units.
+
+    Parts end at the last paragraph break in the second half of the allowed length, else the last line
+    break, sentence end or space there, and only as a last resort in the middle of a word.
+    """
+    parts = []
+    text = text.strip()
+    while utf16_length(text) > limit:
+        end = _longest_prefix(text, limit)
+        cut = end
+        for pattern in _BREAKS:
+            matches = [match for match in pattern.finditer(text, end // 2, end)]
+            if matches:
+                cut = matches[-1].start()
+                break
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        parts.append(text)
+    return parts
+
+
+class _ChatQueue:
+    __slots__ = ("lock", "bucket")
+
+    def __init__(self, bucket: TokenBucket):
+        self.lock = threading.Lock()
+        self.bucket = bucket
+
+
+class TelegramSender:
+    """Bot API client for one bot token. Thread-safe; share one per process.
+
+    Messages to one chat are sent in order, one reply at a time, so the parts of a split reply are never
+    interleaved with another reply.
+    """
+
+    def __init__(self, api_root: str, pool_size: int = 16, timeout_s: float = 10.0, max_attempts: int = 4,
+                 max_retry_after_s: float = 30.0, global_per_second: float = GLOBAL_MESSAGES_PER_SECOND,
+                 private_per_minute: float = PRIVATE_CHAT_MESSAGES_PER_MINUTE,
+                 group_per_minute: float = GROUP_CHAT_MESSAGES_PER_MINUTE, chat_burst: float = CHAT_BURST,
+                 max_chats: int = 10_000, clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.api_root = api_root
+        self.timeout_s = timeout_s
+        self.max_attempts = max_attempts
+        self.max_retry_after_s = max_retry_after_s
+        self.private_per_minute = private_per_minute
+        self.group_per_minute = group_per_minute
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self.clock = clock
+        self.sleep = sleep
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self._global = TokenBucket(global_per_second * 60, global_per_second, clock)
+        self._chats: "OrderedDict[int, _ChatQueue]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id: int, text: str, **params) -> List[dict]:
+        """Send `text` to the chat, split into as many messages as needed. Returns the sent messages; parts
+        that could not be delivered after retrying are logged and skipped."""
+        chat_id = int(chat_id)
+        queue = self._queue(chat_id)
+        sent = []
+        with queue.lock:
+            for part in split_message(text):
+                self._wait_for_turn(queue)
+                try:
+                    sent.append(self.call("sendMessage", {"chat_id": chat_id, "text": part, **params}))
+                except SteamshipError as e:
+                    logging.error(f"Could not deliver a message to chat {chat_id}: {e}")
+        return sent
+
+    def call(self, method: str, params: dict, max_attempts: Optional[int] = None) -> dict:
+        """Call a Bot API method, retrying 429s, server errors and network errors. Raises SteamshipError once
+        attempts run out or on any other error."""
+        attempts = max_attempts or self.max_attempts
+        for attempt in range(1, attempts + 1):
+            delay, reason = None, None
+            try:
+                response = self.session.post(f"{self.api_root}/{method}", json=params, timeout=self.timeout_s)
+                body = response.json() if response.content else {}
+            except (requests.RequestException, ValueError) as e:
+                body, reason, delay = {"description": str(e)}, "network", self._backoff(attempt)
+            else:
+                if body.get("ok"):
+                    return body.get("result") or {}
+                if response.status_code == 429:
+                    retry_after = (body.get("parameters") or {}).get("retry_after", 1)
+                    reason, delay = "rate_limited", min(float(retry_after), self.max_retry_after_s)
+                elif response.status_code >= 500:
+                    reason, delay = "server_error", self._backoff(attempt)
+            if reason is None or attempt == attempts:
+                telegram_failures.inc(method=method)
+                raise SteamshipError(f"Telegram {method} failed: {body.get('description')}")
+            telegram_retries.inc(method=method, reason=reason)
+            logging.info(f"Retrying Telegram {method} in {delay:.1f}s ({reason})")
+            self.sleep(delay)
+
+    def _backoff(self, attempt: int) -> float:
+        return min(8.0, 0.5 * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+    def _wait_for_turn(self, queue: _ChatQueue):
+        while True:
+            with self._lock:
+                wait_s = max(queue.bucket.seconds_until(1), self._global.seconds_until(1))
+                if wait_s <= 0 and queue.bucket.try_take(1) and self._global.try_take(1):
+                    return
+            self.sleep(max(wait_s, 0.005))
+
+    def _queue(self, chat_id: int) -> _ChatQueue:
+        with self._lock:
+            queue = self._chats.get(chat_id)
+            if queue is None:
+                # Group and channel ids are negative
+                per_minute = self.group_per_minute if chat_id < 0 else self.private_per_minute
+                queue = self._chats[chat_id] = _ChatQueue(TokenBucket(per_minute, self.chat_burst, self.clock))
+                self._evict()
+            else:
+                self._chats.move_to_end(chat_id)
+            return queue
+
+    def _evict(self):
+        # A chat that is sending right now stays, otherwise its messages could be reordered
+        for chat_id in [chat_id for chat_id, queue in self._chats.items() if not queue.lock.locked()]:
+            if len(self._chats) <= self.max_chats:
+                break
+            del self._chats[chat_id]
+
+
+class TelegramSenderRegistry:
+    """One sender per bot, so every request handled by this process shares its connections and limits."""
+
+    def __init__(self):
+        self._senders: Dict[str, TelegramSender] = {}
+        self._lock = threading.Lock()
+
+    def get(self, api_root: str) -> TelegramSender:
+        with self._lock:
+            if api_root not in self._senders:
+                self._senders[api_root] = TelegramSender(api_root)
+            return self._senders[api_root]
+
+
+telegram_senders = TelegramSenderRegistry()
@@ -0,0 +1,145 @@
+"""Admission control for generations: a token bucket in model tokens per minute, shared fairly across chats."""
+import heapq
+import itertools
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from metrics import metrics
+
+BUSY_REPLY = "I'm getting a lot of messages right now and can't answer yours yet. Please try again in a minute!"
+
+rejections = metrics.counter("scheduler_rejections_total", "Replies refused because the token budget was exhausted.")
+
+
+class TokenBucket:
+    """Tokens refill continuously at `tokens_per_minute`, up to `capacity`. Not thread-safe on its own."""
+
+    def __init__(self, tokens_per_minute: float, capacity: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.rate = tokens_per_minute / 60
+        self.capacity = capacity if capacity is not None else tokens_per_minute
+        self.clock = clock
+        self.tokens = self.capacity
+        self._updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_take(self, amount: float) -> bool:
+        self._refill()
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def give_back(self, amount: float):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def seconds_until(self, amount: float) -> float:
+        """How long until `amount` tokens are available, if nobody else takes any."""
+        self._refill()
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+
+class _Ticket:
+    __slots__ = ("chat_id", "cost", "start", "finish")
+
+    def __init__(self, chat_id: str, cost: float, start: float):
+        self.chat_id = chat_id
+        self.cost = cost
+        self.start = start
+        self.finish = start + cost
+
+
+class TokenScheduler:
+    """Hands out the token bucket to waiting generations in weighted-fair-queuing order.
+
+    Each request gets a virtual finish tag: the later of "now" in virtual time and its chat's previous
+    finish tag, plus its cost in tokens. Serving the smallest tag first alternates between chats, so a
+    chat with a backlog cannot starve the others, and short prompts go ahead of long ones. A request whose
+    estimated wait exceeds `max_wait_s` is refused up front, so callers can answer "busy" instead of
+    hanging until the webhook times out.
+    """
+
+    def __init__(self, tokens_per_minute: float, capacity: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.bucket = TokenBucket(tokens_per_minute, capacity, clock)
+        self.clock = clock
+        self._virtual_time = 0.0
+        self._chat_finish: Dict[str, float] = {}
+        self._queue: List[Tuple[float, int, _Ticket]] = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+
+    def acquire(self, chat_id: str, cost: float, max_wait_s: float) -> Optional[float]:
+        """Block until `cost` tokens are granted to this chat, and return how many were taken: a cost above the
+        bucket's capacity is capped at it. None if the wait would exceed `max_wait_s`."""
+        cost = min(cost, self.bucket.capacity)
+        with self._cond:
+            ticket = _Ticket(chat_id, cost, max(self._virtual_time, self._chat_finish.get(chat_id, 0.0)))
+            ahead = sum(queued.cost for _, _, queued in self._queue if queued.finish <= ticket.finish)
+            if self.bucket.seconds_until(ahead + cost) > max_wait_s:
+                rejections.inc()
+                return None
+            entry = (ticket.finish, next(self._sequence), ticket)
+            heapq.heappush(self._queue, entry)
+            self._chat_finish[chat_id] = ticket.finish
+
+            deadline = self.clock() + max_wait_s
+            while True:
+                at_head = self._queue[0] is entry
+                if at_head and self.bucket.try_take(cost):
+                    heapq.heappop(self._queue)
+                    self._virtual_time = max(self._virtual_time, ticket.start)
+                    self._forget_idle_chats()
+                    self._cond.notify_all()
+                    return cost
+                remaining = deadline - self.clock()
+                if remaining <= 0:
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+                    self._cond.notify_all()
+                    rejections.inc()
+                    return None
+                wait_s = self.bucket.seconds_until(cost) if at_head else remaining
+                self._cond.wait(min(remaining, max(wait_s, 0.005)))
+
+    def release(self, unused: float):
+        """Return tokens that were reserved but not used, e.g. when a reply came out shorter than its limit."""
+        if unused <= 0:
+            return
+        with self._cond:
+            self.bucket.give_back(unused)
+            self._cond.notify_all()
+
+    def queued(self) -> int:
+        with self._cond:
+            return len(self._queue)
+
+    def _forget_idle_chats(self):
+        if len(self._chat_finish) > 10_000:
+            self._chat_finish = {
+                chat_id: finish for chat_id, finish in self._chat_finish.items() if finish > self._virtual_time
+            }
+
+
+class TokenSchedulerRegistry:
+    """One scheduler per model, since provider rate limits are per model."""
+
+    def __init__(self):
+        self._schedulers: Dict[Tuple[str, float], TokenScheduler] = {}
+        self._lock = threading.Lock()
+
+    def get(self, model: str, tokens_per_minute: float) -> TokenScheduler:
+        with self._lock:
+            key = (model, tokens_per_minute)
+            if key not in self._schedulers:
+                self._schedulers[key] = TokenScheduler(tokens_per_minute)
+            return self._schedulers[key]
+
+
+token_schedulers = TokenSchedulerRegistry()
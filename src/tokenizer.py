@@ -0,0 +1,201 @@
+"""Process-wide tiktoken encoders and memoized per-block token counts."""
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, Hashable, List, Optional
+
+import tiktoken
+from steamship import Block, Tag
+from steamship.data.tags.tag_constants import TagValueKey
+from tiktoken.model import MODEL_PREFIX_TO_ENCODING, MODEL_TO_ENCODING
+
+from metrics import cache_lookups
+
+# gpt-3.5-turbo and gpt-4 both use cl100k_base.
+DEFAULT_ENCODING = "cl100k_base"
+
+# BPE rank files shipped with the package, in tiktoken's cache layout, so a cold instance never downloads them.
+# They are committed along with their checksums; `python src/tokenizer.py` downloads them again.
+BUNDLED_BPE_DIR = Path(__file__).parent / "tiktoken_cache"
+# `sha256sum` format, so a build step can also check them with `sha256sum -c`
+CHECKSUMS_FILE_NAME = "SHA256SUMS"
+
+if "TIKTOKEN_CACHE_DIR" not in os.environ and any(BUNDLED_BPE_DIR.glob("[0-9a-f]*")):
+    os.environ["TIKTOKEN_CACHE_DIR"] = str(BUNDLED_BPE_DIR)
+
+# Blocks carry their token count in a tag of this kind, named after the encoding that produced it.
+TOKEN_COUNT_TAG_KIND = "token_count"
+
+
+def encoding_name_for_model(model: str) -> str:
+    """Name of the tiktoken encoding used by `model`, falling back to DEFAULT_ENCODING."""
+    if model in MODEL_TO_ENCODING:
+        return MODEL_TO_ENCODING[model]
+    for prefix, encoding_name in MODEL_PREFIX_TO_ENCODING.items():
+        if model.startswith(prefix):
+            return encoding_name
+    logging.warning(f"No known tiktoken encoding for model {model}; using {DEFAULT_ENCODING}")
+    return DEFAULT_ENCODING
+
+
+# Encoders used instead of tiktoken's, e.g. an offline stand-in in tests
+_registered_encoders: Dict[str, Any] = {}
+
+
+def register_encoder(encoding_name: str, encoder: Any):
+    """Use `encoder` (anything with tiktoken's `encode` and `encode_batch`) for `encoding_name` from now on."""
+    _registered_encoders[encoding_name] = encoder
+    get_encoder.cache_clear()
+    token_counts.clear()
+
+
+@lru_cache(maxsize=None)
+def get_encoder(encoding_name: str = DEFAULT_ENCODING) -> tiktoken.Encoding:
+    """Return the shared encoder for `encoding_name`; its BPE ranks are loaded once per process."""
+    if encoding_name in _registered_encoders:
+        return _registered_encoders[encoding_name]
+    return tiktoken.get_encoding(encoding_name)
+
+
+def bpe_file_checksums(cache_dir: Path = BUNDLED_BPE_DIR) -> Dict[str, str]:
+    """sha256 of each BPE file in `cache_dir`, by file name."""
+    return {path.name: hashlib.sha256(path.read_bytes()).hexdigest()
+            for path in sorted(cache_dir.glob("[0-9a-f]*")) if path.is_file()}
+
+
+def verify_bpe_files(cache_dir: Path = BUNDLED_BPE_DIR) -> List[str]:
+    """Names of the files listed in `cache_dir`'s checksums file that are missing or do not match it."""
+    actual = bpe_file_checksums(cache_dir)
+    mismatched = []
+    for line in (cache_dir / CHECKSUMS_FILE_NAME).read_text().splitlines():
+        expected, name = line.split()
+        if actual.get(name) != expected:
+            mismatched.append(name)
+    return mismatched
+
+
+def prefetch_encodings(encoding_names: List[str], cache_dir: Path = BUNDLED_BPE_DIR):
+    """Download the BPE files for `encoding_names` into `cache_dir`, and write their checksums, so they can be
+    shipped with the package."""
+    from tiktoken_ext import openai_public
+
+    previous = os.environ.get("TIKTOKEN_CACHE_DIR")
+    os.environ["TIKTOKEN_CACHE_DIR"] = str(cache_dir)
+    try:
+        for encoding_name in encoding_names:
+            # Calling the constructor directly (not tiktoken's registry) always reads through cache_dir.
+            getattr(openai_public, encoding_name)()
+            logging.info(f"Cached BPE ranks for {encoding_name} in {cache_dir}")
+        (cache_dir / CHECKSUMS_FILE_NAME).write_text(
+            "".join(f"{checksum}  {name}\n" for name, checksum in bpe_file_checksums(cache_dir).items()))
+    finally:
+        if previous is None:
+            del os.environ["TIKTOKEN_CACHE_DIR"]
+        else:
+            os.environ["TIKTOKEN_CACHE_DIR"] = previous
+
+
+class TokenCountCache:
+    """Thread-safe LRU of token counts, keyed by encoding and block id (or text for unsaved blocks)."""
+
+    def __init__(self, max_entries: int = 50_000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[int]:
+        with self._lock:
+            count = self._entries.get(key)
+            if count is not None:
+                self._entries.move_to_end(key)
+            return count
+
+    def put(self, key: Hashable, count: int):
+        with self._lock:
+            self._entries[key] = count
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_counts = TokenCountCache()
+
+
+def _cache_key(block: Block, encoding_name: str) -> Hashable:
+    return (encoding_name, block.id) if block.id else (encoding_name, "text", block.text)
+
+
+def count_tokens(text: str, encoding_name: str = DEFAULT_ENCODING) -> int:
+    """Count the tokens in `text` with the shared encoder."""
+    return len(get_encoder(encoding_name).encode(text or ""))
+
+
+def token_count_tag(count: int, encoding_name: str = DEFAULT_ENCODING) -> Tag:
+    """Tag recording a block's token count, written alongside the block so it is never re-tokenized."""
+    return Tag(
+        kind=TOKEN_COUNT_TAG_KIND, name=encoding_name, value={TagValueKey.NUMBER_VALUE: count}
+    )
+
+
+def tagged_token_count(block: Block, encoding_name: str = DEFAULT_ENCODING) -> Optional[int]:
+    """Return the token count stored in the block's tags for `encoding_name`, if any."""
+    for tag in block.tags or []:
+        if tag.kind == TOKEN_COUNT_TAG_KIND and tag.name == encoding_name and tag.value:
+            count = tag.value.get(TagValueKey.NUMBER_VALUE)
+            if count is not None:
+                return int(count)
+    return None
+
+
+def remember_token_count(block: Block, count: int, encoding_name: str = DEFAULT_ENCODING):
+    """Seed the in-memory cache with a count computed elsewhere (e.g. at append time)."""
+    token_counts.put(_cache_key(block, encoding_name), count)
+
+
+def block_token_counts(blocks: List[Block], encoding_name: str = DEFAULT_ENCODING) -> List[int]:
+    """Token counts for `blocks`, in order.
+
+    Counts come from the LRU first, then from token_count tags; whatever is left is tokenized in a
+    single `encode_batch` call and remembered, so each block is tokenized at most once per process.
+    """
+    counts: List[Optional[int]] = []
+    missing = []
+    from_tags = 0
+    for i, block in enumerate(blocks):
+        key = _cache_key(block, encoding_name)
+        count = token_counts.get(key)
+        if count is None:
+            count = tagged_token_count(block, encoding_name)
+            if count is not None:
+                from_tags += 1
+                token_counts.put(key, count)
+        if count is None:
+            missing.append(i)
+        counts.append(count)
+
+    cache_lookups.inc(len(blocks) - from_tags - len(missing), cache="token_count", result="hit")
+    if from_tags:
+        cache_lookups.inc(from_tags, cache="token_count", result="tag")
+    if missing:
+        cache_lookups.inc(len(missing), cache="token_count", result="miss")
+
+    if missing:
+        encoded = get_encoder(encoding_name).encode_batch([blocks[i].text or "" for i in missing])
+        for i, tokens in zip(missing, encoded):
+            counts[i] = len(tokens)
+            token_counts.put(_cache_key(blocks[i], encoding_name), counts[i])
+
+    return counts
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    prefetch_encodings(sorted(set(MODEL_TO_ENCODING[model] for model in ("gpt-4", "gpt-3.5-turbo"))))
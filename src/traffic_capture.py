@@ -0,0 +1,158 @@
+"""Capture of incoming webhook traffic as anonymized JSONL, for replaying realistic load offline.
+
+Each line is one request: `{"t": arrival time in Unix seconds, "path": ..., "seconds": time to handle it,
+"body": anonymized payload}`. Ids are replaced by keyed hashes, so a chat keeps one id throughout a capture
+and Telegram retries still share their update_id, but nothing maps back to real users without the key. The key
+is shared by every run and worker writing to a capture; see `capture_salt`.
+"""
+import hashlib
+import hmac
+import json
+import os
+import re
+import secrets
+import threading
+import time
+from typing import Any, Dict, Optional
+
+# Identifiers of people, chats and files; update_id and message_id are per-bot counters and are kept.
+ID_KEYS = {"id", "user_id", "chat_id", "sender_chat_id", "file_id", "file_unique_id"}
+NAME_KEYS = {"first_name", "last_name", "username", "title", "phone_number", "email", "vcard", "bio"}
+TEXT_KEYS = {"text", "caption"}
+DROPPED_KEYS = {"location", "venue", "contact"}
+
+SALT_ENV_VAR = "TRAFFIC_CAPTURE_SALT"
+
+_WORD = re.compile(r"[^\W_]+")
+_LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+
+def capture_salt(path: str) -> bytes:
+    """The salt for the capture file at `path`: $TRAFFIC_CAPTURE_SALT if set, which workers on different hosts
+    must share, else the one kept next to the capture in `<path>.salt`, created on first use.
+
+    Anyone with the salt can tell which pseudonym belongs to a known chat or user, so keep it apart from the
+    capture when passing that on.
+    """
+    salt = os.environ.get(SALT_ENV_VAR)
+    if salt:
+        return salt.encode("utf-8")
+    salt_path = path + ".salt"
+    if not os.path.exists(salt_path):
+        # Written under a private name and linked into place, so concurrent workers all end up with one salt
+        temp_path = f"{salt_path}.{os.getpid()}.{threading.get_ident()}"
+        with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w", encoding="ascii") as f:
+            f.write(secrets.token_hex(16))
+        try:
+            os.link(temp_path, salt_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+    with open(salt_path, encoding="ascii") as f:
+        return bytes.fromhex(f.read().strip())
+
+
+class Anonymizer:
+    """Replaces personal data in Telegram updates with stable pseudonyms derived from a secret salt."""
+
+    def __init__(self, salt: Optional[bytes] = None):
+        self.salt = salt if salt is not None else secrets.token_bytes(16)
+
+    def _digest(self, value: str) -> bytes:
+        return hmac.new(self.salt, value.encode("utf-8"), hashlib.sha256).digest()
+
+    def pseudo_id(self, value: Any) -> Any:
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, int):
+            # Same magnitude as Telegram ids; group chats keep their negative sign
+            pseudo = int.from_bytes(self._digest(str(value))[:6], "big") % 10**12 + 1
+            return -pseudo if value < 0 else pseudo
+        return self._digest(str(value)).hex()[:24]
+
+    def pseudo_word(self, word: str) -> str:
+        digest = self._digest(word.lower())
+        return "".join(_LETTERS[digest[i % len(digest)] % len(_LETTERS)] for i in range(len(word)))
+
+    def text(self, text: str) -> str:
+        """Bot commands such as /start are kept; every other word becomes a pseudo-word of the same length.
+        Repeated words stay repeated, so caches see the same mix of repeats as in production."""
+        if text.startswith("/"):
+            command, _, rest = text.partition(" ")
+            return command + (" " + self.text(rest) if rest else "")
+        return _WORD.sub(lambda match: self.pseudo_word(match.group(0)), text)
+
+    def update(self, value: Any) -> Any:
+        """A copy of `value` with personal data replaced."""
+        if isinstance(value, list):
+            return [self.update(item) for item in value]
+        if not isinstance(value, dict):
+            return value
+        result = {}
+        for key, item in value.items():
+            if key in DROPPED_KEYS:
+                continue
+            if key in ID_KEYS and not isinstance(item, (dict, list)):
+                result[key] = self.pseudo_id(item)
+            elif key in NAME_KEYS and isinstance(item, str):
+                result[key] = self.pseudo_word(item) if item else item
+            elif key in TEXT_KEYS and isinstance(item, str):
+                result[key] = self.text(item)
+            else:
+                result[key] = self.update(item)
+        return result
+
+
+class TrafficRecorder:
+    """Appends anonymized requests to a JSONL file. Safe to share between threads."""
+
+    def __init__(self, path: str, anonymizer: Optional[Anonymizer] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.anonymizer = anonymizer or Anonymizer(capture_salt(path))
+        self._file = open(path, "a", encoding="utf-8")
+
+    @staticmethod
+    def now() -> float:
+        """Value to pass as `arrived_at`, taken when a request comes in. Wall time, so a capture file can
+        collect several runs of the server."""
+        return time.time()
+
+    def record(self, path: str, body: Dict, arrived_at: float, seconds: float):
+        line = json.dumps({"t": round(arrived_at, 6), "path": path, "seconds": round(seconds, 6),
+                           "body": self.anonymizer.update(body)}, separators=(",", ":"))
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class TrafficRecorderRegistry:
+    """One recorder per capture file, so every request handled by this process lands in the same file."""
+
+    def __init__(self):
+        self._recorders: Dict[str, TrafficRecorder] = {}
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> TrafficRecorder:
+        with self._lock:
+            if path not in self._recorders:
+                self._recorders[path] = TrafficRecorder(path)
+            return self._recorders[path]
+
+
+traffic_recorders = TrafficRecorderRegistry()
+
+
+def load_capture(path: str):
+    """The requests of a capture file, in order of arrival."""
+    with open(path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return sorted(records, key=lambda record: record["t"])
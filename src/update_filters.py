@@ -0,0 +1,165 @@
+"""Cheap checks on raw Telegram updates that decide, before any storage or model access, whether to answer."""
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+from metrics import metrics
+
+update_filter_results = metrics.counter(
+    "update_filter_total", "Incoming updates by the filter that dropped them; filter=\"none\" counts updates let through.")
+
+
+def update_message(update: dict) -> dict:
+    return update.get("message") or {}
+
+
+def sender_key(update: dict) -> Tuple[Hashable, Hashable]:
+    message = update_message(update)
+    return (message.get("chat") or {}).get("id"), (message.get("from") or {}).get("id")
+
+
+class UpdateFilter(ABC):
+    """One stage of a FilterPipeline. `allow` must be fast and must not touch storage or the network."""
+
+    name = "filter"
+
+    @abstractmethod
+    def allow(self, update: dict) -> bool:
+        ...
+
+
+class ContentTypeFilter(UpdateFilter):
+    """Only new text messages are answered. Edits, channel posts, stickers, media and service messages (members
+    joining, pinned messages, ...) are dropped instead of failing later in parsing."""
+
+    name = "content_type"
+
+    def allow(self, update: dict) -> bool:
+        text = update_message(update).get("text")
+        return isinstance(text, str) and text.strip() != ""
+
+
+class GroupMentionFilter(UpdateFilter):
+    """In groups, only answer messages that mention the bot, reply to it, or are commands meant for it.
+
+    `bot_username` is called on the first group message and may return None when it is unknown; then only
+    replies to a bot and commands without an explicit addressee get through.
+    """
+
+    name = "group_mention"
+
+    def __init__(self, bot_username: Callable[[], Optional[str]]):
+        self.bot_username = bot_username
+
+    def allow(self, update: dict) -> bool:
+        message = update_message(update)
+        if (message.get("chat") or {}).get("type") not in ("group", "supergroup"):
+            return True
+        username = (self.bot_username() or "").lower()
+        text = message.get("text") or ""
+        if text.startswith("/"):
+            command = text.split(maxsplit=1)[0].lower()
+            return "@" not in command or (bool(username) and command.endswith("@" + username))
+        replied_to = (message.get("reply_to_message") or {}).get("from") or {}
+        if replied_to.get("is_bot") and (not username or (replied_to.get("username") or "").lower() == username):
+            return True
+        return bool(username) and f"@{username}" in text.lower()
+
+
+class _RecentSenders:
+    """Bounded LRU of per-sender state; the least recently active senders are forgotten first."""
+
+    def __init__(self, max_senders: int):
+        self.max_senders = max_senders
+        self._entries: "OrderedDict[Hashable, object]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Callable[[], object]):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = default()
+            if len(self._entries) > self.max_senders:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+        return entry
+
+
+class FloodFilter(UpdateFilter):
+    """Drops a sender's messages beyond `max_messages` within any `window_s` seconds, per chat."""
+
+    name = "flood"
+
+    def __init__(self, max_messages: int, window_s: float, max_senders: int = 10_000,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_messages = max_messages
+        self.window_s = window_s
+        self.clock = clock
+        self._senders = _RecentSenders(max_senders)
+        self._lock = threading.Lock()
+
+    def allow(self, update: dict) -> bool:
+        now = self.clock()
+        with self._lock:
+            times: Deque[float] = self._senders.get(sender_key(update), deque)
+            while times and times[0] <= now - self.window_s:
+                times.popleft()
+            if len(times) >= self.max_messages:
+                return False
+            times.append(now)
+            return True
+
+
+class RepeatFilter(UpdateFilter):
+    """Drops a message whose text is exactly the sender's previous message in that chat, sent within
+    `window_s` seconds of it."""
+
+    name = "repeat"
+
+    def __init__(self, window_s: float, max_senders: int = 10_000, clock: Callable[[], float] = time.monotonic):
+        self.window_s = window_s
+        self.clock = clock
+        self._senders = _RecentSenders(max_senders)
+        self._lock = threading.Lock()
+
+    def allow(self, update: dict) -> bool:
+        now = self.clock()
+        text = update_message(update).get("text")
+        with self._lock:
+            last = self._senders.get(sender_key(update), lambda: [None, float("-inf")])
+            repeated = text == last[0] and now - last[1] <= self.window_s
+            last[0], last[1] = text, now
+            return not repeated
+
+
+class FilterPipeline:
+    """Runs filters in order and stops at the first one that drops the update."""
+
+    def __init__(self, filters: List[UpdateFilter]):
+        self.filters = filters
+
+    def admit(self, update: dict) -> bool:
+        for update_filter in self.filters:
+            if not update_filter.allow(update):
+                update_filter_results.inc(filter=update_filter.name)
+                return False
+        update_filter_results.inc(filter="none")
+        return True
+
+
+class FilterPipelineRegistry:
+    """One pipeline per package instance and filter settings, so flood and repeat state outlives a request."""
+
+    def __init__(self):
+        self._pipelines: Dict[Hashable, FilterPipeline] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, build: Callable[[], FilterPipeline]) -> FilterPipeline:
+        with self._lock:
+            if key not in self._pipelines:
+                self._pipelines[key] = build()
+            return self._pipelines[key]
+
+
+filter_pipelines = FilterPipelineRegistry()
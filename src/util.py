@@ -1,9 +1,12 @@
-import tiktoken
 from steamship.data.tags.tag_constants import RoleTag, TagKind
-from steamship import Block, SteamshipError
-from typing import List
+from steamship import Block
+from typing import List, Optional
 import logging
 
+from context_window import ContextWindow
+from metrics import prompt_tokens, retained_blocks, time_stage
+from tokenizer import DEFAULT_ENCODING, block_token_counts
+
 
 def block_role(block: Block) -> RoleTag:
 	for tag in block.tags:
@@ -11,48 +14,24 @@ def block_role(block: Block) -> RoleTag:
 			return RoleTag(tag.name)
 
 
-def token_length(block: Block) -> int:
-	"""Calculate num tokens with tiktoken package."""
-	encoder = "p50k_base"
-	# create a GPT-3 encoder instance
-	enc = tiktoken.get_encoding(encoder)
-	# encode the text using the GPT-3 encoder
-	tokenized_text = enc.encode(block.text)
-	# calculate the number of tokens in the encoded text
-	return len(tokenized_text)
-
-
-def filter_blocks_for_prompt_length(max_tokens: int, blocks: List[Block]) -> List[int]:
-
-	retained_blocks = []
-	total_length = 0
-
-	# Keep all system blocks
-	for block in blocks:
-		if block_role(block) == RoleTag.SYSTEM:
-			retained_blocks.append(block)
-			total_length += token_length(block)
-
-	# If system blocks are too long, throw error
-	if total_length > max_tokens:
-		raise SteamshipError(
-			f"Plugin attempted to filter input to fit into {max_tokens} tokens, but the total size of system blocks was {total_length}")
-
-	# Now work backwards and keep as many blocks as we can
-	num_system_blocks = len(retained_blocks)
-	for block in reversed(blocks):
-		if block_role(block) != RoleTag.SYSTEM and total_length < max_tokens:
-			block_length = token_length(block)
-			if block_length + total_length < max_tokens:
-				retained_blocks.append(block)
-				total_length += block_length
-				logging.info(f"Adding block {block.index_in_file} of token length {block_length}")
-
-	# If we didn't add any non-system blocks, throw error
-	if len(retained_blocks) == num_system_blocks:
-		raise SteamshipError(
-			f"Plugin attempted to filter input to fit into {max_tokens} tokens, but no non-System blocks remained.")
-
-	block_indices = [block.index_in_file for block in blocks if block in retained_blocks]
-	logging.info(f"Filtered input.  Total tokens {total_length} Block indices: {block_indices}")
-	return block_indices
\ No newline at end of file
+def token_length(block: Block, encoding_name: str = DEFAULT_ENCODING) -> int:
+	"""Calculate num tokens with tiktoken package, reusing the block's cached or tagged count."""
+	return block_token_counts([block], encoding_name)[0]
+
+
+def filter_blocks_for_prompt_length(max_tokens: int, blocks: List[Block], encoding_name: str = DEFAULT_ENCODING, window: Optional[ContextWindow] = None) -> List[int]:
+	"""Keep all system blocks plus the newest run of other blocks that fits in max_tokens.
+
+	Pass the chat's persistent `window` to make repeated calls incremental; without one, a throwaway
+	window is built, which is still linear in the number of blocks. A ChatMemory passed as `window`
+	selects by relevance instead (see memory.py).
+	"""
+	if window is None:
+		window = ContextWindow(encoding_name)
+	with time_stage("select_prompt_window"):
+		block_indices = window.fit(blocks, max_tokens)
+	total_tokens = window.token_total(block_indices)
+	prompt_tokens.observe(total_tokens)
+	retained_blocks.observe(len(block_indices))
+	logging.info(f"Filtered input.  Total tokens {total_tokens} Block indices: {block_indices}")
+	return block_indices
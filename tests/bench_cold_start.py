@@ -0,0 +1,69 @@
+"""Cold-start benchmark: time until the first reply's prompt is sized, with and without cached BPE files.
+
+Each run happens in a fresh interpreter so nothing is shared between them:
+
+    python tests/bench_cold_start.py [--warm-cache-dir src/tiktoken_cache] [--runs 3]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+SRC = Path(__file__).parent.parent / "src"
+
+# Runs in the child interpreter. Importing the package modules is part of what we measure.
+CHILD = """
+import json, time
+t0 = time.perf_counter()
+from steamship import Block, Tag
+from steamship.data.tags.tag_constants import TagKind, RoleTag
+from util import filter_blocks_for_prompt_length
+blocks = [Block(text="Your name is buddy. Your personality is happy.", index_in_file=0,
+                tags=[Tag(kind=TagKind.ROLE, name=RoleTag.SYSTEM)]),
+          Block(text="Hi there!", index_in_file=1, tags=[Tag(kind=TagKind.ROLE, name=RoleTag.USER)])]
+filter_blocks_for_prompt_length(3000, blocks)
+print(json.dumps({"seconds": time.perf_counter() - t0}))
+"""
+
+
+def time_first_reply(cache_dir: str) -> float:
+    env = {**os.environ, "PYTHONPATH": str(SRC), "TIKTOKEN_CACHE_DIR": cache_dir}
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD], env=env, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])["seconds"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--warm-cache-dir", default=str(SRC / "tiktoken_cache"))
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    results = {}
+    for label in ("cold", "warm"):
+        timings = []
+        for _ in range(args.runs):
+            try:
+                if label == "cold":
+                    with tempfile.TemporaryDirectory() as empty_cache:
+                        timings.append(time_first_reply(empty_cache))
+                else:
+                    timings.append(time_first_reply(args.warm_cache_dir))
+            except subprocess.CalledProcessError as e:
+                print(f"{label}: run failed ({e.stderr.strip().splitlines()[-1]})")
+                break
+        if timings:
+            results[label] = statistics.median(timings)
+            print(f"{label}: median {results[label] * 1000:.1f} ms over {len(timings)} runs")
+
+    if "cold" in results and "warm" in results:
+        print(f"Bundled BPE files save {(results['cold'] - results['warm']) * 1000:.1f} ms on the first reply")
+
+
+if __name__ == "__main__":
+    main()
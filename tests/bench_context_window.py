@@ -0,0 +1,53 @@
+"""Microbenchmark: context-window selection time as a chat grows.
+
+Compares a cold selection over the whole history with the incremental path used by TelegramBuddy, where
+the chat's ContextWindow is reused and one message is appended between selections:
+
+    PYTHONPATH=src python tests/bench_context_window.py
+"""
+import time
+
+from steamship import Block, Tag
+from steamship.data.tags.tag_constants import RoleTag, TagKind
+
+from context_window import ContextWindow
+from tokenizer import DEFAULT_ENCODING, token_count_tag
+
+MAX_TOKENS = 3841
+SIZES = [100, 1_000, 10_000, 50_000]
+APPENDS = 200
+
+
+def make_block(i: int) -> Block:
+    role = RoleTag.SYSTEM if i == 0 else (RoleTag.USER if i % 2 else RoleTag.ASSISTANT)
+    return Block(
+        id=f"block-{i}",
+        text="lorem ipsum",
+        index_in_file=i,
+        tags=[Tag(kind=TagKind.ROLE, name=role), token_count_tag(20 + i % 37, DEFAULT_ENCODING)],
+    )
+
+
+def main():
+    print(f"{'blocks':>8} {'cold select (ms)':>18} {'incremental select (us)':>24}")
+    for size in SIZES:
+        blocks = [make_block(i) for i in range(size + APPENDS)]
+
+        t0 = time.perf_counter()
+        ContextWindow().fit(blocks[:size], MAX_TOKENS)
+        cold_ms = (time.perf_counter() - t0) * 1000
+
+        window = ContextWindow()
+        history = blocks[:size]
+        window.fit(history, MAX_TOKENS)
+        t0 = time.perf_counter()
+        for block in blocks[size:]:
+            history.append(block)
+            window.fit(history, MAX_TOKENS)
+        incremental_us = (time.perf_counter() - t0) / APPENDS * 1e6
+
+        print(f"{size:>8} {cold_ms:>18.2f} {incremental_us:>24.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Offline benchmark of TelegramBuddy.create_response against an in-memory Steamship engine.
+
+Synthetic chats with `--history` prior turns each receive `--messages` new messages, with `--concurrency`
+chats handled at once. The LLM is a fake with `--generate-latency-ms` of latency, so the numbers show the
+overhead of the package itself. Reports throughput and p50/p95/p99 latency per stage:
+
+    PYTHONPATH=src:tests python tests/bench_create_response.py --history 0,200,2000 --concurrency 1,8
+
+No network access is needed. Without the BPE files (`python src/tokenizer.py`, or point TIKTOKEN_CACHE_DIR at a
+directory that has them) tokens are counted with a fake encoder, so token counts are approximate.
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+from steamship.experimental.transports.chat import ChatMessage
+
+import api
+from chat_fixtures import make_bot, seed_chat, sentence
+from fake_steamship import FakeSteamship, use_fake_encoder_if_offline
+
+# Engine operations worth reporting as their own stage.
+ENGINE_STAGES = {"file/get": "engine file/get", "block/create": "engine block/create",
+                 "tag/create": "engine tag/create", "plugin/instance/generate": "llm generate"}
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class StageTimer:
+    """Collects wall times per named stage from any number of threads."""
+
+    def __init__(self):
+        self.seconds: Dict[str, List[float]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self.seconds[stage].append(seconds)
+
+    def wrap(self, stage: str, fn: Callable) -> Callable:
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return timed
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for stage, values in self.seconds.items():
+            values = sorted(values)
+            result[stage] = {"count": len(values),
+                             **{f"p{q}_ms": percentile(values, q / 100) * 1000 for q in (50, 95, 99)}}
+        return result
+
+
+def run_scenario(history: int, concurrency: int, chats: int, messages: int, generate_latency_s: float,
+                 tagged: bool = True) -> dict:
+    client = FakeSteamship(generate_latency_s=generate_latency_s)
+    bot = make_bot(client)
+    timer = StageTimer()
+
+    # Instance attributes shadow the methods, so internal calls are timed too.
+    bot.get_file_for_chat = timer.wrap("get_file_for_chat", bot.get_file_for_chat)
+    bot.append_user_message = timer.wrap("append_user_message", bot.append_user_message)
+    bot.generate_for_chat = timer.wrap("generate_for_chat", bot.generate_for_chat)
+    original_filter = api.filter_blocks_for_prompt_length
+    api.filter_blocks_for_prompt_length = timer.wrap("select_prompt_window", original_filter)
+
+    # Chat ids are fresh per scenario because the package's caches are process-wide.
+    prefix = uuid.uuid4().int % 10**9
+    chat_ids = [str(prefix * 1000 + n) for n in range(chats)]
+    for chat_id in chat_ids:
+        seed_chat(client, bot, chat_id, history, tagged)
+    client.op_seconds.clear()
+    client.calls.clear()
+
+    def converse(chat_id: str):
+        for n in range(messages):
+            message = ChatMessage(text=sentence(n + 1), chat_id=chat_id, message_id=str(history + 2 * n + 1))
+            start = time.perf_counter()
+            bot.create_response(message)
+            timer.record("create_response", time.perf_counter() - start)
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(converse, chat_ids))
+        elapsed = time.perf_counter() - start
+    finally:
+        api.filter_blocks_for_prompt_length = original_filter
+
+    for operation, stage in ENGINE_STAGES.items():
+        for seconds in client.op_seconds.get(operation, []):
+            timer.record(stage, seconds)
+    return {
+        "history": history,
+        "concurrency": concurrency,
+        "messages": chats * messages,
+        "seconds": elapsed,
+        "throughput_per_s": chats * messages / elapsed,
+        "engine_calls": dict(client.calls),
+        "stages": timer.summary(),
+    }
+
+
+def print_scenario(result: dict):
+    print(f"\nhistory={result['history']} concurrency={result['concurrency']}: {result['messages']} messages "
+          f"in {result['seconds']:.2f}s, {result['throughput_per_s']:.1f} msg/s")
+    print(f"  {'stage':<24} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for stage, stats in sorted(result["stages"].items()):
+        print(f"  {stage:<24} {stats['count']:>6} {stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} "
+              f"{stats['p99_ms']:>9.2f}")
+
+
+def int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history", type=int_list, default=[0, 200, 2000], help="prior turns per chat")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 8], help="chats handled at once")
+    parser.add_argument("--chats", type=int, default=16)
+    parser.add_argument("--messages", type=int, default=10, help="new messages per chat")
+    parser.add_argument("--generate-latency-ms", type=float, default=50.0)
+    parser.add_argument("--untagged", action="store_true", help="seed history without token_count tags")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    if use_fake_encoder_if_offline(make_bot(FakeSteamship()).encoding_name):
+        print("BPE files are not available offline; counting tokens with a fake encoder, so token counts are "
+              "approximate. Run `python src/tokenizer.py` once, or set TIKTOKEN_CACHE_DIR, for exact counts.")
+
+    results = []
+    for history in args.history:
+        for concurrency in args.concurrency:
+            result = run_scenario(history, concurrency, args.chats, args.messages,
+                                  args.generate_latency_ms / 1000, tagged=not args.untagged)
+            print_scenario(result)
+            results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Benchmark: recency-only prompts versus relevance-based memory prompts on long synthetic chats.
+
+Each chat mentions a few personal facts early on and then talks about other things. At the end the user asks
+about each fact. For both selectors the benchmark reports the prompt size, the share of questions whose fact
+made it into the prompt (recall), and the selection time per message:
+
+    PYTHONPATH=src python tests/bench_memory.py --history 200,2000,10000
+
+Facts older than the newest `--max-turns` turns (memory_max_turns) cannot be recalled.
+"""
+import argparse
+import random
+import time
+import uuid
+from typing import List, Tuple
+
+from steamship import Block, Tag
+from steamship.data.tags.tag_constants import RoleTag, TagKind
+
+from context_window import ContextWindow
+from memory import DEFAULT_MAX_TURNS, ChatMemory, HashingEmbedder
+from tokenizer import DEFAULT_ENCODING, token_count_tag
+
+MAX_TOKENS = 3841
+
+FACTS: List[Tuple[str, str]] = [
+    ("My dog is called Biscuit and he is a beagle.", "What breed is my dog Biscuit again?"),
+    ("I work as a nurse at the children's hospital downtown.", "Do you remember which hospital I work at?"),
+    ("My sister Maria moved to Lisbon last spring.", "Which city did my sister Maria move to?"),
+    ("I am allergic to peanuts, so I avoid satay.", "What was I allergic to again?"),
+    ("My favourite band is Radiohead, I saw them twice.", "Which band did I say was my favourite?"),
+    ("I'm training for the Berlin marathon in September.", "Which marathon am I training for?"),
+]
+
+FILLER = ("weather coffee meeting train lunch movie weekend garden book rain traffic email project deadline "
+          "recipe pasta soup holiday beach mountain bike phone laptop series episode office colleague "
+          "neighbour shopping jacket shoes concert ticket cinema bakery bread cheese tea kettle").split()
+
+
+def make_block(text: str, role: RoleTag, index: int, chat: str) -> Block:
+    # Token counts come from tags, so the benchmark needs no BPE files
+    return Block(id=f"{chat}-{index}", text=text, index_in_file=index,
+                 tags=[Tag(kind=TagKind.ROLE, name=role), token_count_tag(len(text.split()) * 4 // 3 + 1, DEFAULT_ENCODING)])
+
+
+def filler_sentence(rng: random.Random) -> str:
+    return " ".join(rng.choice(FILLER) for _ in range(rng.randint(8, 20))) + "."
+
+
+def make_chat(history: int, seed: int = 0) -> Tuple[List[Block], List[Tuple[int, str]]]:
+    """A chat with `history` turns, the facts mentioned by the user in its first fifth.
+
+    Returns the blocks and, per fact, the index of the block stating it plus the question asking about it.
+    """
+    rng = random.Random(seed)
+    chat = uuid.uuid4().hex
+    blocks = [make_block("Your name is buddy. Your personality is happy.", RoleTag.SYSTEM, 0, chat)]
+    fact_turns = sorted(rng.sample(range(0, max(len(FACTS), history // 5), 2), len(FACTS)))
+    questions = []
+    for turn in range(history):
+        role = RoleTag.USER if turn % 2 == 0 else RoleTag.ASSISTANT
+        if turn in fact_turns:
+            statement, question = FACTS[fact_turns.index(turn)]
+            questions.append((len(blocks), question))
+            text = statement
+        else:
+            text = filler_sentence(rng)
+        blocks.append(make_block(text, role, len(blocks), chat))
+    return blocks, questions
+
+
+def ask(blocks: List[Block], question: str, selector, rng: random.Random) -> Tuple[List[int], float]:
+    """Append a question (and afterwards an answer) to the chat; returns the prompt selected for it."""
+    chat = blocks[0].id.split("-")[0]
+    blocks.append(make_block(question, RoleTag.USER, len(blocks), chat))
+    start = time.perf_counter()
+    selected = selector.fit(blocks, MAX_TOKENS)
+    seconds = time.perf_counter() - start
+    blocks.append(make_block(filler_sentence(rng), RoleTag.ASSISTANT, len(blocks), chat))
+    return selected, seconds
+
+
+def run(history: int, recent_turns: int = 6, top_k: int = 4, max_turns: int = DEFAULT_MAX_TURNS) -> dict:
+    results = {}
+    memory = ChatMemory(HashingEmbedder(), recent_turns=recent_turns, top_k=top_k, max_turns=max_turns)
+    for name, selector in [("recency", ContextWindow()), ("memory", memory)]:
+        blocks, questions = make_chat(history)
+        rng = random.Random(1)
+        start = time.perf_counter()
+        selector.fit(blocks, MAX_TOKENS)
+        cold_ms = (time.perf_counter() - start) * 1000
+        tokens, hits, seconds = [], 0, []
+        for fact_index, question in questions:
+            selected, elapsed = ask(blocks, question, selector, rng)
+            tokens.append(selector.token_total(selected))
+            hits += fact_index in selected
+            seconds.append(elapsed)
+        results[name] = {"prompt_tokens": sum(tokens) / len(tokens), "recall": hits / len(questions),
+                         "cold_ms": cold_ms, "select_us": sorted(seconds)[len(seconds) // 2] * 1e6}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history", type=lambda v: [int(x) for x in v.split(",") if x], default=[200, 2000, 10000])
+    parser.add_argument("--recent-turns", type=int, default=6)
+    parser.add_argument("--top-k", type=int, default=4)
+    parser.add_argument("--max-turns", type=int, default=DEFAULT_MAX_TURNS)
+    args = parser.parse_args()
+
+    print(f"{'turns':>7} {'selector':>9} {'prompt tokens':>14} {'recall':>7} {'cold ms':>9} {'select us':>10}")
+    for history in args.history:
+        for name, stats in run(history, args.recent_turns, args.top_k, args.max_turns).items():
+            print(f"{history:>7} {name:>9} {stats['prompt_tokens']:>14.0f} {stats['recall']:>7.0%} "
+                  f"{stats['cold_ms']:>9.1f} {stats['select_us']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
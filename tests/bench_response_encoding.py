@@ -0,0 +1,96 @@
+"""Benchmark: encoding large responses (multi-MB chat exports) in http_handler.
+
+Compares the previous path, which serialized the data to measure it with `sys.getsizeof` and serialized the
+whole response again to send it, with `encode_json` + `encode_result`, which serialize once and splice. Also
+times gzipping an oversized payload for the bucket upload. Reports CPU time and peak traced memory:
+
+    PYTHONPATH=src:tests python tests/bench_response_encoding.py --blocks 10000,50000
+"""
+import argparse
+import gzip
+import io
+import json
+import sys
+import time
+import tracemalloc
+from typing import Callable, List
+
+from http_handler import GZIP_CHUNK_BYTES, body_length, encode_json, encode_result
+
+WORDS = "the quick brown fox jumps over a lazy dog while telegram users chat about their day".split()
+
+
+def chat_export(num_blocks: int) -> dict:
+    """A response shaped like an exported chat File: blocks with text and a few tags each."""
+    blocks = []
+    for i in range(num_blocks):
+        text = " ".join(WORDS[(i * 7 + j * 3) % len(WORDS)] for j in range(40))
+        blocks.append({
+            "id": f"block-{i:08d}",
+            "index": i,
+            "text": text,
+            "tags": [
+                {"kind": "role", "name": "user" if i % 2 else "assistant"},
+                {"kind": "message_id", "name": str(i)},
+                {"kind": "token_count", "name": "cl100k_base", "value": {"number-value": 41}},
+            ],
+        })
+    return {"data": {"file": {"handle": "123456", "blocks": blocks}}, "status": None, "http": {"status": 200}}
+
+
+def previous_path(result: dict) -> int:
+    data = json.dumps(result.get("data", None)).encode("UTF-8")
+    sys.getsizeof(data)
+    return len(json.dumps(result).encode("UTF-8"))
+
+
+def single_pass(result: dict) -> int:
+    data = encode_json(result.get("data", None))
+    len(data)
+    return body_length(encode_result(result, data))
+
+
+def gzip_upload_buffer(result: dict) -> int:
+    data = encode_json(result.get("data", None))
+    buffer = io.BytesIO()
+    view = memoryview(data)
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=6) as compressor:
+        for start in range(0, len(view), GZIP_CHUNK_BYTES):
+            compressor.write(view[start:start + GZIP_CHUNK_BYTES])
+    return buffer.tell()
+
+
+def measure(fn: Callable[[dict], int], result: dict, repeats: int):
+    """Best-of-`repeats` CPU time and the peak memory allocated while running `fn` once."""
+    times = []
+    for _ in range(repeats):
+        start = time.process_time()
+        size = fn(result)
+        times.append(time.process_time() - start)
+    tracemalloc.start()
+    fn(result)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size, min(times), peak
+
+
+def int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--blocks", type=int_list, default=[10_000, 50_000], help="blocks per exported chat")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'blocks':>8} {'path':<16} {'bytes':>12} {'cpu ms':>9} {'peak MB':>9}")
+    for num_blocks in args.blocks:
+        result = chat_export(num_blocks)
+        for label, fn in (("previous", previous_path), ("single pass", single_pass), ("gzip upload", gzip_upload_buffer)):
+            size, cpu, peak = measure(fn, result, args.repeats)
+            print(f"{num_blocks:>8} {label:<16} {size:>12} {cpu * 1000:>9.1f} {peak / 1e6:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
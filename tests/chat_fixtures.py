@@ -0,0 +1,39 @@
+"""Bots and seeded chats on an in-memory Steamship engine, shared by the tests and the offline benchmarks."""
+from steamship import Block, File, Tag
+from steamship.data.tags.tag_constants import RoleTag, TagKind
+from steamship.invocable import InvocationContext
+
+import api
+from fake_steamship import FakeSteamship
+from message_index import MESSAGE_ID_TAG_KIND
+from tokenizer import count_tokens, token_count_tag
+
+WORDS = "the quick brown fox jumps over a lazy dog while telegram users chat about their day".split()
+
+
+def sentence(rng_seed: int, length: int = 12) -> str:
+    return " ".join(WORDS[(rng_seed * 7 + i * 3) % len(WORDS)] for i in range(length))
+
+
+def seed_chat(client: FakeSteamship, bot: api.TelegramBuddy, chat_id: str, history: int, tagged: bool):
+    """Create a chat File with `history` prior turns, as an older deployment would have left it."""
+    system_prompt = f"Your name is {bot.config.bot_name}. Your personality is {bot.config.bot_personality}."
+    blocks = [Block(text=system_prompt, tags=[Tag(kind=TagKind.ROLE, name=RoleTag.SYSTEM)])]
+    for i in range(history):
+        text = sentence(i)
+        tags = [Tag(kind=TagKind.ROLE, name=RoleTag.USER if i % 2 == 0 else RoleTag.ASSISTANT)]
+        if i % 2 == 0:
+            tags.append(Tag(kind=MESSAGE_ID_TAG_KIND, name=str(i)))
+        if tagged:
+            tags.append(token_count_tag(count_tokens(text, bot.encoding_name), bot.encoding_name))
+        blocks.append(Block(text=text, tags=tags))
+    File.create(client, handle=chat_id, blocks=blocks)
+
+
+def make_bot(client: FakeSteamship, **config) -> api.TelegramBuddy:
+    return api.TelegramBuddy(
+        client=client,
+        config={"bot_name": "buddy", "bot_personality": "happy", "bot_token": "offline", **config},
+        context=InvocationContext(invocable_url="http://localhost/", invocable_handle="telegram-buddy",
+                                  invocable_instance_handle="telegram-buddy-bench"),
+    )
@@ -0,0 +1,12 @@
+"""Shared fixtures. Every test tokenizes with FakeEncoder, so the suite never needs tiktoken's BPE files."""
+import pytest
+
+from fake_steamship import FakeEncoder
+from tokenizer import DEFAULT_ENCODING, register_encoder
+
+
+@pytest.fixture(autouse=True, scope="session")
+def offline_encoder() -> FakeEncoder:
+    encoder = FakeEncoder(DEFAULT_ENCODING)
+    register_encoder(DEFAULT_ENCODING, encoder)
+    return encoder
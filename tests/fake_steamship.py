@@ -0,0 +1,298 @@
+"""In-memory stand-in for the Steamship engine, so the package can be exercised without a network."""
+import re
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter, defaultdict
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from pydantic import BaseModel, PrivateAttr
+
+from steamship import Steamship, SteamshipError, Task
+from steamship.base import Configuration
+from steamship.base.tasks import TaskState
+from steamship.data.operations.generator import GenerateResponse
+
+from tokenizer import get_encoder, register_encoder
+
+
+class FakeEncoder:
+    """Deterministic stand-in for a tiktoken Encoding that needs no BPE files: one token per word or
+    punctuation mark, each mapped to a stable id."""
+
+    _TOKEN = re.compile(r"\w+|[^\w\s]")
+
+    def __init__(self, name: str = "cl100k_base"):
+        self.name = name
+
+    def encode(self, text: str, **kwargs) -> List[int]:
+        return [zlib.crc32(token.encode("utf-8")) for token in self._TOKEN.findall(text)]
+
+    def encode_batch(self, texts: List[str], **kwargs) -> List[List[int]]:
+        return [self.encode(text) for text in texts]
+
+
+def use_fake_encoder_if_offline(encoding_name: str = "cl100k_base") -> bool:
+    """Register a FakeEncoder for `encoding_name` if tiktoken cannot load its BPE files. Returns whether it did."""
+    try:
+        get_encoder(encoding_name)
+        return False
+    except Exception:
+        register_encoder(encoding_name, FakeEncoder(encoding_name))
+        return True
+
+
+def echo_generator(prompt: List[dict]) -> str:
+    """Default fake LLM: answer with a short acknowledgement of the last prompt block."""
+    return f"You said: {prompt[-1]['text'][:80]}" if prompt else "Hello!"
+
+
+class FakeSteamship(Steamship):
+    """A Steamship client whose engine lives in this process.
+
+    Files, Blocks, Tags and the generator plugin are simulated with dicts so that the package code runs
+    unchanged against it. `generate_latency_s` simulates the LLM call; it may be a function of the plugin
+    instance config, e.g. to make one model slower than another. With `background_tasks`, generate returns a
+    running Task that completes on a thread and is observed through task/status, like the real engine.
+    """
+
+    _lock: Any = PrivateAttr()
+    _files: Dict[str, dict] = PrivateAttr()
+    _handles: Dict[str, str] = PrivateAttr()
+    _instances: Dict[str, dict] = PrivateAttr()
+    _calls: Counter = PrivateAttr()
+    _op_seconds: Dict[str, List[float]] = PrivateAttr()
+    _generate_latency_s: Union[float, Callable[[dict], float]] = PrivateAttr()
+    _generator: Callable[[List[dict]], str] = PrivateAttr()
+    _background_tasks: bool = PrivateAttr()
+    _tasks: Dict[str, dict] = PrivateAttr()
+
+    def __init__(
+        self,
+        generate_latency_s: Union[float, Callable[[dict], float]] = 0.0,
+        generator: Optional[Callable[[List[dict]], str]] = None,
+        background_tasks: bool = False,
+    ):
+        # Each fake is its own engine, so warm plugin instances are never shared between two of them
+        super().__init__(
+            config=Configuration(api_key="fake", workspace_handle="fake",
+                                 workspace_id=f"fake-workspace-{uuid.uuid4().hex}"),
+            trust_workspace_config=True,
+        )
+        self._lock = threading.RLock()
+        self._files = {}
+        self._handles = {}
+        self._instances = {}
+        self._calls = Counter()
+        self._op_seconds = defaultdict(list)
+        self._generate_latency_s = generate_latency_s
+        self._generator = generator or echo_generator
+        self._background_tasks = background_tasks
+        self._tasks = {}
+
+    @property
+    def calls(self) -> Counter:
+        """Number of engine calls made, by operation (e.g. "file/get")."""
+        return self._calls
+
+    @property
+    def op_seconds(self) -> Dict[str, List[float]]:
+        """Wall time of every engine call, by operation."""
+        return self._op_seconds
+
+    def call(self, verb, operation: str, payload=None, expect=None, **kwargs):
+        if isinstance(payload, BaseModel):
+            payload = payload.dict(by_alias=True)
+        payload = payload or {}
+        self._calls[operation] += 1
+        handler = getattr(self, "_op_" + operation.replace("/", "_"), None)
+        if handler is None:
+            raise SteamshipError(message=f"FakeSteamship does not implement {operation}")
+        start = time.perf_counter()
+        try:
+            data = handler(payload)
+        finally:
+            self._op_seconds[operation].append(time.perf_counter() - start)
+        if isinstance(data, Task):
+            return data
+        if expect is not None and issubclass(expect, BaseModel):
+            return expect.parse_obj(self._add_client_to_response(expect, data))
+        return data
+
+    # Files and blocks
+
+    def _file(self, payload: dict) -> dict:
+        file_id = payload.get("id") or self._handles.get(payload.get("handle"))
+        if file_id is None or file_id not in self._files:
+            raise SteamshipError(message=f"File not found: {payload}")
+        return self._files[file_id]
+
+    @staticmethod
+    def _copy(obj: Any) -> Any:
+        if isinstance(obj, dict):
+            return {k: FakeSteamship._copy(v) for k, v in obj.items()}
+        if isinstance(obj, list):
+            return [FakeSteamship._copy(v) for v in obj]
+        return obj
+
+    def _new_block(self, file: dict, text: str, tags: List[dict]) -> dict:
+        block_id = str(uuid.uuid4())
+        block = {
+            "id": block_id,
+            "fileId": file["id"],
+            "text": text,
+            "index": len(file["blocks"]),
+            "tags": [
+                {**tag, "id": str(uuid.uuid4()), "fileId": file["id"], "blockId": block_id}
+                for tag in tags or []
+            ],
+        }
+        file["blocks"].append(block)
+        return block
+
+    def _op_file_get(self, payload: dict) -> dict:
+        with self._lock:
+            return self._copy(self._file(payload))
+
+    def _op_file_create(self, payload: dict) -> dict:
+        with self._lock:
+            handle = payload.get("handle")
+            if handle in self._handles:
+                raise SteamshipError(message=f"File with handle {handle} already exists")
+            file = {"id": str(uuid.uuid4()), "handle": handle, "blocks": [], "tags": payload.get("tags") or []}
+            self._files[file["id"]] = file
+            if handle is not None:
+                self._handles[handle] = file["id"]
+            for block in payload.get("blocks") or []:
+                self._new_block(file, block.get("text"), block.get("tags"))
+            return self._copy(file)
+
+    def _op_file_delete(self, payload: dict) -> dict:
+        with self._lock:
+            file = self._file(payload)
+            del self._files[file["id"]]
+            self._handles.pop(file.get("handle"), None)
+            return self._copy(file)
+
+    def _op_file_list(self, payload: dict) -> dict:
+        with self._lock:
+            files = sorted(self._files.values(), key=lambda f: f["id"])
+            start = int(payload.get("pageToken") or 0)
+            size = payload.get("pageSize") or 100
+            page = files[start:start + size]
+            next_token = str(start + size) if start + size < len(files) else None
+            return {"files": [self._copy({**f, "blocks": []}) for f in page], "nextPageToken": next_token}
+
+    def _op_file_query(self, payload: dict) -> dict:
+        # Only the `filetag and kind "..." and name "..."` form the package uses
+        match = re.fullmatch(r'filetag and kind "([^"]*)" and name "([^"]*)"', payload.get("tagFilterQuery") or "")
+        if match is None:
+            raise SteamshipError(message=f"FakeSteamship cannot run query {payload.get('tagFilterQuery')!r}")
+        kind, name = match.groups()
+        with self._lock:
+            files = [f for f in self._files.values()
+                     if any(tag.get("kind") == kind and tag.get("name") == name for tag in f["tags"])]
+            return {"files": [self._copy({**f, "blocks": []}) for f in files]}
+
+    def _op_block_create(self, payload: dict) -> dict:
+        with self._lock:
+            file = self._file({"id": payload.get("fileId")})
+            return self._copy(self._new_block(file, payload.get("text"), payload.get("tags")))
+
+    def _op_block_delete(self, payload: dict) -> dict:
+        with self._lock:
+            for file in self._files.values():
+                for position, block in enumerate(file["blocks"]):
+                    if block["id"] == payload.get("id"):
+                        del file["blocks"][position]
+                        # Block indices stay positional, which generate's block index lists rely on here
+                        for later in file["blocks"][position:]:
+                            later["index"] -= 1
+                        return self._copy(block)
+            raise SteamshipError(message=f"Block not found: {payload}")
+
+    def _op_tag_create(self, payload: dict) -> dict:
+        with self._lock:
+            tag = {**payload, "id": str(uuid.uuid4())}
+            file = self._file({"id": payload.get("fileId")})
+            if payload.get("blockId"):
+                block = next(b for b in file["blocks"] if b["id"] == payload["blockId"])
+                block["tags"].append(tag)
+            else:
+                file["tags"].append(tag)
+            return self._copy(tag)
+
+    # Plugins
+
+    def _op_plugin_instance_create(self, payload: dict) -> dict:
+        with self._lock:
+            handle = payload.get("handle") or str(uuid.uuid4())
+            if handle not in self._instances:
+                self._instances[handle] = {
+                    "id": str(uuid.uuid4()),
+                    "handle": handle,
+                    "pluginHandle": payload.get("pluginHandle"),
+                    "config": {"max_tokens": 256, **(payload.get("config") or {})},
+                }
+            return self._copy(self._instances[handle])
+
+    def _op_plugin_instance_get(self, payload: dict) -> dict:
+        with self._lock:
+            return self._copy(self._instances[payload.get("handle")])
+
+    def _op_plugin_instance_generate(self, payload: dict) -> Task:
+        with self._lock:
+            if payload.get("inputFileId"):
+                file = self._file({"id": payload["inputFileId"]})
+                indices = payload.get("inputFileBlockIndexList")
+                if indices is None:
+                    indices = range(len(file["blocks"]))
+                prompt = [self._copy(file["blocks"][i]) for i in indices]
+            else:
+                prompt = [{"text": payload.get("text") or "", "tags": []}]
+            instance = self._instances.get(payload.get("pluginInstance")) or {}
+        latency = self._generate_latency_s
+        if callable(latency):
+            latency = latency(instance.get("config") or {})
+
+        task_id = str(uuid.uuid4())
+        if not self._background_tasks:
+            output = self._run_generation(payload, prompt, latency)
+            return Task(client=self, task_id=task_id, state=TaskState.succeeded, output=output)
+
+        def run():
+            try:
+                self._tasks[task_id] = {"state": TaskState.succeeded,
+                                        "output": self._run_generation(payload, prompt, latency)}
+            except Exception as e:
+                self._tasks[task_id] = {"state": TaskState.failed, "status_message": str(e)}
+
+        self._tasks[task_id] = {"state": TaskState.running}
+        threading.Thread(target=run, daemon=True).start()
+        return Task(client=self, task_id=task_id, state=TaskState.running, expect=GenerateResponse)
+
+    def _run_generation(self, payload: dict, prompt: List[dict], latency: float) -> GenerateResponse:
+        if latency:
+            time.sleep(latency)
+        text = self._generator(prompt)
+        with self._lock:
+            if payload.get("appendOutputToFile") and payload.get("outputFileId"):
+                file = self._file({"id": payload["outputFileId"]})
+                block = self._new_block(
+                    file, text, [{"kind": "role", "name": "assistant"}]
+                )
+            else:
+                block = {"text": text, "tags": [{"kind": "role", "name": "assistant"}]}
+            return GenerateResponse.parse_obj(
+                self._add_client_to_response(GenerateResponse, {"blocks": [self._copy(block)]})
+            )
+
+    # Tasks
+
+    def _op_task_status(self, payload: dict) -> Task:
+        task_id = payload.get("taskId")
+        task = self._tasks.get(task_id)
+        if task is None:
+            raise SteamshipError(message=f"Task not found: {task_id}")
+        return Task(client=self, task_id=task_id, **task)
@@ -0,0 +1,97 @@
+"""A local stand-in for the Telegram Bot API, recording what the bot sends instead of delivering it.
+
+    telegram = FakeTelegram().start()
+    bot.api_root = bot.telegram_transport.api_root = telegram.api_root("token")
+"""
+import itertools
+import json
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qsl, urlparse
+
+
+class FakeTelegram:
+    """Answers every Bot API method with `ok`. `latency_s` delays each answer; `respond` can override one
+    by returning `(status, body)` for a `(method, params)` pair, e.g. to simulate 429s."""
+
+    def __init__(self, latency_s: float = 0.0,
+                 respond: Optional[Callable[[str, dict], Optional[tuple]]] = None, username: str = "buddy_bot"):
+        self.latency_s = latency_s
+        self.username = username
+        self.respond = respond
+        self.calls: Counter = Counter()
+        self.sent: Dict[int, List[str]] = defaultdict(list)
+        # Client (host, port) pairs seen, i.e. TCP connections opened to the server
+        self.connections = set()
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def api_root(self, bot_token: str = "offline") -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/bot{bot_token}"
+
+    def start(self) -> "FakeTelegram":
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, like the real Bot API
+            protocol_version = "HTTP/1.1"
+
+            def _handle(self, params: dict):
+                with fake._lock:
+                    fake.connections.add(self.client_address)
+                method = urlparse(self.path).path.rsplit("/", 1)[-1]
+                status, body = fake.handle(method, params)
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self._handle(dict(parse_qsl(urlparse(self.path).query)))
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                params = dict(parse_qsl(urlparse(self.path).query))
+                if self.headers.get("Content-Type", "").startswith("application/json") and raw:
+                    params.update(json.loads(raw))
+                elif raw:
+                    params.update(parse_qsl(raw.decode("utf-8")))
+                self._handle(params)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def handle(self, method: str, params: dict) -> tuple:
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        with self._lock:
+            self.calls[method] += 1
+        override = self.respond(method, params) if self.respond is not None else None
+        if override is not None:
+            return override
+        if method == "sendMessage":
+            with self._lock:
+                self.sent[int(params["chat_id"])].append(params.get("text"))
+                message_id = next(self._message_ids)
+            return 200, {"ok": True, "result": {"message_id": message_id, "chat": {"id": int(params["chat_id"])},
+                                                "text": params.get("text")}}
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "username": self.username}}
+        return 200, {"ok": True, "result": True}
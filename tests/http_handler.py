@@ -1,15 +1,18 @@
 """Attempts to mimic the lambda_handler class to create a handler that can be used with HTTP posts."""
 
+import gzip
 import importlib
 import inspect
 import json
 import logging
-import sys
 import traceback
 import uuid
 from http import HTTPStatus
 from os import environ
-from typing import Callable, Dict, Type
+from tempfile import SpooledTemporaryFile
+from typing import Callable, Dict, List, Optional, Type, Union
+
+import requests
 
 from fluent import asynchandler as fluenthandler
 from fluent.handler import FluentRecordFormatter
@@ -20,7 +23,11 @@ from steamship.client import Steamship
 from steamship.data.workspace import SignedUrl
 from steamship.invocable import Invocable, InvocableRequest, InvocableResponse, InvocationContext
 from steamship.invocable.lambda_handler import safely_find_invocable_class, encode_exception
-from steamship.utils.signed_urls import upload_to_signed_url
+from steamship.utils.signed_urls import apply_localstack_url_fix
+
+from client_registry import steamship_clients
+from profiling import RequestProfiler
+
 import json
 from typing import Optional
 import logging
@@ -85,11 +92,18 @@ def use_local(client: Steamship, package_class, context: Optional[InvocationCont
 
     return obj
 
+def create_local_invocable(client: Steamship, package_class, context: InvocationContext, config: Optional[dict] = None) -> Invocable:
+    """Construct and initialize the package once, so a long-running server can reuse it for every request."""
+    invocable = use_local(client, package_class, context=context, config=config)
+    invocable.instance_init()
+    return invocable
+
 def internal_handler(  # noqa: C901
     invocable_cls_func: Callable[[], Type[Invocable]],
     event: Dict,
     client: Steamship,
     invocation_context: InvocationContext,
+    invocable: Optional[Invocable] = None,
 ) -> InvocableResponse:
 
     try:
@@ -130,9 +144,9 @@ def internal_handler(  # noqa: C901
             )
 
     try:
-        print(f"Running __instance_init__:")
-        invocable = use_local(client, invocable_cls_func(), context=invocation_context, config=request.invocation.config)
-        invocable.instance_init()
+        if invocable is None:
+            print(f"Running __instance_init__:")
+            invocable = create_local_invocable(client, invocable_cls_func(), invocation_context, request.invocation.config)
         # invocable = invocable_cls_func()(
         #     client=client, config=request.invocation.config, context=invocation_context
         # )
@@ -171,7 +185,63 @@ def internal_handler(  # noqa: C901
         )
 
 
-def handler(bound_internal_handler, event: Dict, _: Dict = None) -> dict:  # noqa: C901
+# Responses whose data serializes to more than this are uploaded to a bucket instead of returned inline.
+RESPONSE_DATA_LIMIT_BYTES = 4_000_000
+# Compressed uploads stay in memory up to this size before spilling to a temporary file.
+UPLOAD_SPOOL_BYTES = 8 * 1024 * 1024
+GZIP_CHUNK_BYTES = 1024 * 1024
+
+# A JSON body as a list of chunks, so a large payload can be written out without concatenating it.
+EncodedBody = List[bytes]
+
+
+def encode_json(value) -> bytes:
+    """Serialize once with the C encoder; the length of the result is the real payload size."""
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def encode_result(result: dict, data: Optional[bytes]) -> EncodedBody:
+    """The JSON body for `result` with the already serialized `data` spliced in rather than encoded again."""
+    rest = encode_json({key: value for key, value in result.items() if key != "data"})
+    if data is None:
+        return [rest]
+    if rest == b"{}":
+        return [b'{"data":', data, b"}"]
+    return [b'{"data":', data, b",", rest[1:]]
+
+
+def body_length(body: EncodedBody) -> int:
+    return sum(len(chunk) for chunk in body)
+
+
+def upload_gzipped(url: str, data: bytes):
+    """Gzip `data` into a spooled buffer chunk by chunk and stream that to the signed URL.
+
+    Only the compressed copy is held besides `data` itself, and it spills to disk if it grows large.
+    """
+    url = apply_localstack_url_fix(url)
+    with SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES) as buffer:
+        view = memoryview(data)
+        with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=6) as compressor:
+            for start in range(0, len(view), GZIP_CHUNK_BYTES):
+                compressor.write(view[start:start + GZIP_CHUNK_BYTES])
+        logging.info(f"Uploading {len(data)} bytes gzipped to {buffer.tell()} bytes")
+        buffer.seek(0)
+        http_response = requests.put(
+            url, data=buffer, headers={"Content-Type": "application/octet-stream", "Content-Encoding": "gzip"}
+        )
+    # S3 returns 204 upon success; we include 200 here for safety.
+    if http_response.status_code not in [200, 204]:
+        raise SteamshipError(
+            message=f"Unable to upload data to signed URL. Status code: {http_response.status_code}. Status text: {http_response.text}"
+        )
+
+
+def handler(bound_internal_handler, event: Dict, _: Dict = None, encoded: bool = False) -> Union[dict, EncodedBody]:  # noqa: C901
+    """Handle one event. Returns the response dict, or with `encoded` its JSON body, serialized only once."""
+    def finish(result: dict) -> Union[dict, EncodedBody]:
+        return encode_result(result, encode_json(result["data"]) if "data" in result else None) if encoded else result
+
     logging_config = event.get("loggingConfig")
     logging_host = None
     logging_handler = None
@@ -189,10 +259,10 @@ def handler(bound_internal_handler, event: Dict, _: Dict = None) -> dict:  # noq
 
     invocation_context_dict = event.get("invocationContext")
     if invocation_context_dict is None:
-        return InvocableResponse.error(
+        return finish(InvocableResponse.error(
             code=HTTPStatus.INTERNAL_SERVER_ERROR,
             message="Plugin/App handler did not receive an invocation context.",
-        ).dict(by_alias=True)
+        ).dict(by_alias=True))
 
     invocation_context = InvocationContext.parse_obj(invocation_context_dict)
 
@@ -247,27 +317,28 @@ def handler(bound_internal_handler, event: Dict, _: Dict = None) -> dict:  # noq
         # class itself is limited to accepting `workspace` (`config.workspace_handle`) since that is the manner
         # of interaction ideal for developers.
         config = Configuration(**event.get("clientConfig", {}))
-        client = Steamship(config=config, trust_workspace_config=True)
+        # Reused across requests, with its open connections, rather than built again for each one
+        client = steamship_clients.client(config)
     except SteamshipError as se:
         logging.exception(se)
-        return InvocableResponse.from_obj(se).dict(by_alias=True)
+        return finish(InvocableResponse.from_obj(se).dict(by_alias=True))
     except Exception as ex:
         logging.exception(ex)
-        return InvocableResponse.error(
+        return finish(InvocableResponse.error(
             code=HTTPStatus.INTERNAL_SERVER_ERROR,
             message="Plugin/App handler was unable to create Steamship client.",
             exception=ex,
-        ).dict(by_alias=True)
+        ).dict(by_alias=True))
     logging.info(f"Localstack hostname: {environ.get('LOCALSTACK_HOSTNAME')}.")
     response = bound_internal_handler(event, client, invocation_context)
 
     result = response.dict(by_alias=True, exclude={"client"})
     # When created with data > 4MB, data is uploaded to a bucket.
-    # This is a very ugly way to get the deep size of this object
-    data = json.dumps(result.get("data", None)).encode("UTF-8")
-    data_size = sys.getsizeof(data)
+    # The payload is serialized exactly once; those bytes are measured, uploaded or spliced into the body.
+    data = encode_json(result.get("data", None))
+    data_size = len(data)
     logging.info(f"Response data size {data_size}")
-    if data_size > 4e6 and invocation_context.invocable_type == "plugin":
+    if data_size > RESPONSE_DATA_LIMIT_BYTES and invocation_context.invocable_type == "plugin":
         logging.info("Response data size >4MB, must upload to bucket")
 
         filepath = str(uuid.uuid4())
@@ -285,20 +356,25 @@ def handler(bound_internal_handler, event: Dict, _: Dict = None) -> dict:  # noq
 
         logging.info(f"Got signed url for writing: {signed_url}")
 
-        upload_to_signed_url(signed_url, data)
+        upload_gzipped(signed_url, data)
 
         # Now remove raw data and replace with bucket
         del result["data"]
+        data = None
         result["dataBucket"] = SignedUrl.Bucket.PLUGIN_DATA.value
         result["dataFilepath"] = filepath
 
     if logging_handler is not None:
         logging_handler.close()
 
-    return result
+    return encode_result(result, data) if encoded else result
 
 
-def create_safe_handler(known_invocable_for_testing: Type[Invocable] = None):
+def create_safe_handler(known_invocable_for_testing: Type[Invocable] = None, invocable: Optional[Invocable] = None, encoded: bool = False,
+                        profiler: Optional[RequestProfiler] = None):
+    """Build an event handler. With `invocable`, every event is served by that instance instead of a new one;
+    with `encoded`, the handler returns the serialized JSON body (see `handler`); with `profiler`, every
+    invocation is profiled (see `tests/profiling.py`)."""
     # Get the invocable class
     if known_invocable_for_testing is not None:
         invocable_getter = lambda: known_invocable_for_testing  # noqa: E731
@@ -306,7 +382,14 @@ def create_safe_handler(known_invocable_for_testing: Type[Invocable] = None):
         invocable_getter = safely_find_invocable_class
 
     bound_internal_handler = lambda event, client, context: internal_handler(  # noqa: E731
-        invocable_getter, event, client, context
+        invocable_getter, event, client, context, invocable
     )
-    return lambda event, context=None: handler(bound_internal_handler, event, context)
+    if profiler is not None:
+        # Decided once here, so handlers built without a profiler run exactly as before
+        unprofiled_handler = bound_internal_handler
+        bound_internal_handler = lambda event, client, context: profiler.run(  # noqa: E731
+            (event.get("invocation") or {}).get("invocationPath") or "request",
+            lambda: unprofiled_handler(event, client, context),
+        )
+    return lambda event, context=None: handler(bound_internal_handler, event, context, encoded)
 
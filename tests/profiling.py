@@ -0,0 +1,183 @@
+"""Opt-in per-request profiling for the local server.
+
+    httpd = serve_local(client, TelegramBuddy, context, config, profile_dir="profiles")
+
+Each request is profiled on its own, so while profiling is on, requests are handled one at a time. For request
+number N, `profile_dir` gets:
+
+- `N-<path>.collapsed`: sampled stacks in the collapsed format, for flamegraph.pl or speedscope
+- `N-<path>.prof` and `N-<path>.txt`: a cProfile dump and its top functions (`mode="cprofile"`)
+- `N-<path>.alloc.txt`: the lines that allocated the most memory that was still held when the request finished
+
+All samples also go into `all.collapsed`. `summary.txt` lists the requests, slowest stage first, and is rewritten
+after every request. Stage times come from the stages timed with `metrics.time_stage`.
+"""
+import cProfile
+import io
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, TypeVar
+
+from metrics import recording_stages
+
+T = TypeVar("T")
+
+MODES = ("sample", "cprofile")
+
+
+@dataclass
+class RequestProfile:
+    index: int
+    label: str
+    seconds: float
+    stages: Dict[str, float]
+    allocated_bytes: int
+    peak_bytes: int
+    files: List[str] = field(default_factory=list)
+
+    @property
+    def slowest_stage(self) -> str:
+        return max(self.stages, key=self.stages.get) if self.stages else "-"
+
+    @property
+    def slowest_stage_seconds(self) -> float:
+        # Requests without any timed stage sort by their total time
+        return max(self.stages.values()) if self.stages else self.seconds
+
+
+def frame_name(code) -> str:
+    return f"{Path(code.co_filename).stem}.{getattr(code, 'co_qualname', code.co_name)}".replace(";", ":")
+
+
+class StackSampler:
+    """Samples the stack of one thread every `interval_s` seconds from a background thread."""
+
+    def __init__(self, thread_id: int, interval_s: float):
+        self.thread_id = thread_id
+        self.interval_s = interval_s
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def __enter__(self) -> "StackSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                names.append(frame_name(frame.f_code))
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+
+class RequestProfiler:
+    """Profiles whole requests with a stack sampler (`mode="sample"`) or cProfile (`mode="cprofile"`), plus
+    tracemalloc when `trace_allocations` is set. Thread-safe; requests are serialized while profiling."""
+
+    def __init__(self, out_dir: str, mode: str = "sample", interval_s: float = 0.002,
+                 trace_allocations: bool = True, top_allocations: int = 25):
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiling mode {mode!r}; use one of {', '.join(MODES)}")
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.mode = mode
+        self.interval_s = interval_s
+        self.trace_allocations = trace_allocations
+        self.top_allocations = top_allocations
+        self.requests: List[RequestProfile] = []
+        self._lock = threading.Lock()
+
+    def run(self, label: str, fn: Callable[[], T]) -> T:
+        """Call `fn` under the profiler and write its profile, whether or not it raises."""
+        with self._lock:
+            index = len(self.requests) + 1
+            prefix = self.out_dir / f"{index:05d}-{re.sub(r'[^A-Za-z0-9_.-]+', '_', label).strip('_') or 'request'}"
+            # Tracing only for the length of the request, unless someone else already traces
+            started_tracing = self.trace_allocations and not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start(25)
+            before = tracemalloc.take_snapshot() if self.trace_allocations and not started_tracing else None
+            if self.trace_allocations:
+                tracemalloc.reset_peak()
+            start_bytes = tracemalloc.get_traced_memory()[0] if self.trace_allocations else 0
+            profiler = cProfile.Profile() if self.mode == "cprofile" else None
+            sampler = StackSampler(threading.get_ident(), self.interval_s) if self.mode == "sample" else None
+            started = time.perf_counter()
+            with recording_stages() as stages:
+                try:
+                    if sampler is not None:
+                        with sampler:
+                            return fn()
+                    return profiler.runcall(fn)
+                finally:
+                    seconds = time.perf_counter() - started
+                    current_bytes, peak_bytes = tracemalloc.get_traced_memory() if self.trace_allocations else (0, 0)
+                    profile = RequestProfile(
+                        index=index, label=label, seconds=seconds, stages=self._stage_totals(stages),
+                        allocated_bytes=current_bytes - start_bytes, peak_bytes=max(0, peak_bytes - start_bytes))
+                    if sampler is not None:
+                        profile.files.append(self._write_collapsed(prefix, sampler.stacks))
+                    if profiler is not None:
+                        profile.files.extend(self._write_cprofile(prefix, profiler))
+                    if self.trace_allocations:
+                        profile.files.append(self._write_allocations(prefix, before, tracemalloc.take_snapshot()))
+                    if started_tracing:
+                        tracemalloc.stop()
+                    self.requests.append(profile)
+                    self._write_summary()
+
+    @staticmethod
+    def _stage_totals(stages) -> Dict[str, float]:
+        totals: Dict[str, float] = {}
+        for stage, seconds in stages:
+            totals[stage] = totals.get(stage, 0.0) + seconds
+        return totals
+
+    def _write_collapsed(self, prefix: Path, stacks: Counter) -> str:
+        lines = [f"{stack} {count}\n" for stack, count in stacks.most_common()]
+        path = Path(f"{prefix}.collapsed")
+        path.write_text("".join(lines))
+        with open(self.out_dir / "all.collapsed", "a") as combined:
+            combined.writelines(lines)
+        return path.name
+
+    def _write_cprofile(self, prefix: Path, profiler: cProfile.Profile) -> List[str]:
+        dump, text = Path(f"{prefix}.prof"), Path(f"{prefix}.txt")
+        profiler.dump_stats(str(dump))
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(40)
+        text.write_text(out.getvalue())
+        return [dump.name, text.name]
+
+    def _write_allocations(self, prefix: Path, before: Optional[tracemalloc.Snapshot],
+                           after: tracemalloc.Snapshot) -> str:
+        # Leave out tracemalloc's own bookkeeping and this module
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        after = after.filter_traces(ignore)
+        stats = after.compare_to(before.filter_traces(ignore), "lineno") if before else after.statistics("lineno")
+        path = Path(f"{prefix}.alloc.txt")
+        path.write_text("".join(f"{stat}\n" for stat in stats[:self.top_allocations]))
+        return path.name
+
+    def _write_summary(self):
+        lines = [f"{'slowest stage':<24}{'stage s':>9}{'total s':>9}{'held KiB':>10}{'peak KiB':>10}  request\n"]
+        for profile in sorted(self.requests, key=lambda p: p.slowest_stage_seconds, reverse=True):
+            lines.append(f"{profile.slowest_stage:<24}{profile.slowest_stage_seconds:>9.3f}{profile.seconds:>9.3f}"
+                         f"{profile.allocated_bytes / 1024:>10.1f}{profile.peak_bytes / 1024:>10.1f}"
+                         f"  {profile.index:05d} {profile.label} ({', '.join(profile.files)})\n")
+        (self.out_dir / "summary.txt").write_text("".join(lines))
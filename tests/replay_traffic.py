@@ -0,0 +1,191 @@
+"""Replay captured Telegram webhook traffic against a locally hosted TelegramBuddy.
+
+Capture with the `capture_traffic_path` package config, or `serve_local(..., capture_path=...)`. The bot is
+served on localhost over HTTP, backed by an in-memory Steamship engine with a fake LLM and a fake Telegram
+Bot API, and the captured updates are posted to it on their original schedule sped up by `--speed`:
+
+    PYTHONPATH=src:tests python tests/replay_traffic.py capture.jsonl --speed 1,10,100
+
+Reports throughput, latency percentiles, how far sending fell behind the schedule, and duplicate handling:
+every distinct message should be answered exactly once, however often it was delivered. `--retry-rate`
+adds Telegram-style redeliveries on top of any in the capture. Configs that merge bursts (e.g.
+reply_debounce_ms) legitimately answer fewer messages than were sent.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+from steamship.invocable import InvocationContext
+
+import api
+from bench_create_response import percentile
+from fake_steamship import FakeSteamship, use_fake_encoder_if_offline
+from fake_telegram import FakeTelegram
+from traffic_capture import load_capture
+from utils import serve_local
+
+BOT_CONFIG = {"bot_name": "buddy", "bot_personality": "happy", "bot_token": "offline"}
+
+
+def local_bot_class(api_root: str):
+    """TelegramBuddy talking to `api_root` instead of the real Bot API."""
+
+    class LocalTelegramBuddy(api.TelegramBuddy):
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.api_root = self.telegram_transport.api_root = api_root
+
+    return LocalTelegramBuddy
+
+
+def serve_bot(client: FakeSteamship, telegram: FakeTelegram, config: Optional[dict] = None,
+              capture_path: Optional[str] = None, max_workers: int = 8):
+    """Start a local server for the bot on a free port; returns the server and its base URL."""
+    context = InvocationContext(invocable_url="http://localhost/", invocable_handle="telegram-buddy",
+                                invocable_instance_handle="telegram-buddy-replay")
+    httpd = serve_local(client, local_bot_class(telegram.api_root()), context, {**BOT_CONFIG, **(config or {})},
+                        port=0, max_workers=max_workers, capture_path=capture_path)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, f"http://127.0.0.1:{httpd.server_address[1]}"
+
+
+def with_retries(records: List[dict], retry_rate: float, seed: int = 0) -> List[dict]:
+    """Add redeliveries of a random `retry_rate` share of the updates, 1-5 seconds after the original."""
+    rng = random.Random(seed)
+    retries = [{**record, "t": record["t"] + rng.uniform(1, 5)} for record in records if rng.random() < retry_rate]
+    return sorted(records + retries, key=lambda record: record["t"])
+
+
+def relabel(body: dict, run: int) -> dict:
+    """Shift update and chat ids per run, since the package remembers which updates it has handled."""
+    if not run:
+        return body
+    shift = run * 10**13
+    body = {**body}
+    if isinstance(body.get("update_id"), int):
+        body["update_id"] += shift
+    message = body.get("message")
+    if isinstance(message, dict) and isinstance(message.get("chat", {}).get("id"), int):
+        chat_id = message["chat"]["id"]
+        body["message"] = {**message, "chat": {**message["chat"], "id": chat_id + shift if chat_id >= 0 else chat_id - shift}}
+    return body
+
+
+def expected_replies(bodies: List[dict]) -> Counter:
+    """Replies each chat should get: one per distinct text message."""
+    messages = {(body["message"]["chat"]["id"], body["message"]["message_id"])
+                for body in bodies if (body.get("message") or {}).get("text")}
+    return Counter(chat_id for chat_id, _ in messages)
+
+
+def run_replay(records: List[dict], speed: float, generate_latency_s: float = 0.05, concurrency: int = 64,
+               config: Optional[dict] = None, run: int = 0) -> dict:
+    client = FakeSteamship(generate_latency_s=generate_latency_s)
+    telegram = FakeTelegram().start()
+    httpd, base_url = serve_bot(client, telegram, config)
+    records = [record for record in records if record.get("path", "/respond").rstrip("/").endswith("respond")]
+    bodies = [relabel(record["body"], run) for record in records]
+    origin = records[0]["t"] if records else 0.0
+
+    latencies, lags, errors = [], [], Counter()
+    lock = threading.Lock()
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+    def post(body: dict, due: float):
+        sent = time.perf_counter()
+        try:
+            response = session.post(f"{base_url}/respond", json=body, timeout=120)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        with lock:
+            lags.append(sent - due)
+            latencies.append(time.perf_counter() - sent)
+            if not ok:
+                errors["http"] += 1
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for record, body in zip(records, bodies):
+                due = start + (record["t"] - origin) / speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(post, body, due)
+        elapsed = time.perf_counter() - start
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        telegram.stop()
+
+    expected = expected_replies(bodies)
+    replies = Counter({chat_id: len(texts) for chat_id, texts in telegram.sent.items()})
+    latencies.sort()
+    lags.sort()
+    return {
+        "speed": speed,
+        "requests": len(records),
+        "seconds": elapsed,
+        "throughput_per_s": len(records) / elapsed if elapsed else 0.0,
+        "latency_ms": {f"p{q}": percentile(latencies, q / 100) * 1000 for q in (50, 95, 99)},
+        "schedule_lag_ms": {f"p{q}": percentile(lags, q / 100) * 1000 for q in (50, 99)},
+        "errors": errors["http"],
+        "messages": sum(expected.values()),
+        "replies": sum(replies.values()),
+        "generations": client.calls["plugin/instance/generate"],
+        "duplicate_replies": sum(max(0, replies[chat_id] - expected[chat_id]) for chat_id in replies),
+        "missing_replies": sum(max(0, expected[chat_id] - replies[chat_id]) for chat_id in expected),
+    }
+
+
+def print_replay(result: dict):
+    print(f"\nspeed={result['speed']:g}x: {result['requests']} requests in {result['seconds']:.2f}s, "
+          f"{result['throughput_per_s']:.1f} req/s, {result['errors']} errors")
+    latency, lag = result["latency_ms"], result["schedule_lag_ms"]
+    print(f"  latency ms      p50 {latency['p50']:.1f}  p95 {latency['p95']:.1f}  p99 {latency['p99']:.1f}")
+    print(f"  behind schedule p50 {lag['p50']:.1f}  p99 {lag['p99']:.1f}")
+    print(f"  {result['messages']} distinct messages, {result['replies']} replies, {result['generations']} "
+          f"generations, {result['duplicate_replies']} duplicate and {result['missing_replies']} missing replies")
+
+
+def float_list(value: str) -> List[float]:
+    return [float(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", help="JSONL file written by a traffic capture")
+    parser.add_argument("--speed", type=float_list, default=[1, 10, 100], help="replay speed-ups")
+    parser.add_argument("--retry-rate", type=float, default=0.0, help="share of updates to deliver twice")
+    parser.add_argument("--concurrency", type=int, default=64, help="requests in flight at once")
+    parser.add_argument("--generate-latency-ms", type=float, default=50.0)
+    parser.add_argument("--config", type=json.loads, default={}, help="package config as JSON, e.g. '{\"async_replies\": true}'")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    if use_fake_encoder_if_offline():
+        print("BPE files are not available offline; counting tokens with a fake encoder, so token counts are "
+              "approximate. Run `python src/tokenizer.py` once, or set TIKTOKEN_CACHE_DIR, for exact counts.")
+
+    records = with_retries(load_capture(args.capture), args.retry_rate)
+    results = []
+    for run, speed in enumerate(args.speed):
+        result = run_replay(records, speed, args.generate_latency_ms / 1000, args.concurrency, args.config, run)
+        print_replay(result)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
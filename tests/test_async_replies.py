@@ -0,0 +1,49 @@
+"""Tests for replies generated in the background by generate_reply."""
+import uuid
+
+from steamship import File, Tag
+from steamship.data.tags.tag_constants import RoleTag, TagKind
+from steamship.experimental.transports.chat import ChatMessage
+
+from chat_fixtures import make_bot, seed_chat
+from chat_export import message_id_tag
+from fake_steamship import FakeSteamship
+
+
+def test_a_message_appended_by_another_worker_is_answered_not_skipped():
+    client = FakeSteamship()
+    bot = make_bot(client, async_replies=True)
+    sent = []
+    bot.telegram_transport.send = sent.extend
+    chat_id = str(uuid.uuid4().int % 10**9)
+    seed_chat(client, bot, chat_id, history=4, tagged=True)
+    bot.get_file_for_chat(chat_id)
+
+    # The webhook ran on another worker, so this process's cached File lacks the message
+    File.get(client, handle=chat_id).append_block(
+        text="are you there?", tags=[Tag(kind=TagKind.ROLE, name=RoleTag.USER), message_id_tag("5")])
+    bot.generate_reply(chat_id, "5")
+
+    assert [message.text for message in sent] == ["You said: are you there?"]
+    assert File.get(client, handle=chat_id).blocks[-1].text == "You said: are you there?"
+
+    # Once answered, a repeated invocation is skipped
+    bot.generate_reply(chat_id, "5")
+    assert len(sent) == 1
+
+
+def test_without_a_debounce_window_messages_sent_before_the_reply_share_it():
+    client = FakeSteamship()
+    bot = make_bot(client, async_replies=True)
+    scheduled, sent = [], []
+    bot.invoke_later = lambda method, arguments=None, **kwargs: scheduled.append(arguments)
+    bot.telegram_transport.send = sent.extend
+    chat_id = str(uuid.uuid4().int % 10**9)
+    seed_chat(client, bot, chat_id, history=4, tagged=True)
+
+    for message_id, text in (("5", "one"), ("7", "two")):
+        bot.create_response(ChatMessage(text=text, chat_id=chat_id, message_id=message_id))
+    for arguments in scheduled:
+        bot.generate_reply(**arguments)
+
+    assert [message.text for message in sent] == ["You said: two"]
@@ -0,0 +1,85 @@
+"""Tests for the paged NDJSON chat export."""
+import json
+import uuid
+
+from steamship import File
+from steamship.experimental.transports.chat import ChatMessage
+
+from chat_fixtures import make_bot, seed_chat
+from chat_export import ChatExporter, chat_id_of, decode_page_token
+from fake_steamship import FakeSteamship
+
+
+def new_chat_id() -> str:
+    return str(uuid.uuid4().int % 10**9)
+
+
+def export_page(bot, **kwargs):
+    response = bot.export_chats(**kwargs)
+    assert response.http.headers["Content-Type"] == "application/x-ndjson"
+    return [json.loads(line) for line in response.data.splitlines()]
+
+
+def test_segments_are_exported_once_in_order_with_stats():
+    client = FakeSteamship()
+    bot = make_bot(client, segment_max_blocks=10)
+    bot.invoke_later = lambda method, arguments=None, **kwargs: None
+    chat_id = new_chat_id()
+    seed_chat(client, bot, chat_id, history=10, tagged=True)
+    bot.roll_chat_segment(chat_id)
+    bot.create_response(ChatMessage(text="after the roll", chat_id=chat_id, message_id="100"))
+
+    records = export_page(bot, chat_ids=[chat_id])
+    blocks, (stats, page) = records[:-2], records[-2:]
+
+    assert [block["text"] for block in blocks[-2:]] == ["after the roll", "You said: after the roll"]
+    # Turns carried into the new segment are not repeated
+    assert len(blocks) == 11 + 2
+    assert blocks[-2]["role"] == "user" and blocks[-2]["message_id"] == "100"
+    assert stats == {"type": "chat", "chat_id": chat_id, "turns": 12, "user_turns": 6, "assistant_turns": 6,
+                     "tokens": sum(block["tokens"] for block in blocks), "blocks": 13, "files": 2,
+                     "last_activity": blocks[-2]["sent_at"]}
+    assert stats["last_activity"] is not None
+    assert page == {"type": "page", "chats": 1, "next_page_token": None}
+
+
+def test_pages_resume_where_the_last_one_stopped():
+    client = FakeSteamship()
+    bot = make_bot(client)
+    chat_ids = [new_chat_id() for _ in range(5)]
+    for chat_id in chat_ids:
+        seed_chat(client, bot, chat_id, history=4, tagged=False)
+    # Files that belong to a chat but are not its first segment are skipped
+    File.create(client, handle=f"{chat_ids[0]}-manifest", blocks=[])
+
+    exporter = ChatExporter(client, bot.encoding_name)
+    files, _ = exporter.list_chats(page_size=100)
+    assert sorted(chat_id_of(file) for file in files) == sorted(chat_ids)
+
+    seen, page_token, pages = [], None, 0
+    while True:
+        records = list(exporter.page(page_token=page_token, max_blocks=8))
+        seen += [record["chat_id"] for record in records if record["type"] == "chat"]
+        page_token = records[-1]["next_page_token"]
+        pages += 1
+        if page_token is None:
+            break
+        assert set(decode_page_token(page_token)) == {"list", "skip"}
+    assert sorted(seen) == sorted(chat_ids) and pages == 3
+
+
+def test_stats_only_export_reads_each_file_once():
+    client = FakeSteamship()
+    bot = make_bot(client)
+    chat_ids = [new_chat_id() for _ in range(3)]
+    for chat_id in chat_ids:
+        seed_chat(client, bot, chat_id, history=6, tagged=True)
+    client.calls.clear()
+
+    records = export_page(bot, chat_ids=chat_ids, include_blocks=False)
+
+    assert [record["type"] for record in records] == ["chat"] * 3 + ["page"]
+    assert [record["turns"] for record in records[:3]] == [6, 6, 6]
+    assert records[0]["last_activity"] is None
+    # Per chat: the manifest lookup and the chat File
+    assert client.calls["file/get"] == 6 and client.calls["file/query"] == 0
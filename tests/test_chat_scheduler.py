@@ -0,0 +1,69 @@
+"""Unit tests for per-chat serialization and burst coalescing."""
+from steamship import Block, File, Tag
+from steamship.data.tags.tag_constants import RoleTag, TagKind
+
+from chat_scheduler import ChatScheduler, is_awaiting_reply
+from message_index import MESSAGE_ID_TAG_KIND
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+def turn(role: RoleTag, message_id: str = None) -> Block:
+    tags = [Tag(kind=TagKind.ROLE, name=role)]
+    if message_id is not None:
+        tags.append(Tag(kind=MESSAGE_ID_TAG_KIND, name=message_id))
+    return Block(text="text", tags=tags)
+
+
+def test_only_the_last_message_of_a_burst_replies():
+    clock = FakeClock()
+    scheduler = ChatScheduler(clock=clock, sleep=clock.sleep)
+    first = scheduler.take_ticket("chat")
+    second = scheduler.take_ticket("chat")
+    other_chat = scheduler.take_ticket("other")
+
+    assert not scheduler.wait_for_quiet("chat", first, 1.0)
+    assert scheduler.wait_for_quiet("chat", second, 1.0)
+    assert scheduler.wait_for_quiet("other", other_chat, 1.0)
+
+
+def test_a_message_arriving_during_the_debounce_window_takes_over():
+    clock = FakeClock()
+    scheduler = ChatScheduler(clock=clock, sleep=clock.sleep)
+    first = scheduler.take_ticket("chat")
+
+    def sleep_then_receive(seconds: float):
+        clock.sleep(seconds)
+        if clock.now >= 0.5 and scheduler.is_latest("chat", first):
+            scheduler.take_ticket("chat")
+
+    scheduler.sleep = sleep_then_receive
+    assert not scheduler.wait_for_quiet("chat", first, 1.0)
+    assert clock.now < 1.0
+
+
+def test_lock_is_per_chat_and_survives_eviction_while_held():
+    scheduler = ChatScheduler(max_chats=1)
+    lock = scheduler.lock("busy")
+    with lock:
+        scheduler.lock("other")
+        assert scheduler.lock("busy") is lock
+    assert scheduler.lock("busy") is not scheduler.lock("other")
+
+
+def test_is_awaiting_reply_checks_newest_unanswered_user_turn():
+    file = File(blocks=[turn(RoleTag.SYSTEM), turn(RoleTag.USER, "1"), turn(RoleTag.USER, "2")])
+    assert is_awaiting_reply(file, "2")
+    assert not is_awaiting_reply(file, "1")
+
+    file.blocks.append(turn(RoleTag.ASSISTANT))
+    assert not is_awaiting_reply(file, "2")
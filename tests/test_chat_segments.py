@@ -0,0 +1,83 @@
+"""Tests for epoch-segmented chat storage."""
+import uuid
+
+from steamship import File
+from steamship.experimental.transports.chat import ChatMessage
+
+from chat_fixtures import make_bot, seed_chat
+from chat_cache import chat_files
+from chat_export import ChatExporter
+from chat_segments import (ChatManifest, closing_block_index, load_manifest, manifest_handle, manifests, roll_segment,
+                           segment_handle)
+from context_window import is_system_block
+from fake_steamship import FakeSteamship
+
+
+def test_manifest_defaults_to_the_legacy_chat_file_and_records_new_segments():
+    client = FakeSteamship()
+    chat_id = str(uuid.uuid4().int % 10**9)
+    manifest = load_manifest(client, chat_id)
+    assert manifest.epochs == [0] and manifest.current_handle == chat_id
+
+    File.create(client, handle=chat_id, blocks=[])
+    roll_segment(client, manifest, [])
+    roll_segment(client, manifest, [])
+
+    reloaded = load_manifest(client, chat_id)
+    assert reloaded.epochs == [0, 1, 2]
+    assert reloaded.segment_handles() == [chat_id, segment_handle(chat_id, 1), segment_handle(chat_id, 2)]
+    assert File.get(client, handle=manifest_handle(chat_id)).blocks == []
+    assert ChatManifest(chat_id, [2, 0, 1]).current_epoch == 2
+
+
+def test_long_chats_continue_in_a_new_segment_with_recent_turns():
+    client = FakeSteamship()
+    bot = make_bot(client, segment_max_blocks=20)
+    rolls = []
+    bot.invoke_later = lambda method, arguments=None, **kwargs: rolls.append(arguments["chat_id"])
+    chat_id = str(uuid.uuid4().int % 10**9)
+    seed_chat(client, bot, chat_id, history=30, tagged=True)
+
+    bot.create_response(ChatMessage(text="still there?", chat_id=chat_id, message_id="31"))
+    assert rolls == [chat_id]
+    bot.roll_chat_segment(chat_id)
+
+    segment = File.get(client, handle=segment_handle(chat_id, 1))
+    assert is_system_block(segment.blocks[0])
+    assert len(segment.blocks) == 1 + 10
+    assert [b.text for b in segment.blocks][-2:] == ["still there?", "You said: still there?"]
+    assert closing_block_index(File.get(client, handle=chat_id)) == 33
+
+    # New turns go to the new segment, and retried messages from before the roll are still recognized
+    chat_files.discard(chat_id)
+    client.calls.clear()
+    bot.create_response(ChatMessage(text="good", chat_id=chat_id, message_id="33"))
+    assert bot.create_response(ChatMessage(text="still there?", chat_id=chat_id, message_id="31")) is None
+    assert client.calls["file/get"] == 1
+    assert [b.text for b in File.get(client, handle=segment_handle(chat_id, 1)).blocks][-1] == "You said: good"
+
+
+def test_a_worker_with_a_stale_manifest_follows_a_roll_made_elsewhere():
+    client = FakeSteamship()
+    bot = make_bot(client, segment_max_blocks=50)
+    bot.invoke_later = lambda method, arguments=None, **kwargs: None
+    chat_id = str(uuid.uuid4().int % 10**9)
+    seed_chat(client, bot, chat_id, history=10, tagged=True)
+    bot.create_response(ChatMessage(text="before", chat_id=chat_id, message_id="11"))
+
+    # Another worker rolls the chat; this process still caches the old segment and manifest
+    old_segment = File.get(client, handle=chat_id)
+    roll_segment(client, load_manifest(client, chat_id), old_segment.blocks[:1], current=old_segment)
+    assert closing_block_index(File.get(client, handle=chat_id)) == 13
+
+    replies = bot.create_response(ChatMessage(text="after", chat_id=chat_id, message_id="13"))
+    assert [reply.text for reply in replies] == ["You said: after"]
+    assert manifests.get(chat_id).epochs == [0, 1]
+    assert [b.text for b in File.get(client, handle=segment_handle(chat_id, 1)).blocks][1:] == \
+           ["after", "You said: after"]
+
+    # The message that landed after the close marker is exported once, from the new segment
+    texts = [record["text"] for record in ChatExporter(client, bot.encoding_name).chat_records(chat_id)
+             if record["type"] == "block"]
+    assert texts[-4:] == ["before", "You said: before", "after", "You said: after"]
+    assert texts.count("after") == 1
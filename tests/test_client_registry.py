@@ -0,0 +1,81 @@
+"""Tests for the process-wide registry of warm clients and plugin instances."""
+import threading
+import time
+
+import pytest
+from steamship.base import Configuration
+from steamship.invocable import InvocationContext
+
+from client_registry import ClientRegistry
+from fake_steamship import FakeSteamship
+from fake_telegram import FakeTelegram
+from replay_traffic import BOT_CONFIG, local_bot_class
+
+
+def test_concurrent_misses_build_once_and_idle_entries_expire():
+    now = [0.0]
+    registry = ClientRegistry(ttl_s=60, clock=lambda: now[0])
+    builds = []
+
+    def build():
+        builds.append(1)
+        time.sleep(0.05)
+        return object()
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.get("k", build))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(builds) == 1 and len(set(map(id, results))) == 1
+
+    now[0] = 59
+    assert registry.get("k", build) is results[0]
+    now[0] = 118
+    assert registry.get("k", build) is results[0]
+    now[0] = 179
+    assert registry.get("k", build) is not results[0]
+    assert len(builds) == 2
+
+
+def test_failed_builds_are_not_cached_and_size_is_bounded():
+    registry = ClientRegistry(max_entries=2)
+
+    def fail():
+        raise RuntimeError("engine unavailable")
+
+    with pytest.raises(RuntimeError):
+        registry.get("k", fail)
+    assert registry.get("k", lambda: "ok") == "ok"
+    registry.get("a", lambda: 1)
+    registry.get("b", lambda: 2)
+    assert len(registry) == 2
+    assert registry.get("k", lambda: "rebuilt") == "rebuilt"
+
+
+def test_clients_are_shared_per_workspace():
+    registry = ClientRegistry()
+    config = dict(api_key="key", workspace_handle="ws", workspace_id="ws-id")
+    client = registry.client(Configuration(**config))
+    assert registry.client(Configuration(**config)) is client
+    assert registry.client(Configuration(**{**config, "workspace_id": "other"})) is not client
+
+
+def test_a_fresh_package_object_on_a_warm_worker_makes_no_setup_calls():
+    client = FakeSteamship()
+    telegram = FakeTelegram().start()
+    try:
+        # The engine builds a new package object for every invocation
+        for update_id in (84011, 84012):
+            bot = local_bot_class(telegram.api_root())(
+                client=client, config=BOT_CONFIG,
+                context=InvocationContext(invocable_url="http://localhost/", invocable_instance_handle="warm-test"))
+            bot.respond(update_id=update_id, message={"message_id": update_id, "text": f"hi {update_id}",
+                                                      "chat": {"id": 8401, "type": "private"}})
+            assert bot.get_gpt4().client is client
+    finally:
+        telegram.stop()
+    assert telegram.sent[8401] == ["You said: hi 84011", "You said: hi 84012"]
+    assert client.calls["plugin/instance/create"] == 1
+    assert client.calls["plugin/instance/generate"] == 2
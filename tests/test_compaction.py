@@ -0,0 +1,74 @@
+"""Tests for folding long chats into a summary."""
+import uuid
+
+from steamship import File
+from steamship.experimental.transports.chat import ChatMessage
+
+from chat_fixtures import make_bot, seed_chat
+from chat_segments import closing_block_index, load_manifest, segment_handle
+from compaction import is_summary_block
+from context_window import is_system_block
+from fake_steamship import FakeSteamship
+
+
+def new_chat_id() -> str:
+    return str(uuid.uuid4().int % 10**9)
+
+
+def say(bot, chat_id: str, message_id: int, text: str):
+    return bot.create_response(ChatMessage(text=text, chat_id=chat_id, message_id=str(message_id)))
+
+
+def test_a_reply_over_the_threshold_compacts_the_chat_inline_into_a_new_segment():
+    client = FakeSteamship()
+    bot = make_bot(client, summarize_after_tokens=150)
+    invoked = []
+
+    def invoke_later(method, arguments=None, **kwargs):
+        # Like the local development server, which runs background invocations inline
+        invoked.append(method)
+        return getattr(bot, method)(**arguments)
+
+    bot.invoke_later = invoke_later
+    chat_id = new_chat_id()
+    seed_chat(client, bot, chat_id, history=30, tagged=True)
+
+    replies = say(bot, chat_id, 31, "do you remember?")
+    assert [reply.text for reply in replies] == ["You said: do you remember?"]
+    assert invoked == ["compact_chat"]
+    assert load_manifest(client, chat_id).epochs == [0, 1]
+    segment = File.get(client, handle=segment_handle(chat_id, 1))
+    assert is_system_block(segment.blocks[0]) and is_summary_block(segment.blocks[1])
+    assert [block.text for block in segment.blocks][-2:] == ["do you remember?", "You said: do you remember?"]
+    # The old File keeps the full history, followed by the close marker
+    assert closing_block_index(File.get(client, handle=chat_id)) == 33
+
+    say(bot, chat_id, 33, "good")
+    assert invoked == ["compact_chat"]
+    assert File.get(client, handle=segment_handle(chat_id, 1)).blocks[-1].text == "You said: good"
+
+
+def test_compaction_is_scheduled_once_and_skipped_when_the_file_changed():
+    client = FakeSteamship()
+    bot = make_bot(client, summarize_after_tokens=150)
+    scheduled = []
+    bot.invoke_later = lambda method, arguments=None, **kwargs: scheduled.append(arguments)
+    chat_id = new_chat_id()
+    seed_chat(client, bot, chat_id, history=30, tagged=True)
+
+    say(bot, chat_id, 31, "one")
+    say(bot, chat_id, 33, "two")
+    assert len(scheduled) == 1
+
+    # A message arrived after the compaction was scheduled
+    bot.compact_chat(**scheduled[0])
+    assert load_manifest(client, chat_id).epochs == [0]
+
+    say(bot, chat_id, 35, "three")
+    assert len(scheduled) == 2
+    bot.compact_chat(**scheduled[1])
+    assert load_manifest(client, chat_id).epochs == [0, 1]
+    # A duplicate of the same compaction would fold the turns of the new File
+    bot.compact_chat(**scheduled[1])
+    assert load_manifest(client, chat_id).epochs == [0, 1]
+    assert File.get(client, handle=segment_handle(chat_id, 1)).blocks[-1].text == "You said: three"
@@ -0,0 +1,61 @@
+"""Unit tests for context-window selection."""
+import uuid
+
+import pytest
+from steamship import Block, SteamshipError, Tag
+from steamship.data.tags.tag_constants import RoleTag, TagKind
+
+from context_window import ContextWindow
+from tokenizer import DEFAULT_ENCODING, token_count_tag
+from util import filter_blocks_for_prompt_length
+
+
+def make_blocks(token_counts, system_tokens=5):
+    # Token counts are cached by block id, so every chat gets fresh ids.
+    chat = uuid.uuid4().hex
+    blocks = [
+        Block(
+            id=f"{chat}-0",
+            text="system",
+            index_in_file=0,
+            tags=[Tag(kind=TagKind.ROLE, name=RoleTag.SYSTEM), token_count_tag(system_tokens, DEFAULT_ENCODING)],
+        )
+    ]
+    for i, count in enumerate(token_counts, start=1):
+        blocks.append(
+            Block(
+                id=f"{chat}-{i}",
+                text=f"message {i}",
+                index_in_file=i,
+                tags=[Tag(kind=TagKind.ROLE, name=RoleTag.USER), token_count_tag(count, DEFAULT_ENCODING)],
+            )
+        )
+    return blocks
+
+
+def test_keeps_system_block_and_newest_blocks_that_fit():
+    blocks = make_blocks([10, 10, 10, 10])
+    # 5 system tokens + 3 * 10 = 35 < 36
+    assert filter_blocks_for_prompt_length(36, blocks) == [0, 2, 3, 4]
+    assert filter_blocks_for_prompt_length(35, blocks) == [0, 3, 4]
+
+
+def test_incremental_selection_matches_cold_selection():
+    blocks = make_blocks([(i * 7) % 23 + 1 for i in range(300)])
+    window = ContextWindow()
+    for n in range(2, len(blocks) + 1):
+        assert window.fit(blocks[:n], 100) == ContextWindow().fit(blocks[:n], 100)
+
+
+def test_rewritten_history_resets_window():
+    window = ContextWindow()
+    window.fit(make_blocks([10, 10, 10]), 100)
+    rewritten = make_blocks([50, 50])
+    assert window.fit(rewritten, 100) == [0, 2]
+
+
+def test_errors_when_nothing_fits():
+    with pytest.raises(SteamshipError):
+        filter_blocks_for_prompt_length(4, make_blocks([1]))
+    with pytest.raises(SteamshipError):
+        filter_blocks_for_prompt_length(20, make_blocks([30]))
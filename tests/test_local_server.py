@@ -0,0 +1,68 @@
+"""Tests for the local development server: one shared package instance, requests served concurrently."""
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from steamship.invocable import InvocableResponse, InvocationContext, PackageService, post
+
+from fake_steamship import FakeSteamship
+from http_handler import body_length, encode_json, encode_result
+from utils import serve_local
+
+
+class SlowPackage(PackageService):
+    constructions = 0
+    inits = 0
+    pings = 0
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        SlowPackage.constructions += 1
+
+    def instance_init(self):
+        SlowPackage.inits += 1
+
+    @post("ping")
+    def ping(self, delay_s: float = 0.0) -> InvocableResponse[str]:
+        time.sleep(delay_s)
+        SlowPackage.pings += 1
+        return InvocableResponse(string="pong")
+
+
+def test_requests_share_one_instance_and_run_concurrently():
+    client = FakeSteamship()
+    httpd = serve_local(client, SlowPackage, InvocationContext(invocable_url="http://localhost/"), config={},
+                        port=0, max_workers=4, max_queued=4)
+    port = httpd.server_address[1]
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            responses = list(pool.map(
+                lambda _: requests.post(f"http://127.0.0.1:{port}/ping", json={"delay_s": 0.5}, timeout=10),
+                range(4),
+            ))
+        elapsed = time.perf_counter() - start
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+    assert all(response.status_code == 200 for response in responses)
+    assert all(response.json()["data"] == "pong" for response in responses)
+    assert SlowPackage.pings == 4
+    assert SlowPackage.constructions == 1
+    assert SlowPackage.inits == 1
+    # Four half-second requests on four workers take about half a second, not two
+    assert elapsed < 1.5
+
+
+def test_encoded_body_matches_a_single_json_dumps():
+    result = {"data": {"blocks": [{"text": "héllo \"quoted\""}]}, "status": {"state": "succeeded"}, "http": None}
+    body = encode_result(result, encode_json(result["data"]))
+    assert json.loads(b"".join(body)) == result
+    assert body_length(body) == len(b"".join(body))
+    assert json.loads(b"".join(encode_result({"status": None}, encode_json("x")))) == {"data": "x", "status": None}
+    assert json.loads(b"".join(encode_result({}, encode_json([])))) == {"data": []}
@@ -0,0 +1,81 @@
+"""Unit tests for relevance-based prompt selection."""
+import random
+
+import numpy as np
+import pytest
+from steamship import SteamshipError
+from steamship.data.tags.tag_constants import RoleTag
+
+from bench_memory import MAX_TOKENS, ask, make_block, make_chat
+from context_window import ContextWindow
+from memory import ChatMemory, Embedder, HashingEmbedder
+from tokenizer import block_token_counts
+from util import filter_blocks_for_prompt_length
+
+
+def test_hashing_embedder_matches_shared_words():
+    vectors = HashingEmbedder().embed(["My dog Biscuit is a beagle.", "What breed is my dog Biscuit?",
+                                       "The train was late again.", ""])
+    assert np.allclose(np.linalg.norm(vectors[:3], axis=1), 1.0)
+    assert vectors[0] @ vectors[1] > 0.3
+    assert abs(vectors[0] @ vectors[2]) < 0.2
+    assert not vectors[3].any()
+
+
+def test_recalls_old_facts_with_a_fraction_of_the_recency_prompt():
+    blocks, questions = make_chat(2000)
+    memory = ChatMemory(HashingEmbedder(), recent_turns=6, top_k=4)
+    window = ContextWindow()
+    rng = random.Random(1)
+    for fact_index, question in questions:
+        selected, _ = ask(blocks, question, memory, rng)
+        recent = window.fit(blocks[:-1], MAX_TOKENS)
+
+        assert selected[0] == 0 and fact_index in selected
+        assert blocks[-2].index_in_file in selected
+        assert fact_index not in recent
+        assert memory.token_total(selected) < window.token_total(recent) / 4
+
+
+def test_incremental_selection_matches_cold_selection_and_resets_on_rewrite():
+    blocks, questions = make_chat(300)
+    memory = ChatMemory(HashingEmbedder(), recent_turns=4, top_k=2)
+    memory.fit(blocks, MAX_TOKENS)
+    rng = random.Random(1)
+    for _, question in questions:
+        selected, _ = ask(blocks, question, memory, rng)
+        assert selected == ChatMemory(HashingEmbedder(), recent_turns=4, top_k=2).fit(blocks[:-1], MAX_TOKENS)
+
+    assert memory.total_tokens == ContextWindow().extend(blocks[:-1]).total_tokens
+    rewritten = blocks[:1] + blocks[-10:]
+    for index, block in enumerate(rewritten):
+        block.index_in_file = index
+    selected = filter_blocks_for_prompt_length(MAX_TOKENS, rewritten, window=memory)
+    assert selected[0] == 0 and selected[-4:] == [7, 8, 9, 10]
+    assert len(memory) == 11 and memory.total_tokens == ContextWindow().extend(rewritten).total_tokens
+
+
+def test_only_the_newest_turns_are_indexed_but_every_turn_counts():
+    blocks, _ = make_chat(300)
+    memory = ChatMemory(HashingEmbedder(), recent_turns=4, top_k=2, max_turns=100)
+    memory.fit(blocks[:201], MAX_TOKENS)
+    assert memory.indices == list(range(101, 201))
+
+    # Past the limit, the oldest quarter is dropped at once
+    selected = memory.fit(blocks[:251], MAX_TOKENS)
+    assert memory.indices == list(range(176, 251))
+    assert set(selected) <= {0, *memory.indices} and selected[-4:] == [247, 248, 249, 250]
+    assert memory.total_tokens == ContextWindow().extend(blocks[:251]).total_tokens
+    assert memory.token_total(selected) == sum(block_token_counts([blocks[index] for index in selected]))
+
+    with pytest.raises(TypeError):
+        Embedder()
+
+
+def test_errors_when_nothing_fits():
+    chat = "too-long"
+    blocks = [make_block("system prompt " * 30, RoleTag.SYSTEM, 0, chat), make_block("hi " * 30, RoleTag.USER, 1, chat)]
+    with pytest.raises(SteamshipError):
+        ChatMemory(HashingEmbedder()).fit(blocks, 10)
+    with pytest.raises(SteamshipError):
+        ChatMemory(HashingEmbedder()).fit(blocks, 50)
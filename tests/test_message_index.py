@@ -0,0 +1,36 @@
+"""Tests for detecting messages that were already handled."""
+import uuid
+
+from steamship import File, Tag
+from steamship.data.tags.tag_constants import RoleTag, TagKind
+from steamship.experimental.transports.chat import ChatMessage
+
+from chat_export import message_id_tag
+from chat_fixtures import make_bot, seed_chat
+from fake_steamship import FakeSteamship
+from message_index import message_ids_in_file
+
+
+def test_a_retry_handled_by_another_worker_is_dropped_once_the_file_is_refreshed():
+    client = FakeSteamship()
+    bot = make_bot(client)
+    chat_id = str(uuid.uuid4().int % 10**9)
+    seed_chat(client, bot, chat_id, history=4, tagged=True)
+    bot.create_response(ChatMessage(text="hello", chat_id=chat_id, message_id="5"))
+
+    # Another worker got the first delivery of message 7 and answered it; this process's caches predate it
+    other = File.get(client, handle=chat_id)
+    other.append_block(text="are you there?", tags=[Tag(kind=TagKind.ROLE, name=RoleTag.USER), message_id_tag("7")])
+    other.append_block(text="You said: are you there?", tags=[Tag(kind=TagKind.ROLE, name=RoleTag.ASSISTANT)])
+    generated = client.calls["plugin/instance/generate"]
+
+    assert bot.create_response(ChatMessage(text="are you there?", chat_id=chat_id, message_id="7")) is None
+    chat_file = File.get(client, handle=chat_id)
+    assert list(message_ids_in_file(chat_file)).count("7") == 1
+    assert chat_file.blocks[-1].text == "You said: are you there?"
+    assert client.calls["plugin/instance/generate"] == generated
+
+    # The chat carries on from a fresh copy
+    replies = bot.create_response(ChatMessage(text="good", chat_id=chat_id, message_id="9"))
+    assert [reply.text for reply in replies] == ["You said: good"]
+    assert [block.index_in_file for block in File.get(client, handle=chat_id).blocks] == list(range(11))
@@ -0,0 +1,61 @@
+"""Unit tests for the Prometheus metrics registry."""
+import pytest
+
+from metrics import MetricsRegistry
+
+
+def test_histogram_renders_cumulative_buckets_sum_and_count():
+    registry = MetricsRegistry(prefix="test")
+    histogram = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, stage="generate")
+
+    lines = registry.render().splitlines()
+    assert lines[:2] == ["# HELP test_latency_seconds Latency.", "# TYPE test_latency_seconds histogram"]
+    assert 'test_latency_seconds_bucket{stage="generate",le="0.1"} 2' in lines
+    assert 'test_latency_seconds_bucket{stage="generate",le="1"} 3' in lines
+    assert 'test_latency_seconds_bucket{stage="generate",le="+Inf"} 4' in lines
+    assert 'test_latency_seconds_sum{stage="generate"} 3.65' in lines
+    assert 'test_latency_seconds_count{stage="generate"} 4' in lines
+
+
+def test_counter_keeps_one_series_per_label_set():
+    registry = MetricsRegistry(prefix="test")
+    lookups = registry.counter("lookups_total", "Lookups.")
+    lookups.inc(cache="chat_file", result="hit")
+    lookups.inc(2, cache="chat_file", result="hit")
+    lookups.inc(cache="chat_file", result="miss")
+
+    assert lookups.value(cache="chat_file", result="hit") == 3
+    assert 'test_lookups_total{cache="chat_file",result="miss"} 1' in registry.render().splitlines()
+    assert registry.counter("lookups_total", "Lookups.") is lookups
+
+
+def test_label_values_are_escaped():
+    registry = MetricsRegistry(prefix="test")
+    registry.counter("errors_total", "Errors.").inc(reason='bad "quote"\n')
+    assert 'test_errors_total{reason="bad \\"quote\\"\\n"} 1' in registry.render()
+
+
+def test_time_stage_records_failures_too():
+    from metrics import stage_seconds, time_stage
+
+    before = stage_seconds.count(stage="test_failure")
+    with pytest.raises(ValueError):
+        with time_stage("test_failure"):
+            raise ValueError()
+    assert stage_seconds.count(stage="test_failure") == before + 1
+
+
+def test_recording_stages_collects_only_the_enclosed_stages():
+    from metrics import recording_stages, time_stage
+
+    with time_stage("test_outside"):
+        pass
+    with recording_stages() as stages:
+        with time_stage("test_outer"):
+            with time_stage("test_inner"):
+                pass
+    with time_stage("test_after"):
+        pass
+    assert [stage for stage, _ in stages] == ["test_inner", "test_outer"]
@@ -0,0 +1,13 @@
+"""Smoke test for the offline benchmark: the package runs end to end against the in-memory engine."""
+from bench_create_response import run_scenario
+
+
+def test_every_message_gets_one_generation():
+    result = run_scenario(history=20, concurrency=2, chats=3, messages=2, generate_latency_s=0)
+
+    assert result["messages"] == 6
+    assert result["engine_calls"]["plugin/instance/generate"] == 6
+    # Each chat File is fetched once; later messages are served from the chat cache
+    assert result["engine_calls"]["file/get"] == 3
+    for stage in ("create_response", "select_prompt_window", "llm generate"):
+        assert result["stages"][stage]["count"] == 6
@@ -0,0 +1,68 @@
+"""Tests for the opt-in per-request profiling of the local server."""
+import pstats
+import threading
+import time
+
+import pytest
+import requests
+from steamship.invocable import InvocableResponse, InvocationContext, PackageService, post
+
+from fake_steamship import FakeSteamship
+from metrics import time_stage
+from profiling import RequestProfiler
+from utils import serve_local
+
+
+class StagedPackage(PackageService):
+    @post("work")
+    def work(self, fetch_s: float = 0.0, parse_s: float = 0.0) -> InvocableResponse[str]:
+        with time_stage("profiling_test_fetch"):
+            busy_wait(fetch_s)
+        with time_stage("profiling_test_parse"):
+            held = [bytearray(1024) for _ in range(256)]
+            busy_wait(parse_s)
+        return InvocableResponse(string=str(len(held)))
+
+
+def busy_wait(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_each_request_gets_a_profile_and_the_summary_puts_the_slowest_stage_first(tmp_path):
+    httpd = serve_local(FakeSteamship(), StagedPackage, InvocationContext(invocable_url="http://localhost/"),
+                        config={}, port=0, profile_dir=str(tmp_path))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        for fetch_s, parse_s in ((0.05, 0.01), (0.01, 0.2)):
+            response = requests.post(f"http://127.0.0.1:{httpd.server_address[1]}/work",
+                                     json={"fetch_s": fetch_s, "parse_s": parse_s}, timeout=10)
+            assert response.json()["data"] == "256"
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+    summary = (tmp_path / "summary.txt").read_text().splitlines()
+    assert summary[1].startswith("profiling_test_parse") and "00002 /work" in summary[1]
+    assert summary[2].startswith("profiling_test_fetch") and "00001 /work" in summary[2]
+
+    collapsed = (tmp_path / "00002-work.collapsed").read_text().splitlines()
+    stack, count = collapsed[0].rsplit(" ", 1)
+    assert stack.endswith("test_profiling.busy_wait") and "test_profiling.StagedPackage.work" in stack
+    assert int(count) > 10
+    assert len((tmp_path / "all.collapsed").read_text().splitlines()) >= len(collapsed)
+    assert "test_profiling.py" in (tmp_path / "00002-work.alloc.txt").read_text()
+
+
+def test_cprofile_mode_writes_a_loadable_dump(tmp_path):
+    profiler = RequestProfiler(str(tmp_path), mode="cprofile", trace_allocations=False)
+    with pytest.raises(ZeroDivisionError):
+        profiler.run("/fails", lambda: busy_wait(0.01) or 1 / 0)
+    assert profiler.run("/works", lambda: 42) == 42
+
+    stats = pstats.Stats(str(tmp_path / "00001-fails.prof"))
+    assert any(name == "busy_wait" for _, _, name in stats.stats)
+    assert [profile.label for profile in profiler.requests] == ["/fails", "/works"]
+    with pytest.raises(ValueError):
+        RequestProfiler(str(tmp_path), mode="perf")
@@ -0,0 +1,72 @@
+"""Tests for the reply cache."""
+from steamship import Block, Tag
+from steamship.data.tags.tag_constants import RoleTag, TagKind
+from steamship.experimental.transports.chat import ChatMessage
+
+from chat_fixtures import make_bot
+from fake_steamship import FakeSteamship
+from reply_cache import ReplyCache, normalize_turn, prompt_key
+
+
+def block(role: RoleTag, text: str) -> Block:
+    return Block(text=text, tags=[Tag(kind=TagKind.ROLE, name=role)])
+
+
+def test_prompt_key_normalizes_turns_and_covers_only_chats_of_a_few_turns():
+    system = block(RoleTag.SYSTEM, "Your name is buddy.")
+    key = prompt_key("gpt-4", [system, block(RoleTag.USER, "Hi!")], num_turns=2)
+
+    assert normalize_turn("  Hello   THERE?! ") == "hello there"
+    assert prompt_key("gpt-4", [system, block(RoleTag.USER, " hi ")], num_turns=2) == key
+    assert prompt_key("gpt-3.5-turbo", [system, block(RoleTag.USER, "hi")], num_turns=2) != key
+    assert prompt_key("gpt-4", [block(RoleTag.SYSTEM, "Your name is ted."), block(RoleTag.USER, "hi")], 2) != key
+
+    older = [block(RoleTag.USER, "first"), block(RoleTag.ASSISTANT, "reply")]
+    other = [block(RoleTag.USER, "something else"), block(RoleTag.ASSISTANT, "reply")]
+    latest = [block(RoleTag.USER, "help")]
+    # Chats that differ only in earlier turns never share a key
+    assert prompt_key("gpt-4", [system, *older, *latest], 2) is None
+    assert prompt_key("gpt-4", [system, *older, *latest], 3) != prompt_key("gpt-4", [system, *other, *latest], 3)
+
+
+def test_entries_expire_and_least_recently_used_are_evicted():
+    now = [0.0]
+    cache = ReplyCache(max_entries=2, ttl_s=10, clock=lambda: now[0])
+    cache.put("a", ["A"])
+    cache.put("b", ["B"])
+    assert cache.get("a") == ["A"]
+    cache.put("c", ["C"])
+    assert cache.get("b") is None
+    now[0] = 11
+    assert cache.get("a") is None
+    assert cache.stats() == {"entries": 1, "hits": 1, "misses": 2, "hit_rate": 1 / 3}
+
+
+def test_repeated_openers_in_new_chats_are_answered_from_the_cache():
+    client = FakeSteamship()
+    bot = make_bot(client, reply_cache_ttl_s=60)
+
+    first = bot.create_response(ChatMessage(text="Hi!", chat_id="9001", message_id="1"))
+    second = bot.create_response(ChatMessage(text="hi", chat_id="9002", message_id="1"))
+
+    assert [m.text for m in first] == [m.text for m in second] == ["You said: Hi!"]
+    assert client.calls["plugin/instance/generate"] == 1
+    # The cached reply is part of the second chat's history like any other reply
+    assert [b.text for b in bot.get_file_for_chat("9002").blocks][-1] == "You said: Hi!"
+
+
+def test_longer_chats_are_neither_served_nor_stored():
+    client = FakeSteamship()
+    bot = make_bot(client, reply_cache_ttl_s=60, reply_cache_turns=1)
+    # The cache is process-wide, so other tests may have filled it
+    entries = bot.get_reply_cache().stats()["entries"]
+
+    bot.create_response(ChatMessage(text="my name is ann", chat_id="9101", message_id="1"))
+    bot.create_response(ChatMessage(text="what is my name?", chat_id="9101", message_id="2"))
+    bot.create_response(ChatMessage(text="i am bob", chat_id="9102", message_id="1"))
+    reply = bot.create_response(ChatMessage(text="what is my name?", chat_id="9102", message_id="2"))
+
+    assert [m.text for m in reply] == ["You said: what is my name?"]
+    assert client.calls["plugin/instance/generate"] == 4
+    # Only the replies to each chat's first message were stored
+    assert bot.get_reply_cache().stats()["entries"] == entries + 2
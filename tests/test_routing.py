@@ -0,0 +1,113 @@
+"""Tests for latency-aware model choice and hedged generation."""
+import pytest
+from steamship import SteamshipError
+from steamship.experimental.transports.chat import ChatMessage
+
+from chat_fixtures import make_bot, seed_chat
+from fake_steamship import FakeSteamship, echo_generator
+from routing import LatencyTracker, choose_models, race
+
+
+def test_estimates_prefer_samples_for_the_same_prompt_size():
+    tracker = LatencyTracker(min_samples=2)
+    for seconds in (1.0, 1.0, 1.0):
+        tracker.observe("gpt-4", seconds, prompt_tokens=500)
+    assert tracker.estimate("gpt-4", prompt_tokens=500) == 1.0
+    # Too few samples for long prompts: fall back to everything known about the model
+    tracker.observe("gpt-4", 9.0, prompt_tokens=3000)
+    assert tracker.estimate("gpt-4", prompt_tokens=3000) == 9.0
+    assert tracker.estimate("gpt-3.5-turbo") is None
+
+
+def test_choose_models_switches_only_when_the_primary_is_over_budget_and_slower():
+    tracker = LatencyTracker(min_samples=1)
+    assert choose_models("gpt-4", "gpt-3.5-turbo", tracker, 5.0, 100) == ("gpt-4", "gpt-3.5-turbo")
+
+    tracker.observe("gpt-4", 8.0)
+    tracker.observe("gpt-3.5-turbo", 2.0)
+    assert choose_models("gpt-4", "gpt-3.5-turbo", tracker, 5.0, 100) == ("gpt-3.5-turbo", "gpt-3.5-turbo")
+    assert choose_models("gpt-4", "gpt-3.5-turbo", tracker, 10.0, 100) == ("gpt-4", "gpt-3.5-turbo")
+
+
+def test_a_skipped_primary_is_tried_again_once_its_samples_age_out():
+    now = [0.0]
+    tracker = LatencyTracker(min_samples=1, max_age_s=600, clock=lambda: now[0])
+    tracker.observe("gpt-4", 8.0)
+    now[0] = 300
+    tracker.observe("gpt-3.5-turbo", 2.0)
+    assert choose_models("gpt-4", "gpt-3.5-turbo", tracker, 5.0, 100) == ("gpt-3.5-turbo", "gpt-3.5-turbo")
+    now[0] = 601
+    assert tracker.estimate("gpt-4") is None
+    assert choose_models("gpt-4", "gpt-3.5-turbo", tracker, 5.0, 100) == ("gpt-4", "gpt-3.5-turbo")
+
+
+def test_abandoned_requests_count_as_lower_bounds():
+    tracker = LatencyTracker(min_samples=1)
+    for _ in range(4):
+        tracker.observe("gpt-4", 1.0)
+    # Hedges that lost after half a second say nothing about gpt-4 being fast
+    for _ in range(4):
+        tracker.observe("gpt-4", 0.5, censored=True)
+    assert tracker.estimate("gpt-4") == 1.0
+    # Requests abandoned after 6s keep a slow model's estimate at least that high
+    for _ in range(8):
+        tracker.observe("gpt-3.5-turbo", 6.0, censored=True)
+    tracker.observe("gpt-3.5-turbo", 2.0)
+    assert tracker.estimate("gpt-3.5-turbo") == 6.0
+
+
+def failing_on_request(prompt):
+    if prompt[-1]["text"] == "fail":
+        raise ValueError("model unavailable")
+    return echo_generator(prompt)
+
+
+@pytest.fixture
+def client():
+    return FakeSteamship(
+        background_tasks=True,
+        generate_latency_s=lambda config: 2.0 if config.get("model") == "slow" else 0.05,
+        generator=failing_on_request,
+    )
+
+
+def start(client, model, text="hi"):
+    return model, lambda: client.use_plugin("gpt-4", config={"model": model}).generate(text=text)
+
+
+def test_race_hedges_after_the_deadline_and_returns_the_first_answer(client):
+    abandoned = []
+    model, task, seconds = race(start(client, "slow"), start(client, "fast"), hedge_after_s=0.2, poll_interval_s=0.05,
+                                on_abandoned=lambda model, seconds: abandoned.append((model, seconds)))
+    assert model == "fast"
+    assert task.output.blocks[0].text == "You said: hi"
+    assert seconds < 1.0
+    assert [model for model, _ in abandoned] == ["slow"] and abandoned[0][1] >= 0.2
+
+
+def test_race_does_not_hedge_a_fast_answer(client):
+    model, _, _ = race(start(client, "fast"), start(client, "slow"), hedge_after_s=1.0, poll_interval_s=0.05)
+    assert model == "fast"
+    assert client.calls["plugin/instance/generate"] == 1
+
+
+def test_race_falls_back_immediately_on_failure_and_raises_when_all_fail(client):
+    model, _, _ = race(start(client, "slow", "fail"), start(client, "fast"), hedge_after_s=10, poll_interval_s=0.05)
+    assert model == "fast"
+    with pytest.raises(SteamshipError):
+        race(start(client, "a", "fail"), start(client, "b", "fail"), hedge_after_s=10, poll_interval_s=0.05)
+
+
+def test_hedged_reply_is_appended_to_the_chat_once():
+    client = FakeSteamship(
+        background_tasks=True,
+        generate_latency_s=lambda config: 3.0 if config.get("model") == "gpt-4" else 0.05,
+    )
+    bot = make_bot(client, use_gpt4=True, latency_budget_ms=300)
+    seed_chat(client, bot, "42", history=4, tagged=True)
+    replies = bot.create_response(ChatMessage(text="hello", chat_id="42", message_id="100"))
+
+    assert [reply.text for reply in replies] == ["You said: hello"]
+    roles = [tag.name for block in bot.get_file_for_chat("42").blocks for tag in block.tags if tag.kind == "role"]
+    assert roles[-2:] == ["user", "assistant"]
+    assert len(roles) == 7
@@ -0,0 +1,51 @@
+"""Tests for streamed replies, run against a local fake Bot API server."""
+import pytest
+
+from fake_telegram import FakeTelegram
+from streaming import StreamingMessage
+
+
+@pytest.fixture
+def telegram():
+    fake = FakeTelegram().start()
+    yield fake
+    fake.stop()
+
+
+def failing(*methods):
+    return lambda method, params: (400, {"ok": False, "description": "Bad Request"}) if method in methods else None
+
+
+def test_a_failed_progress_edit_is_skipped_and_retried_after_the_rate_limit(telegram):
+    now = [0.0]
+    stream = StreamingMessage(telegram.api_root(), "7001", clock=lambda: now[0]).start()
+    telegram.respond = failing("editMessageText")
+    now[0] = 1.0
+    assert stream.update("Hello") is False
+    assert stream.text == "…" and telegram.calls["editMessageText"] == 1
+
+    telegram.respond = None
+    now[0] = 1.5
+    assert stream.update("Hello there") is False
+    now[0] = 2.0
+    assert stream.update("Hello there") is True
+    assert stream.text == "Hello there" and stream.num_edits == 1
+
+
+def test_a_failed_final_edit_sends_the_reply_as_a_new_message(telegram):
+    stream = StreamingMessage(telegram.api_root(), "7002").start()
+    telegram.respond = failing("editMessageText")
+    stream.finish("The whole reply")
+    assert telegram.sent[7002] == ["…", "The whole reply"]
+    assert telegram.calls["deleteMessage"] == 1
+    assert stream.message_id is None and stream.text == "The whole reply"
+
+
+def test_whitespace_only_progress_is_not_shown(telegram):
+    now = [0.0]
+    stream = StreamingMessage(telegram.api_root(), "7003", clock=lambda: now[0]).start()
+    now[0] = 1.0
+    assert stream.update(" \n") is False
+    assert stream.text == "…" and telegram.calls["editMessageText"] == 0
+    assert stream.update(" \nHello") is True
+    assert stream.text == "Hello"
@@ -0,0 +1,91 @@
+"""Tests for the outbound Telegram sender, run against a local fake Bot API server."""
+import threading
+import time
+
+import pytest
+from steamship.invocable import InvocationContext
+
+from fake_steamship import FakeSteamship
+from fake_telegram import FakeTelegram
+from replay_traffic import BOT_CONFIG, local_bot_class
+from telegram_sender import TelegramSender, split_message, telegram_failures, utf16_length
+
+
+@pytest.fixture
+def telegram():
+    fake = FakeTelegram().start()
+    yield fake
+    fake.stop()
+
+
+def test_split_message_prefers_paragraphs_then_sentences_and_counts_utf16():
+    paragraph = "Sentence one is here. " * 40
+    text = "\n\n".join([paragraph.strip()] * 5)
+    parts = split_message(text, limit=2000)
+    assert all(utf16_length(part) <= 2000 for part in parts)
+    assert all(part.endswith(".") for part in parts)
+    assert " ".join(" ".join(parts).split()) == " ".join(text.split())
+
+    emoji = "😀" * 3000
+    parts = split_message(emoji, limit=4096)
+    assert [utf16_length(part) for part in parts] == [4096, 1904]
+    assert "".join(parts) == emoji
+    assert split_message("short") == ["short"]
+    assert split_message("   ") == []
+
+
+def test_retries_429_after_retry_after_and_server_errors_with_backoff(telegram):
+    failures = {"sendMessage": [(429, {"ok": False, "error_code": 429, "parameters": {"retry_after": 3}}),
+                                (502, {"ok": False, "description": "Bad Gateway"})]}
+    telegram.respond = lambda method, params: failures[method].pop(0) if failures.get(method) else None
+    slept = []
+    sender = TelegramSender(telegram.api_root(), sleep=slept.append)
+
+    sent = sender.send_message(42, "hello")
+
+    assert [message["text"] for message in sent] == ["hello"]
+    assert telegram.sent[42] == ["hello"]
+    assert telegram.calls["sendMessage"] == 3
+    assert slept[0] == 3 and 0.5 <= slept[1] <= 1.0
+
+
+def test_client_errors_are_not_retried_and_do_not_raise(telegram):
+    telegram.respond = lambda method, params: (403, {"ok": False, "description": "Forbidden: bot was blocked"})
+    before = telegram_failures.value(method="sendMessage")
+    sender = TelegramSender(telegram.api_root(), sleep=lambda s: None)
+
+    assert sender.send_message(42, "hello") == []
+    assert telegram.calls["sendMessage"] == 1
+    assert telegram_failures.value(method="sendMessage") == before + 1
+
+
+def test_reuses_connections_and_paces_each_chat(telegram):
+    # Ten messages a second per chat, no bursts
+    sender = TelegramSender(telegram.api_root(), private_per_minute=600, chat_burst=1)
+    start = time.perf_counter()
+    threads = [threading.Thread(target=sender.send_message, args=(chat_id, f"message {n}"))
+               for n in range(5) for chat_id in (1, 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    assert sorted(telegram.sent[1]) == sorted(telegram.sent[2]) == [f"message {n}" for n in range(5)]
+    # Both chats are paced independently: four waits of 0.1s each, not nine
+    assert 0.35 < elapsed < 0.9
+    assert len(telegram.connections) <= 2
+
+
+def test_long_replies_are_delivered_in_parts_through_the_bot(telegram):
+    reply = "\n\n".join(f"Paragraph {n}. " + "word " * 400 for n in range(6))
+    client = FakeSteamship(generator=lambda prompt: reply)
+    bot = local_bot_class(telegram.api_root("split"))(
+        client=client, config={**BOT_CONFIG, "bot_token": "split"},
+        context=InvocationContext(invocable_url="http://localhost/", invocable_instance_handle="sender-test"))
+
+    bot.respond(update_id=1, message={"message_id": 1, "chat": {"id": 9301, "type": "private"}, "text": "talk"})
+
+    parts = telegram.sent[9301]
+    assert len(parts) == 3 and all(utf16_length(part) <= 4096 for part in parts)
+    assert [part.split(".")[0] for part in parts] == ["Paragraph 0", "Paragraph 2", "Paragraph 4"]
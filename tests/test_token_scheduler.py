@@ -0,0 +1,131 @@
+"""Tests for the token-budget scheduler."""
+import threading
+import time
+
+import pytest
+from steamship.experimental.transports.chat import ChatMessage
+
+from chat_fixtures import make_bot
+from fake_steamship import FakeSteamship
+from token_scheduler import BUSY_REPLY, TokenBucket, TokenScheduler
+
+
+def test_bucket_refills_at_the_configured_rate():
+    now = [0.0]
+    bucket = TokenBucket(tokens_per_minute=600, clock=lambda: now[0])
+    assert bucket.try_take(600)
+    assert not bucket.try_take(1)
+    assert bucket.seconds_until(100) == pytest.approx(10)
+    now[0] = 5
+    assert bucket.try_take(50)
+    bucket.give_back(1000)
+    assert bucket.tokens == 600
+
+
+def test_a_chat_with_a_backlog_does_not_starve_other_chats():
+    # 100 tokens per second and room for one request at a time
+    scheduler = TokenScheduler(tokens_per_minute=6000, capacity=100)
+    assert scheduler.acquire("busy", 100, max_wait_s=1)
+    order = []
+
+    def request(chat_id: str):
+        if scheduler.acquire(chat_id, 100, max_wait_s=5):
+            order.append(chat_id)
+
+    threads = [threading.Thread(target=request, args=("busy",)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.002)
+    while scheduler.queued() < 4:
+        time.sleep(0.001)
+    quiet = threading.Thread(target=request, args=("quiet",))
+    quiet.start()
+    for thread in threads + [quiet]:
+        thread.join()
+
+    assert order.index("quiet") <= 1
+
+
+def test_short_prompts_go_first():
+    scheduler = TokenScheduler(tokens_per_minute=6000, capacity=100)
+    assert scheduler.acquire("warmup", 100, max_wait_s=1)
+    order = []
+
+    def request(chat_id: str, cost: int):
+        if scheduler.acquire(chat_id, cost, max_wait_s=5):
+            order.append(chat_id)
+
+    long_prompt = threading.Thread(target=request, args=("long", 100))
+    long_prompt.start()
+    while scheduler.queued() < 1:
+        time.sleep(0.001)
+    short_prompt = threading.Thread(target=request, args=("short", 10))
+    short_prompt.start()
+    long_prompt.join()
+    short_prompt.join()
+
+    assert order == ["short", "long"]
+
+
+def test_requests_that_would_wait_too_long_are_refused_immediately():
+    scheduler = TokenScheduler(tokens_per_minute=60, capacity=60)
+    assert scheduler.acquire("a", 60, max_wait_s=1)
+    start = time.perf_counter()
+    assert not scheduler.acquire("b", 30, max_wait_s=1)
+    assert time.perf_counter() - start < 0.1
+    scheduler.release(30)
+    assert scheduler.acquire("b", 30, max_wait_s=1)
+
+
+def test_a_reservation_larger_than_the_bucket_takes_and_returns_at_most_its_capacity():
+    now = [0.0]
+    scheduler = TokenScheduler(tokens_per_minute=60, capacity=60, clock=lambda: now[0])
+    granted = scheduler.acquire("a", 100, max_wait_s=1)
+    assert granted == 60
+    # The caller returns what it did not use out of what it was granted, never more
+    scheduler.release(granted - 10)
+    assert scheduler.bucket.tokens == 50
+
+
+def test_bot_answers_busy_when_over_budget():
+    # Replies use up nearly all of the 256 completion tokens reserved for them
+    client = FakeSteamship(generator=lambda prompt: "word " * 240)
+    bot = make_bot(client, tokens_per_minute=400, max_queue_wait_s=1)
+
+    first = bot.create_response(ChatMessage(text="hello", chat_id="7001", message_id="1"))
+    second = bot.create_response(ChatMessage(text="hello again", chat_id="7002", message_id="1"))
+
+    assert first[0].text.startswith("word")
+    assert [m.text for m in second] == [BUSY_REPLY]
+    assert client.calls["plugin/instance/generate"] == 1
+
+
+def test_a_failed_generation_returns_its_unused_reservation():
+    failures = [RuntimeError("model overloaded")]
+
+    def generator(prompt):
+        if failures:
+            raise failures.pop()
+        return "word " * 240
+
+    client = FakeSteamship(generator=generator)
+    # Schedulers are shared per model and budget; this budget is not used by other tests
+    bot = make_bot(client, tokens_per_minute=401, max_queue_wait_s=1)
+
+    with pytest.raises(RuntimeError):
+        bot.create_response(ChatMessage(text="hello", chat_id="7101", message_id="1"))
+    second = bot.create_response(ChatMessage(text="hello again", chat_id="7102", message_id="1"))
+
+    assert second[0].text.startswith("word")
+    assert client.calls["plugin/instance/generate"] == 2
+
+
+def test_a_reservation_larger_than_the_budget_is_still_charged_for_what_was_used():
+    client = FakeSteamship(generator=lambda prompt: "hi")
+    # The prompt plus 256 reserved completion tokens is more than the whole budget
+    bot = make_bot(client, tokens_per_minute=102, max_queue_wait_s=1)
+
+    bot.create_response(ChatMessage(text="hello", chat_id="7201", message_id="1"))
+
+    # Returning the unused part of the uncapped reservation would refill the bucket completely
+    assert bot.get_token_scheduler().bucket.tokens < 100
@@ -0,0 +1,39 @@
+"""Tests for the BPE files bundled with the package."""
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from tokenizer import BUNDLED_BPE_DIR, verify_bpe_files
+
+SRC = Path(__file__).parent.parent / "src"
+
+# Runs in a fresh interpreter, where the session's fake encoder is not registered
+LOAD_WITHOUT_NETWORK = """
+import socket
+
+def no_network(*args, **kwargs):
+    raise OSError("network access is disabled")
+
+socket.socket.connect = no_network
+socket.getaddrinfo = no_network
+socket.create_connection = no_network
+
+from tokenizer import count_tokens, get_encoder
+assert get_encoder("cl100k_base").encode("hello world") == [15339, 1917]
+print(count_tokens("Your name is buddy."))
+"""
+
+
+def test_bundled_bpe_files_match_their_checksums():
+    assert (BUNDLED_BPE_DIR / "SHA256SUMS").read_text().strip()
+    assert verify_bpe_files() == []
+
+
+def test_the_encoder_loads_with_the_network_disabled():
+    env = {key: value for key, value in os.environ.items()
+           if key not in ("TIKTOKEN_CACHE_DIR", "DATA_GYM_CACHE_DIR")}
+    result = subprocess.run([sys.executable, "-c", LOAD_WITHOUT_NETWORK], env={**env, "PYTHONPATH": str(SRC)},
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "5"
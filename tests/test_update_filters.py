@@ -0,0 +1,121 @@
+"""Tests for the pre-generation update filters."""
+import pytest
+from steamship.invocable import InvocationContext
+
+import api
+from fake_steamship import FakeSteamship
+from fake_telegram import FakeTelegram
+from replay_traffic import BOT_CONFIG, local_bot_class
+from update_filters import (ContentTypeFilter, FilterPipeline, FloodFilter, GroupMentionFilter, RepeatFilter,
+                            UpdateFilter, update_filter_results)
+
+
+def update(text=None, chat_type="private", chat_id=10, user_id=20, update_id=1, **message):
+    body = {"message_id": update_id, "chat": {"id": chat_id, "type": chat_type}, "from": {"id": user_id}, **message}
+    if text is not None:
+        body["text"] = text
+    return {"update_id": update_id, "message": body}
+
+
+def test_only_new_text_messages_pass_the_content_filter():
+    content = ContentTypeFilter()
+    assert content.allow(update("hi"))
+    assert not content.allow(update(sticker={"file_id": "x"}))
+    assert not content.allow(update(new_chat_members=[{"id": 3}]))
+    assert not content.allow(update("   "))
+    assert not content.allow({"update_id": 1, "edited_message": update("hi")["message"]})
+
+
+def test_group_messages_must_mention_reply_to_or_command_the_bot():
+    mentions = GroupMentionFilter(lambda: "Buddy_Bot")
+    assert mentions.allow(update("hello everyone"))
+    assert not mentions.allow(update("hello everyone", chat_type="group"))
+    assert mentions.allow(update("hey @buddy_bot, how are you?", chat_type="supergroup"))
+    assert mentions.allow(update("sure", chat_type="group",
+                                 reply_to_message={"from": {"is_bot": True, "username": "buddy_bot"}}))
+    assert not mentions.allow(update("sure", chat_type="group",
+                                     reply_to_message={"from": {"is_bot": True, "username": "other_bot"}}))
+    assert mentions.allow(update("/start", chat_type="group"))
+    assert mentions.allow(update("/start@buddy_bot", chat_type="group"))
+    assert not mentions.allow(update("/start@other_bot", chat_type="group"))
+    assert not GroupMentionFilter(lambda: None).allow(update("hey @buddy_bot", chat_type="group"))
+
+
+def test_flood_and_repeat_limits_are_per_sender():
+    now = [0.0]
+    flood = FloodFilter(max_messages=2, window_s=10, clock=lambda: now[0])
+    assert flood.allow(update("a")) and flood.allow(update("b"))
+    assert not flood.allow(update("c"))
+    assert flood.allow(update("c", user_id=21))
+    now[0] = 10
+    assert flood.allow(update("d"))
+
+    repeat = RepeatFilter(window_s=5, clock=lambda: now[0])
+    assert repeat.allow(update("buy now"))
+    assert not repeat.allow(update("buy now"))
+    assert repeat.allow(update("buy now", chat_id=11))
+    now[0] = 20
+    assert repeat.allow(update("buy now"))
+
+
+def test_pipeline_stops_at_the_first_filter_that_drops_and_counts_it():
+    before = update_filter_results.value(filter="content_type"), update_filter_results.value(filter="none")
+    calls = []
+
+    class Recording(ContentTypeFilter):
+        name = "recording"
+
+        def allow(self, body):
+            calls.append(body)
+            return True
+
+    pipeline = FilterPipeline([ContentTypeFilter(), Recording()])
+    assert not pipeline.admit(update(sticker={}))
+    assert pipeline.admit(update("hi"))
+    assert len(calls) == 1
+    assert update_filter_results.value(filter="content_type") == before[0] + 1
+    assert update_filter_results.value(filter="none") == before[1] + 1
+
+
+def test_dropped_updates_never_reach_storage_or_the_model():
+    client = FakeSteamship()
+    telegram = FakeTelegram().start()
+    try:
+        bot = local_bot_class(telegram.api_root())(
+            client=client, config={**BOT_CONFIG, "repeat_window_s": 60},
+            context=InvocationContext(invocable_url="http://localhost/", invocable_instance_handle="filter-test"))
+        bot.respond(**update(sticker={"file_id": "x"}, chat_id=8101, update_id=1))
+        bot.respond(**update("chatting among ourselves", chat_type="group", chat_id=-8102, update_id=2))
+        assert client.calls["file/get"] == client.calls["file/create"] == 0
+
+        bot.respond(**update("@buddy_bot hi!", chat_type="group", chat_id=-8102, update_id=3))
+        bot.respond(**update("@buddy_bot hi!", chat_type="group", chat_id=-8102, update_id=4))
+    finally:
+        telegram.stop()
+    assert telegram.sent[-8102] == ["You said: @buddy_bot hi!"]
+    assert telegram.calls["getMe"] == 1
+    assert client.calls["plugin/instance/generate"] == 1
+
+
+def test_a_failed_get_me_is_not_cached_for_good():
+    telegram = FakeTelegram().start()
+    failures = [(502, {"ok": False, "description": "Bad Gateway"})]
+    telegram.respond = lambda method, params: failures.pop() if method == "getMe" and failures else None
+    try:
+        bot = local_bot_class(telegram.api_root())(
+            client=FakeSteamship(), config={**BOT_CONFIG, "bot_token": "get-me-retry-test"},
+            context=InvocationContext(invocable_url="http://localhost/", invocable_instance_handle="get-me-test"))
+        assert bot.get_bot_username() is None
+        assert bot.get_bot_username() is None
+        assert telegram.calls["getMe"] == 1
+
+        # Once the retry delay has passed
+        api.bot_username_retry_at["get-me-retry-test"] = 0.0
+        assert bot.get_bot_username() == "buddy_bot"
+        assert bot.get_bot_username() == "buddy_bot"
+    finally:
+        telegram.stop()
+    assert telegram.calls["getMe"] == 2
+
+    with pytest.raises(TypeError):
+        UpdateFilter()
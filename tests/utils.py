@@ -1,27 +1,85 @@
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 import logging
 from steamship import Steamship, Task
 from steamship.invocable import InvocationContext, Invocable, InvocableRequest, Invocation, LoggingConfig
 from steamship.utils.url import Verb
-from pyngrok import ngrok
 from http import server
 from socketserver import TCPServer
-from http_handler import create_safe_handler
+from http_handler import EncodedBody, body_length, create_local_invocable, create_safe_handler
+from profiling import RequestProfiler
+from traffic_capture import TrafficRecorder, traffic_recorders
+
+
+class BoundedThreadPoolServer(TCPServer):
+    """TCPServer that handles requests on a fixed pool of worker threads.
+
+    At most `max_workers` requests run at once and `max_queued` more wait for a worker. Beyond that the
+    accept loop stops taking connections, which then wait in the OS listen backlog.
+    """
+
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, max_workers: int = 8, max_queued: int = 64):
+        super().__init__(server_address, handler_class)
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="local-server")
+        self.slots = threading.BoundedSemaphore(max_workers + max_queued)
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        try:
+            self.pool.submit(self._process_in_worker, request, client_address)
+        except RuntimeError:
+            # The pool is shutting down
+            self.slots.release()
+            self.shutdown_request(request)
+
+    def _process_in_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+def make_handler(package_class, client: Steamship, context: InvocationContext, config: dict = {}, invocable: Optional[Invocable] = None,
+                 recorder: Optional[TrafficRecorder] = None, profiler: Optional[RequestProfiler] = None):
+    # Built once per server; with `invocable` set, requests reuse it instead of constructing the package again
+    # With `recorder` set, every POST body is captured (anonymized) for replay
+    # With `profiler` set, every invocation is profiled
+    handler = create_safe_handler(package_class, invocable, encoded=True, profiler=profiler)
 
-def make_handler(invocable: Invocable, client: Steamship, context: InvocationContext, config: dict = {}):
     class LocalHttpHandler(server.SimpleHTTPRequestHandler):
         def _set_response(self):
             self.send_response(200)
             self.send_header('Content-type', 'text/html')
             self.end_headers()
 
+        def _send_body(self, body: EncodedBody):
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.send_header('Content-Length', str(body_length(body)))
+            self.end_headers()
+            for chunk in body:
+                self.wfile.write(chunk)
+
         def do_GET(self):
             logging.info("GET request,\nPath: %s\nHeaders:\n%s\n", str(self.path), str(self.headers))
             self._set_response()
             self.wfile.write("GET request for {}".format(self.path).encode('utf-8'))
 
         def do_POST(self):
+            arrived_at, started = TrafficRecorder.now(), time.perf_counter()
             content_length = int(self.headers['Content-Length']) # <--- Gets the size of data
             post_data = self.rfile.read(content_length) # <--- Gets the data itself
             try:
@@ -41,15 +99,13 @@ def make_handler(invocable: Invocable, client: Steamship, context: InvocationCon
                     invocation_context = context
                 )
 
-                handler = create_safe_handler(invocable)
-                resp = handler(event.dict(by_alias=True), context)
-
-                rr = InvocableRequest.parse_obj(event.dict())
+                body = handler(event.dict(by_alias=True), context)
 
                 logging.info("POST request,\nPath: %s\nHeaders:\n%s\n\nBody:\n%s\n",
                         str(self.path), str(self.headers), post_data.decode('utf-8'))
-                self._set_response()
-                self.wfile.write("POST request for {}".format(self.path).encode('utf-8'))
+                self._send_body(body)
+                if recorder is not None:
+                    recorder.record(self.path, post_json, arrived_at, time.perf_counter() - started)
             except Exception as e:
                 print(e)
                 self._set_response()
@@ -57,8 +113,33 @@ def make_handler(invocable: Invocable, client: Steamship, context: InvocationCon
 
     return LocalHttpHandler
 
-def use_local_with_ngrok(client: Steamship, package_class, config: Optional[dict] = None, port: int = 8080):
+def serve_local(client: Steamship, package_class, context: InvocationContext, config: Optional[dict] = None,
+                port: int = 8080, max_workers: int = 8, max_queued: int = 64,
+                capture_path: Optional[str] = None, profile_dir: Optional[str] = None,
+                profile_mode: str = "sample") -> BoundedThreadPoolServer:
+    """Build the package once (running its instance init) and return a server that shares it across requests.
+
+    Call `serve_forever()` on the result. Without a tunnel this is useful for load tests against localhost.
+    With `capture_path`, incoming requests are appended to that file for `tests/replay_traffic.py`.
+    With `profile_dir`, each request is profiled into that directory (see `tests/profiling.py`); requests are
+    then handled one at a time.
+    """
+    invocable = create_local_invocable(client, package_class, context, config)
+    recorder = traffic_recorders.get(capture_path) if capture_path else None
+    profiler = RequestProfiler(profile_dir, mode=profile_mode) if profile_dir else None
+    return BoundedThreadPoolServer(
+        ("", port),
+        make_handler(package_class, client, context, config, invocable, recorder, profiler),
+        max_workers=max_workers,
+        max_queued=max_queued,
+    )
+
+def use_local_with_ngrok(client: Steamship, package_class, config: Optional[dict] = None, port: int = 8080,
+                         max_workers: int = 8, max_queued: int = 64, capture_path: Optional[str] = None,
+                         profile_dir: Optional[str] = None, profile_mode: str = "sample"):
     """Configures a local-host compatible instance and wires an HTTP endpoint up to it."""
+    from pyngrok import ngrok
+
     # Open a HTTP tunnel on the default port 80
     # <NgrokTunnel: "http://<public_sub>.ngrok.io" -> "http://localhost:80">
     http_tunnel = ngrok.connect(port, bind_tls=True)
@@ -68,31 +149,13 @@ def use_local_with_ngrok(client: Steamship, package_class, config: Optional[dict
     print(f"URL: {public_url}")
     print(f"Client Auth: Hardcoded")
 
-    # We need to trigger the instance init.
     context = InvocationContext(
         invocable_url=f"{public_url}/"
     )
 
-    # Now start the server
-    httpd = TCPServer(("", port), make_handler(package_class, client, context, config))
-
-    invocation = Invocation(
-        http_verb="POST",
-        invocation_path="__dir__",
-        arguments={},
-        config=config
-    )
-    event = InvocableRequest(
-        client_config=client.config,
-        invocation=invocation,
-        logging_config=LoggingConfig(logging_host=None, logging_port=None),
-        invocation_context=context
-    )
-    handler = create_safe_handler(package_class)
-    resp = handler(event.dict(by_alias=True), context)
+    # The instance init (which registers the webhook) runs once, here, not on every request
+    httpd = serve_local(client, package_class, context, config, port=port, max_workers=max_workers, max_queued=max_queued,
+                        capture_path=capture_path, profile_dir=profile_dir, profile_mode=profile_mode)
 
-
-    print(f"Now serving..")
+    print(f"Now serving with {max_workers} workers..")
     httpd.serve_forever()
-
-